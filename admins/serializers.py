@@ -10,8 +10,9 @@ User = get_user_model()
 
 class EarningsSerializer(serializers.ModelSerializer):
     transaction_no = serializers.CharField(source='id')
-    rider_name = serializers.CharField(source='rider.fullname')
-    rider_email = serializers.CharField(source='rider.email')
+    # Bookings still waiting for a rider have none
+    rider_name = serializers.CharField(source='rider.fullname', default=None, allow_null=True)
+    rider_email = serializers.CharField(source='rider.email', default=None, allow_null=True)
     date = serializers.DateTimeField(source='created_at', format='%d/%m/%Y')
     
     class Meta:
@@ -189,6 +189,15 @@ class TestEarningsListView(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertGreater(len(response.data), 0)  # Check earnings data is returned
     
+    def test_bookings_without_a_rider_are_listed(self):
+        """Test that bookings still waiting for a rider are listed without one."""
+        Booking.objects.filter(id=self.ride_booking.id).update(rider=None)
+        self.authenticate_admin()
+        response = self.client.get(self.url, {'type': 'ride'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNone(response.data[0]['rider_name'])
+        self.assertIsNone(response.data[0]['rider_email'])
+
     def test_filter_by_type(self):
         """Test admin can filter earnings by booking type (ride/delivery)."""
         self.authenticate_admin()
@@ -0,0 +1,190 @@
+"""
+Ride chat: messages buffered in Redis and written behind in bulk, the latest
+ones cached per booking, and their history paged newest first by keyset on
+(booking, timestamp, id)
+"""
+# pylint: disable=no-member
+import json
+from datetime import datetime
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.db.models import Q
+from channels.db import database_sync_to_async
+
+from ecoride.chat_cache import recent_messages
+from ecoride.redis_client import extend_lock, get_redis, get_async_redis
+
+from .models import Booking, RideChatMessage
+
+# List of chat messages (JSON) waiting to be inserted, oldest first
+RIDE_CHAT_BUFFER_KEY = 'ride_chat_buffer'
+RIDE_CHAT_FLUSH_LOCK_KEY = 'ride_chat_flush_lock'
+# Seconds the flush lock is held for, renewed before every batch
+RIDE_CHAT_FLUSH_LOCK_TIMEOUT = 60
+# Hash counting failed flushes: 'consecutive' since the last good one, and 'total'
+RIDE_CHAT_FLUSH_FAILURES_KEY = 'ride_chat_flush_failures'
+# List of buffered messages that could not be inserted even one at a time
+RIDE_CHAT_DEAD_LETTERS_KEY = 'ride_chat_dead_letters'
+
+def recent_chat_key(booking_id):
+    """Key of the capped list of a booking's latest chat message frames"""
+    return f'booking_{booking_id}_recent_chat'
+
+def encode_cursor(timestamp, message_id):
+    """Opaque cursor pointing just before a message"""
+    return f'{timestamp.isoformat()}|{message_id}'
+
+def decode_cursor(cursor):
+    """``(timestamp, message_id)`` from a cursor; raises ValueError if it is malformed"""
+    timestamp, message_id = cursor.rsplit('|', 1)
+    return datetime.fromisoformat(timestamp), int(message_id)
+
+def chat_message_frame(message):
+    """One chat message as sent over the socket, from a ``values()`` row"""
+    return {
+        'message': message['message'],
+        'user': str(message['sender_id']),
+        'role': message['sender__role'],
+        'timestamp': message['timestamp'].isoformat(),
+    }
+
+def chat_history_rows(booking_id, before=None, limit=None):
+    """
+    Up to ``limit`` (default RIDE_CHAT_HISTORY_PAGE) ``values()`` rows of a
+    booking's chat older than the ``before`` cursor, oldest first, and the
+    cursor of the next older page (``None`` when there is none).
+
+    Seeks on the (booking, timestamp, id) index, so every page costs the same
+    however long the chat is.
+    """
+    limit = limit or settings.RIDE_CHAT_HISTORY_PAGE
+    messages = RideChatMessage.objects.filter(booking_id=booking_id)
+    if before:
+        timestamp, message_id = decode_cursor(before)
+        messages = messages.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id))
+
+    page = list(messages.order_by('-timestamp', '-id')
+                .values('id', 'message', 'timestamp', 'sender_id', 'sender__role')[:limit + 1])
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_cursor(page[-1]['timestamp'], page[-1]['id'])
+    return page[::-1], next_cursor
+
+def chat_history_page(booking_id, before=None, limit=None):
+    """Like ``chat_history_rows``, with the messages as frames"""
+    page, next_cursor = chat_history_rows(booking_id, before, limit)
+    return [chat_message_frame(message) for message in page], next_cursor
+
+def frame_cursor(frame):
+    """
+    Cursor pointing just before a cached frame. Frames loaded from Postgres
+    keep their ``id``; ones cached on send have none yet and are paged past
+    by timestamp alone.
+    """
+    return encode_cursor(datetime.fromisoformat(frame['timestamp']), frame.get('id', 0))
+
+def older_chat_messages(booking_id, oldest, limit):
+    """
+    Up to ``limit`` frames of a booking's chat, with their ``id``, sent before
+    the ``oldest`` cached frame (the latest when it is ``None``), oldest first,
+    and whether that is all of them
+    """
+    page, next_cursor = chat_history_rows(booking_id, frame_cursor(oldest) if oldest else None, limit)
+    return [dict(chat_message_frame(message), id=message['id']) for message in page], next_cursor is None
+
+async def latest_chat_history(booking_id):
+    """
+    The latest RIDE_CHAT_HISTORY_PAGE messages of a booking's chat and the
+    cursor of the next older page, like ``chat_history_page`` but served from
+    the recent message cache, so reconnects usually skip Postgres.
+    """
+    frames, complete = await recent_messages(
+        recent_chat_key(booking_id),
+        lambda oldest, limit: database_sync_to_async(older_chat_messages)(booking_id, oldest, limit),
+    )
+    page = frames[-settings.RIDE_CHAT_HISTORY_PAGE:]
+    messages = [{key: value for key, value in frame.items() if key != 'id'} for frame in page]
+    if not page or (complete and len(page) == len(frames)):
+        return messages, None
+    return messages, frame_cursor(page[0])
+
+def buffered_chat_message(raw):
+    """A RideChatMessage from a buffer entry"""
+    entry = json.loads(raw)
+    return RideChatMessage(booking_id=entry['booking_id'], sender_id=entry['sender_id'],
+                           message=entry['message'], timestamp=datetime.fromisoformat(entry['timestamp']))
+
+async def buffer_chat_message(booking_id, sender_id, message, timestamp):
+    """Queue a chat message for the next bulk insert; returns how many are waiting"""
+    return await get_async_redis().rpush(RIDE_CHAT_BUFFER_KEY, json.dumps({
+        'booking_id': int(booking_id),
+        'sender_id': str(sender_id),
+        'message': message,
+        'timestamp': timestamp.isoformat(),
+    }))
+
+def insert_chat_messages(messages):
+    """Bulk insert chat messages by FK id, dropping those of bookings deleted meanwhile"""
+    existing_ids = set(Booking.objects.filter(id__in={message.booking_id for message in messages})
+                       .values_list('id', flat=True))
+    return len(RideChatMessage.objects.bulk_create(
+        [message for message in messages if message.booking_id in existing_ids]))
+
+def insert_chat_messages_one_by_one(entries):
+    """Insert buffer entries separately, moving the ones that fail to the dead letters"""
+    inserted = 0
+    for raw in entries:
+        try:
+            with transaction.atomic():
+                count = insert_chat_messages([buffered_chat_message(raw)])
+        except DatabaseError:
+            get_redis().rpush(RIDE_CHAT_DEAD_LETTERS_KEY, raw)
+        else:
+            inserted += count
+    return inserted
+
+def flush_chat_buffer(batch_size=None, lock=None):
+    """
+    Move buffered chat messages into Postgres, ``batch_size`` (default
+    RIDE_CHAT_FLUSH_SIZE) per bulk insert, for at most RIDE_CHAT_FLUSH_MAX_BATCHES
+    batches. Must run under the flush lock; when its token ``lock`` is given
+    the lock is renewed before every batch and the flush stops once it is lost.
+
+    Entries leave the buffer only once their insert has committed, so a failed
+    flush is counted in RIDE_CHAT_FLUSH_FAILURES_KEY, re-raised and retried by
+    the next one. After RIDE_CHAT_FLUSH_MAX_FAILURES failures in a row the batch
+    is inserted row by row and rows that still fail go to the dead letters
+    instead of blocking the buffer. Returns how many messages were inserted.
+    """
+    batch_size = batch_size or settings.RIDE_CHAT_FLUSH_SIZE
+    redis_client = get_redis()
+    inserted = 0
+    for _ in range(settings.RIDE_CHAT_FLUSH_MAX_BATCHES):
+        if lock and not extend_lock(RIDE_CHAT_FLUSH_LOCK_KEY, lock, RIDE_CHAT_FLUSH_LOCK_TIMEOUT):
+            return inserted  # Another flush holds the lock now
+        entries = redis_client.lrange(RIDE_CHAT_BUFFER_KEY, 0, batch_size - 1)
+        if not entries:
+            return inserted
+
+        try:
+            with transaction.atomic():
+                count = insert_chat_messages([buffered_chat_message(raw) for raw in entries])
+        except DatabaseError:
+            redis_client.hincrby(RIDE_CHAT_FLUSH_FAILURES_KEY, 'total', 1)
+            failures = redis_client.hincrby(RIDE_CHAT_FLUSH_FAILURES_KEY, 'consecutive', 1)
+            if failures < settings.RIDE_CHAT_FLUSH_MAX_FAILURES:
+                raise
+            count = insert_chat_messages_one_by_one(entries)
+        inserted += count
+
+        # Only the flushed head is trimmed; messages buffered meanwhile were appended after it
+        pipe = redis_client.pipeline()
+        pipe.ltrim(RIDE_CHAT_BUFFER_KEY, len(entries), -1)
+        pipe.hset(RIDE_CHAT_FLUSH_FAILURES_KEY, 'consecutive', 0)
+        pipe.execute()
+        if len(entries) < batch_size:
+            return inserted
+    # The rest is left to the next flush
+    return inserted
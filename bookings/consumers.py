@@ -1,89 +1,192 @@
+import asyncio
 import json
-import jwt
-import redis
+import time
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.contrib.auth import get_user_model
+from django.utils import timezone
 from channels.db import database_sync_to_async
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 from rest_framework.exceptions import AuthenticationFailed
 
-from .models import Booking, RideChatMessage
+from ecoride.chat_cache import push_recent_message
+from ecoride.redis_client import get_async_redis
 
-User = get_user_model()
-
-# Set up Redis connection
-r = redis.StrictRedis(host='redis', port=6379, db=0)
+from .locations import RIDER_LOCATIONS_KEY, RIDER_LOCATION_FRAMES_KEY, LocationThrottle,\
+    rider_location_key, rider_bookings_key
+from .trails import rider_trips_key, append_trail_points
+from .frames import LOCATION_SUBPROTOCOL, decode_location, encode_location
+from .presence import touch_rider, remove_rider
+from .participants import booking_participants
+from .chat import buffer_chat_message, chat_history_page, latest_chat_history, recent_chat_key
+from .tasks import flush_ride_chat
 
 class RiderLocationConsumer(AsyncWebsocketConsumer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.throttle = LocationThrottle(
+            settings.RIDER_LOCATION_MIN_DISTANCE,
+            settings.RIDER_LOCATION_MIN_INTERVAL / 1000,
+        )
+        self.flush_task = None
+        # Heading and speed of the throttle's pending position
+        self.pending_motion = (None, None)
+        self.last_heartbeat = 0
+
     async def connect(self):
-        # Get the token from the query string
-        self.token = self.scope['query_string'].decode().split("token=")[1]
+        # The user authenticated by JWTAuthMiddleware, if any
+        self.user = self.scope.get('principal')
 
         try:
-            # Decode the JWT token to retrieve the user ID
-            decoded_data = jwt.decode(self.token, settings.SECRET_KEY, algorithms=["HS256"])
-            self.user = await self.get_user(decoded_data['user_id'])
-
             # Check if the user exists and if they are a rider
             if self.user and self.user.role == "Rider":
-                # Add the rider's ID to the active riders set in Redis
-                r.sadd('active_riders', str(self.user.id))
-
-                # Accept the WebSocket connection
-                await self.accept()
+                # Mark the rider as online in Redis
+                pipe = get_async_redis().pipeline()
+                touch_rider(pipe, self.user.id)
+                await pipe.execute()
+                self.last_heartbeat = time.monotonic()
+
+                # Accept the WebSocket connection, in binary frames if the client asked for them
+                if LOCATION_SUBPROTOCOL in self.scope.get('subprotocols', []):
+                    await self.accept(subprotocol=LOCATION_SUBPROTOCOL)
+                else:
+                    await self.accept()
             else:
                 # Close the connection if the user is not a rider
                 raise AuthenticationFailed("User is not a rider")
 
-        except (jwt.ExpiredSignatureError, jwt.InvalidTokenError, AuthenticationFailed):
+        except AuthenticationFailed:
             await self.close()
             return
 
-    async def receive(self, text_data):
-        # Parse the incoming data
-        data = json.loads(text_data)
-        rider_lat = data['latitude']
-        rider_long = data['longitude']
+    async def receive(self, text_data=None, bytes_data=None):
+        # Parse the incoming data; the frame's own timestamp is replaced by the server's
+        if bytes_data is not None:
+            try:
+                rider_lat, rider_long, _, heading, speed = decode_location(bytes_data)
+            except ValueError:
+                return  # Ignore malformed frames rather than dropping the connection
+        else:
+            data = json.loads(text_data)
+            rider_lat = data['latitude']
+            rider_long = data['longitude']
+            heading, speed = data.get('heading'), data.get('speed')
+
+        # Coalesce frames that arrive too often or barely move
+        now = time.monotonic()
+        decision = self.throttle.offer(rider_lat, rider_long, now)
+        if decision == LocationThrottle.ACCEPT:
+            await self.store_location(rider_lat, rider_long, heading, speed)
+            return
+        if decision == LocationThrottle.DEFER:
+            self.pending_motion = (heading, speed)
+
+        if decision == LocationThrottle.DEFER and self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_pending_location())
+
+        # A rider standing still still counts as online
+        if now - self.last_heartbeat >= settings.RIDER_HEARTBEAT_INTERVAL:
+            await self.heartbeat()
+
+    async def heartbeat(self):
+        # Refresh the rider's presence and keep their last location and booking sets from expiring
+        self.last_heartbeat = time.monotonic()
+        pipe = get_async_redis().pipeline()
+        touch_rider(pipe, self.user.id)
+        pipe.expire(rider_location_key(self.user.id), settings.RIDER_PRESENCE_TTL)
+        pipe.expire(rider_bookings_key(self.user.id), settings.RIDER_BOOKINGS_TTL)
+        pipe.expire(rider_trips_key(self.user.id), settings.RIDER_BOOKINGS_TTL)
+        await pipe.execute()
+
+    async def flush_pending_location(self):
+        # Write the latest deferred frame once the throttle interval has passed
+        while (delay := self.throttle.retry_after(time.monotonic())) > 0:
+            await asyncio.sleep(delay)
+        self.flush_task = None
+        pending = self.throttle.take_pending(time.monotonic())
+        if pending is not None:
+            await self.store_location(*pending, *self.pending_motion)
+
+    async def store_location(self, rider_lat, rider_long, heading=None, speed=None):
+        accepted, dropped = self.throttle.drain_counters()
+
+        # Store the rider's location in Redis and index it for nearest-rider lookups. The
+        # stored location stays JSON whatever the frame format, since the broadcaster and
+        # the API read it too; heading and speed are kept in it when the rider sent them.
+        location = {'lat': rider_lat, 'long': rider_long}
+        if heading is not None and speed is not None:
+            location.update(heading=heading, speed=speed)
+        self.last_heartbeat = time.monotonic()
+        pipe = get_async_redis().pipeline()
+        pipe.set(rider_location_key(self.user.id), json.dumps(location), ex=settings.RIDER_PRESENCE_TTL)
+        pipe.geoadd(RIDER_LOCATIONS_KEY, [rider_long, rider_lat, str(self.user.id)])
+        touch_rider(pipe, self.user.id)
+        pipe.expire(rider_bookings_key(self.user.id), settings.RIDER_BOOKINGS_TTL)
+        pipe.expire(rider_trips_key(self.user.id), settings.RIDER_BOOKINGS_TTL)
+        pipe.hincrby(RIDER_LOCATION_FRAMES_KEY, 'accepted', accepted)
+        pipe.hincrby(RIDER_LOCATION_FRAMES_KEY, 'dropped', dropped)
+        pipe.smembers(rider_bookings_key(self.user.id))
+        pipe.smembers(rider_trips_key(self.user.id))
+        *_, booking_ids, trip_ids = await pipe.execute()
+
+        # Record the position on the trail of every trip the rider is serving
+        if trip_ids:
+            pipe = get_async_redis().pipeline()
+            append_trail_points(pipe, [trip_id.decode('utf-8') for trip_id in trip_ids],
+                                rider_lat, rider_long)
+            await pipe.execute()
+
+        if settings.RIDER_LOCATION_FANOUT != 'push':
+            return
 
-        # Store the rider's location in Redis
-        r.set(f'rider_{self.user.id}_location', json.dumps({'lat': rider_lat, 'long': rider_long}))
+        # Push the update straight to every booking this rider is being tracked on
+        timestamp = int(time.time())
+        for booking_id in booking_ids:
+            await self.channel_layer.group_send(
+                f'booking_{booking_id.decode("utf-8")}',
+                {
+                    'type': 'rider_location',
+                    'latitude': rider_lat,
+                    'longitude': rider_long,
+                    'heading': location.get('heading'),
+                    'speed': location.get('speed'),
+                    'timestamp': timestamp,
+                }
+            )
 
     async def disconnect(self, close_code):
-        # Remove the rider's ID from the active riders set in Redis when they disconnect
-        r.srem('active_riders', str(self.user.id))
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        if self.throttle.pending is not None:
+            self.throttle.dropped += 1
+        accepted, dropped = self.throttle.drain_counters()
+
+        # Take the rider offline and out of the location index when they disconnect
+        pipe = get_async_redis().pipeline()
+        remove_rider(pipe, self.user.id)
+        pipe.hincrby(RIDER_LOCATION_FRAMES_KEY, 'accepted', accepted)
+        pipe.hincrby(RIDER_LOCATION_FRAMES_KEY, 'dropped', dropped)
+        await pipe.execute()
 
         # Close the WebSocket connection
         await self.close()
     
-    @database_sync_to_async
-    def get_user(self, user_id):
-        # Retrieve the user by their ID (adjust according to your project’s user model)
-        try:
-            return User.objects.get(id=user_id)
-        except User.DoesNotExist:
-            return None
-
 class RideTrackingConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        # Extract the token from the query string
-        self.token = self.scope['query_string'].decode().split("token=")[1]
-        
-        try:
-            # Decode the JWT token to retrieve the user ID
-            decoded_data = jwt.decode(self.token, settings.SECRET_KEY, algorithms=["HS256"])
-            self.user = await self.get_user(decoded_data['user_id'])
+        # The user authenticated by JWTAuthMiddleware, if any
+        self.user = self.scope.get('principal')
 
+        try:
             # Check if the user exists and has the correct role (e.g., 'user')
             if not self.user or self.user.role != "User":
                 raise AuthenticationFailed("Invalid user or role")
         
             # Check if the booking exists and is associated with the user
             self.booking_id = self.scope['url_route']['kwargs']['booking_id']
-            booking_user_id = await self.get_booking_user_id(self.booking_id)
+            booking_user_id, self.rider_id = await booking_participants(self.booking_id)
 
-            if booking_user_id != self.user.id:
+            if booking_user_id != str(self.user.id):
                 raise AuthenticationFailed("User is not associated with this booking")
             
             # Join the tracking group
@@ -93,19 +196,35 @@ class RideTrackingConsumer(AsyncWebsocketConsumer):
                 self.channel_name
             )
 
-            # Add the booking ID to active bookings in Redis
-            r.sadd('active_bookings', str(self.booking_id))
-
-            # Accept the WebSocket connection
-            await self.accept()
+            # Add the booking ID to active bookings and to the rider's push index in Redis; a
+            # booking with no rider yet is indexed when one is assigned (booking_riders_changed)
+            pipe = get_async_redis().pipeline()
+            pipe.sadd('active_bookings', str(self.booking_id))
+            if self.rider_id is not None:
+                pipe.sadd(rider_bookings_key(self.rider_id), str(self.booking_id))
+                pipe.expire(rider_bookings_key(self.rider_id), settings.RIDER_BOOKINGS_TTL)
+            await pipe.execute()
+
+            # Accept the WebSocket connection, in binary frames if the client asked for them
+            self.binary = LOCATION_SUBPROTOCOL in self.scope.get('subprotocols', [])
+            if self.binary:
+                await self.accept(subprotocol=LOCATION_SUBPROTOCOL)
+            else:
+                await self.accept()
 
-        except (jwt.ExpiredSignatureError, jwt.InvalidTokenError, AuthenticationFailed):
+        except AuthenticationFailed:
             await self.close()
             return
 
     async def disconnect(self, close_code):
-        # Remove the booking ID from Redis active bookings
-        r.srem('active_bookings', str(self.booking_id))
+        # Remove the booking ID from Redis active bookings and the rider's push index,
+        # looking the rider up again since the booking may have been (re)assigned meanwhile
+        _, rider_id = await booking_participants(self.booking_id)
+        pipe = get_async_redis().pipeline()
+        pipe.srem('active_bookings', str(self.booking_id))
+        if rider_id is not None:
+            pipe.srem(rider_bookings_key(rider_id), str(self.booking_id))
+        await pipe.execute()
 
         # Leave the tracking group
         await self.channel_layer.group_discard(
@@ -115,46 +234,33 @@ class RideTrackingConsumer(AsyncWebsocketConsumer):
 
     async def rider_location(self, event):
         # Send the rider's location to the WebSocket client
-        await self.send(text_data=json.dumps({
-            'latitude': event['latitude'],
-            'longitude': event['longitude'],
-        }))
-
-    # Helper function to fetch the booking asynchronously
-    @database_sync_to_async
-    def get_booking_user_id(self, booking_id):
-        try:
-            return Booking.objects.get(id=booking_id).user.id
-        except Booking.DoesNotExist:
-            return None
+        if self.binary:
+            await self.send(bytes_data=encode_location(
+                event['latitude'], event['longitude'], event.get('timestamp') or int(time.time()),
+                event.get('heading'), event.get('speed')))
+            return
 
-    # Helper function to fetch the user asynchronously
-    @database_sync_to_async
-    def get_user(self, user_id):
-        try:
-            return User.objects.get(id=user_id)
-        except User.DoesNotExist:
-            return None
+        location = {'latitude': event['latitude'], 'longitude': event['longitude']}
+        if event.get('heading') is not None and event.get('speed') is not None:
+            location.update(heading=event['heading'], speed=event['speed'])
+        await self.send(text_data=json.dumps(location))
 
 class RideChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.token = self.scope['query_string'].decode().split("token=")[1]
+        # The user authenticated by JWTAuthMiddleware, if any
+        self.user = self.scope.get('principal')
 
         try:
-            # Decode the JWT token to retrieve the user ID
-            decoded_data = jwt.decode(self.token, settings.SECRET_KEY, algorithms=["HS256"])
-            self.user = await self.get_user(decoded_data['user_id'])
-
             if not self.user:
                 raise AuthenticationFailed("Invalid user")
 
             self.booking_id = self.scope['url_route']['kwargs']['booking_id']
-            self.booking = await self.get_booking(self.booking_id)
+            participants = await booking_participants(self.booking_id)
 
-            if not self.booking:
+            if participants == (None, None):
                 raise AuthenticationFailed("Invalid booking")
 
-            if not self.is_user_associated_with_booking(self.user, self.booking):
+            if str(self.user.id) not in participants:
                 raise AuthenticationFailed("User is not associated with this booking")
 
             self.group_name = f'chat_{self.booking_id}'
@@ -166,17 +272,10 @@ class RideChatConsumer(AsyncWebsocketConsumer):
             # Accept the WebSocket connection
             await self.accept()
 
-            # Load and send the chat history for the booking when a user connects
-            chat_history = await self.get_chat_history(self.booking_id)
-            for chat_message in chat_history:
-                await self.send(text_data=json.dumps({
-                    'message': chat_message['message'],
-                    'user': str(chat_message['sender__id']),
-                    'role': chat_message['sender__role'],
-                    'timestamp': chat_message['timestamp'].isoformat()
-                }))
-
-        except (jwt.ExpiredSignatureError, jwt.InvalidTokenError, AuthenticationFailed):
+            # Send the latest page of the chat history in one frame; older pages on request
+            await self.send_history()
+
+        except AuthenticationFailed:
             await self.close()
 
     async def disconnect(self, close_code):
@@ -187,21 +286,30 @@ class RideChatConsumer(AsyncWebsocketConsumer):
 
     async def receive(self, text_data):
         text_data_json = json.loads(text_data)
+        if text_data_json.get('type') == 'chat_history':
+            await self.send_history(text_data_json.get('before'))
+            return
         message = text_data_json['message']
+        timestamp = timezone.now()
+        frame = {
+            'message': message,
+            'user': str(self.user.id),
+            'role': self.user.role,
+            'timestamp': timestamp.isoformat(),
+        }
 
-        # Save the message to the database
-        await self.save_chat_message(self.booking_id, self.user.id, message)
+        # Cache it for reconnects first, so a concurrent refill from Postgres cannot add it twice
+        pipe = get_async_redis().pipeline()
+        push_recent_message(pipe, recent_chat_key(self.booking_id), frame)
+        await pipe.execute()
 
-        # Send the message to the group
-        await self.channel_layer.group_send(
-            self.group_name,
-            {
-                'type': 'chat_message',
-                'message': message,
-                'user': str(self.user.id),
-                'role': self.user.role
-            }
-        )
+        # Send the message to the group straight away
+        await self.channel_layer.group_send(self.group_name, {'type': 'chat_message', **frame})
+
+        # Then buffer it for the bulk insert, flushing early once a batch is full
+        buffered = await buffer_chat_message(self.booking_id, self.user.id, message, timestamp)
+        if buffered % settings.RIDE_CHAT_FLUSH_SIZE == 0:
+            await sync_to_async(flush_ride_chat.delay, thread_sensitive=False)()
 
     async def chat_message(self, event):
         message = event['message']
@@ -211,38 +319,24 @@ class RideChatConsumer(AsyncWebsocketConsumer):
         await self.send(text_data=json.dumps({
             'message': message,
             'user': user_id,
-            'role': role
+            'role': role,
+            'timestamp': event.get('timestamp'),
         }))
 
-    @database_sync_to_async
-    def get_user(self, user_id):
+    async def send_history(self, before=None):
         try:
-            return User.objects.get(id=user_id)
-        except User.DoesNotExist:
-            return None
+            if before is not None and not isinstance(before, str):
+                raise ValueError('History cursors are strings')
+            if before is None:
+                messages, next_cursor = await latest_chat_history(self.booking_id)
+            else:
+                messages, next_cursor = await database_sync_to_async(chat_history_page)(self.booking_id, before)
+        except ValueError:
+            await self.send(text_data=json.dumps({'type': 'error', 'message': 'Invalid history cursor.'}))
+            return
 
-    @database_sync_to_async
-    def get_booking(self, booking_id):
-        try:
-            return Booking.objects.get(id=booking_id)
-        except Booking.DoesNotExist:
-            return None
-
-    @database_sync_to_async
-    def save_chat_message(self, booking_id, user_id, message):
-        booking = Booking.objects.get(id=booking_id)
-        sender = User.objects.get(id=user_id)
-        return RideChatMessage.objects.create(booking=booking, sender=sender, message=message)
-
-    @database_sync_to_async
-    def get_chat_history(self, booking_id):
-        # Query chat messages and include the sender's id and role
-        return list(RideChatMessage.objects.filter(booking_id=booking_id)
-                .order_by('timestamp')
-                .values('message', 'timestamp', 'sender__id', 'sender__role'))
-    
-    @database_sync_to_async
-    def is_user_associated_with_booking(self, user, booking):
-        if user.id in (booking.rider.id, booking.user.id):
-            return True
-        return False
\ No newline at end of file
+        await self.send(text_data=json.dumps({
+            'type': 'chat_history',
+            'messages': messages,
+            'next_cursor': next_cursor,
+        }))
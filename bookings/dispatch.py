@@ -0,0 +1,81 @@
+"""
+Automatic dispatch: pick the best free rider for a pickup point
+"""
+# pylint: disable=no-member
+import numpy as np
+from django.conf import settings
+
+from users.models import User
+
+from .eta import rider_etas
+from .locations import nearest_riders
+from .rider_state import ON_TRIP, busy_riders
+
+# Minimum wallet balance a rider needs to be offered work (as in AvailableRidersListView)
+MIN_RIDER_BALANCE = -5000
+
+def eligible_riders(rider_ids, busy_states=(ON_TRIP,)):
+    """
+    The subset of ``rider_ids`` that may be dispatched: riders in none of
+    ``busy_states`` (default: not on a trip) per the rider state cache, then
+    active riders whose wallet is above the threshold, with one query.
+    """
+    busy = busy_riders(busy_states) if busy_states else set()
+    return set(
+        str(rider_id) for rider_id in
+        User.objects.filter(
+            id__in=[rider_id for rider_id in rider_ids if str(rider_id) not in busy],
+            is_active=True,
+            role='Rider',
+            rider_wallet__balance__gt=MIN_RIDER_BALANCE,
+        ).values_list('id', flat=True)
+    )
+
+def rank_riders(latitude, longitude, radius=None, limit=None):
+    """
+    Eligible riders around a pickup point, best first, as
+    ``[(rider_id, distance_m, eta_s), ...]``.
+
+    Candidates come from the live location index, busy riders from the rider
+    state cache, wallet eligibility from a single batched query, and scoring
+    is one vectorized pass in memory.
+    """
+    radius = radius or settings.DISPATCH_RADIUS_KM
+
+    candidates = [rider_id for rider_id, _ in
+                  nearest_riders(latitude, longitude, radius, settings.DISPATCH_CANDIDATES)]
+    if not candidates:
+        return []
+
+    eligible = eligible_riders(candidates)
+    etas = rider_etas(latitude, longitude, [rider_id for rider_id in candidates if rider_id in eligible])
+    if not etas:
+        return []
+
+    rider_ids = list(etas)
+    scores = np.array([eta for _, eta in etas.values()])
+    ranked = [(rider_ids[index], *etas[rider_ids[index]]) for index in np.argsort(scores, kind='stable')]
+    return ranked[:limit] if limit else ranked
+
+def new_booking_notification(booking, pickup_eta=None):
+    """Payload offering a booking to its rider over the notification socket"""
+    return {
+        'type': 'new_booking_notification',
+        'booking_id': booking.id,
+        'booking_type': booking.booking_type,
+        'destination': booking.destination,
+        'origin': booking.origin,
+        'price': str(booking.price),
+        'payment_reference': booking.payment_reference,
+        'package_details': booking.package_details,
+        'pickup_eta': None if pickup_eta is None else round(pickup_eta),
+        'passenger_name': booking.user.fullname,
+        'passenger_email': booking.user.email,
+        'passenger_phone': booking.user.phone,
+        'passenger_address': booking.user.address,
+    }
+
+def dispatch(latitude, longitude):
+    """The best rider for a pickup point as ``(rider_id, distance_m, eta_s)``, or ``None``"""
+    ranked = rank_riders(latitude, longitude, limit=1)
+    return ranked[0] if ranked else None
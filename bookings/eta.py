@@ -0,0 +1,72 @@
+"""
+Vectorized distance and ETA from many riders to one pickup point
+"""
+import numpy as np
+from django.conf import settings
+
+from ecoride.redis_client import get_redis
+
+from .locations import RIDER_LOCATIONS_KEY, EARTH_RADIUS_M
+
+class SpeedModel:
+    """
+    Turns great-circle distances into travel times.
+
+    Roads are longer than the straight line, so distances are stretched by
+    ``detour_factor`` before dividing by ``speed_kmh``; ``overhead`` seconds
+    are added for parking, finding the passenger and so on.
+    """
+    def __init__(self, speed_kmh, detour_factor=1.0, overhead=0):
+        self.speed_ms = speed_kmh / 3.6
+        self.detour_factor = detour_factor
+        self.overhead = overhead
+
+    @classmethod
+    def from_settings(cls):
+        return cls(settings.RIDER_ETA_SPEED_KMH, settings.RIDER_ETA_DETOUR_FACTOR,
+                   settings.RIDER_ETA_OVERHEAD)
+
+    def eta(self, distances):
+        """Travel time in seconds for an array of distances in metres"""
+        return distances * self.detour_factor / self.speed_ms + self.overhead
+
+def great_circle_distances(latitude, longitude, latitudes, longitudes):
+    """Haversine distance in metres from one point to arrays of points"""
+    phi1 = np.radians(latitude)
+    phi2 = np.radians(latitudes)
+    d_phi = phi2 - phi1
+    d_lambda = np.radians(longitudes - longitude)
+    a = np.sin(d_phi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def rider_positions(rider_ids):
+    """
+    Last known positions of riders from the live location index, with one GEOPOS.
+
+    Returns ``(rider_ids, latitudes, longitudes)``; riders with no known
+    position are left out.
+    """
+    rider_ids = [str(rider_id) for rider_id in rider_ids]
+    if not rider_ids:
+        return [], np.empty(0), np.empty(0)
+
+    positions = get_redis().geopos(RIDER_LOCATIONS_KEY, *rider_ids)
+    located = [(rider_id, position) for rider_id, position in zip(rider_ids, positions) if position]
+    if not located:
+        return [], np.empty(0), np.empty(0)
+
+    coordinates = np.array([position for _, position in located], dtype=np.float64)
+    return [rider_id for rider_id, _ in located], coordinates[:, 1], coordinates[:, 0]
+
+def rider_etas(latitude, longitude, rider_ids, speed_model=None):
+    """
+    Distance (metres) and ETA (seconds) from each located rider to the pickup point.
+
+    Returns ``{rider_id: (distance, eta)}``; riders with no known position are
+    left out.
+    """
+    speed_model = speed_model or SpeedModel.from_settings()
+    located_ids, latitudes, longitudes = rider_positions(rider_ids)
+    distances = great_circle_distances(latitude, longitude, latitudes, longitudes)
+    etas = speed_model.eta(distances)
+    return dict(zip(located_ids, zip(distances.tolist(), etas.tolist())))
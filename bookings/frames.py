@@ -0,0 +1,31 @@
+"""
+Compact binary websocket frames for rider locations.
+
+Clients opt in by offering ``LOCATION_SUBPROTOCOL`` when opening the location
+or tracking socket; everyone else keeps the JSON text frames. A frame is
+little-endian float32 latitude, float32 longitude and uint32 unix timestamp,
+optionally followed by float32 heading (degrees) and float32 speed (m/s).
+"""
+import struct
+
+LOCATION_SUBPROTOCOL = 'ecoride.location.v1.bin'
+
+LOCATION_FRAME = struct.Struct('<ffI')
+LOCATION_FRAME_WITH_MOTION = struct.Struct('<ffIff')
+
+def decode_location(data):
+    """
+    Return ``(latitude, longitude, timestamp, heading, speed)`` from a binary
+    frame; raises ValueError if it is neither frame size
+    """
+    if len(data) == LOCATION_FRAME.size:
+        return LOCATION_FRAME.unpack(data) + (None, None)
+    if len(data) == LOCATION_FRAME_WITH_MOTION.size:
+        return LOCATION_FRAME_WITH_MOTION.unpack(data)
+    raise ValueError(f'Malformed location frame of {len(data)} bytes')
+
+def encode_location(latitude, longitude, timestamp, heading=None, speed=None):
+    """Pack a location into a binary frame, with heading and speed when both are known"""
+    if heading is None or speed is None:
+        return LOCATION_FRAME.pack(latitude, longitude, timestamp)
+    return LOCATION_FRAME_WITH_MOTION.pack(latitude, longitude, timestamp, heading, speed)
@@ -0,0 +1,117 @@
+"""
+Live rider location store backed by Redis
+"""
+import math
+
+from ecoride.redis_client import get_redis
+
+# Geospatial index (a sorted set under the hood) of every online rider's last position
+RIDER_LOCATIONS_KEY = 'rider_locations'
+
+# Hash of accepted/dropped location frame counters across all rider connections
+RIDER_LOCATION_FRAMES_KEY = 'rider_location_frames'
+
+EARTH_RADIUS_M = 6371008.8
+
+# GEOSEARCH returns riders that may still be filtered out by the eligibility
+# query, so ask Redis for a few more than the caller wants to keep.
+NEAREST_RIDERS_OVERFETCH = 3
+
+def rider_location_key(rider_id):
+    """Key holding the JSON blob of a rider's last known position"""
+    return f'rider_{rider_id}_location'
+
+def rider_bookings_key(rider_id):
+    """Key of the set of tracked booking IDs a rider's location is pushed to"""
+    return f'rider_{rider_id}_active_bookings'
+
+def nearest_riders(latitude, longitude, radius, limit):
+    """
+    Return up to ``limit * NEAREST_RIDERS_OVERFETCH`` ``(rider_id, distance_km)``
+    pairs within ``radius`` kilometres of the point, nearest first.
+    """
+    results = get_redis().geosearch(
+        RIDER_LOCATIONS_KEY,
+        longitude=longitude,
+        latitude=latitude,
+        radius=radius,
+        unit='km',
+        sort='ASC',
+        count=limit * NEAREST_RIDERS_OVERFETCH,
+        withdist=True,
+    )
+    return [(rider_id.decode('utf-8'), distance) for rider_id, distance in results]
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Great-circle distance in metres between two points"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+class LocationThrottle:
+    """
+    Per-connection coalescing of rider location frames.
+
+    A frame is accepted once ``min_interval`` seconds have passed since the
+    last accepted one and it has moved at least ``min_distance`` metres.
+    Frames that arrive sooner are held as the pending position (a newer one
+    replaces it) so the latest location is always written eventually; frames
+    that barely moved are dropped, along with any pending position, which is
+    older than them.
+    """
+    ACCEPT = 'accept'
+    DEFER = 'defer'
+    DROP = 'drop'
+
+    def __init__(self, min_distance, min_interval):
+        self.min_distance = min_distance
+        self.min_interval = min_interval
+        self.last = None
+        self.pending = None
+        self.accepted = 0
+        self.dropped = 0
+
+    def offer(self, latitude, longitude, now):
+        """Classify a new frame as ACCEPT, DEFER or DROP"""
+        if self.last is not None:
+            last_lat, last_lng, last_time = self.last
+            if haversine(last_lat, last_lng, latitude, longitude) < self.min_distance:
+                # The rider is back near the last written position, so a pending one is stale
+                self.dropped += 1 if self.pending is None else 2
+                self.pending = None
+                return self.DROP
+
+            if now - last_time < self.min_interval:
+                if self.pending is not None:
+                    self.dropped += 1
+                self.pending = (latitude, longitude)
+                return self.DEFER
+
+        self.accept(latitude, longitude, now)
+        return self.ACCEPT
+
+    def accept(self, latitude, longitude, now):
+        if self.pending is not None and self.pending != (latitude, longitude):
+            self.dropped += 1
+        self.pending = None
+        self.last = (latitude, longitude, now)
+        self.accepted += 1
+
+    def retry_after(self, now):
+        """Seconds until the pending frame may be written"""
+        return max(0, self.last[2] + self.min_interval - now)
+
+    def take_pending(self, now):
+        """Accept and return the pending frame, if any"""
+        pending = self.pending
+        if pending is not None:
+            self.accept(*pending, now)
+        return pending
+
+    def drain_counters(self):
+        """Return and reset the (accepted, dropped) counts since the last drain"""
+        counters = (self.accepted, self.dropped)
+        self.accepted = self.dropped = 0
+        return counters
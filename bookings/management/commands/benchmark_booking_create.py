@@ -0,0 +1,69 @@
+"""
+Benchmark latency of POST /new-booking/
+"""
+# pylint: disable=no-member
+import statistics
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from admins.models import NotificationMessage
+from users.models import User
+from bookings.models import Booking
+
+class Command(BaseCommand):
+    help = ("Send N booking requests through the full middleware and view stack and report "
+            "p50/p95/p99 latency. This writes users, bookings and admin notifications to the "
+            "configured database and sends their notifications, so it only runs with DEBUG on "
+            "unless --yes-i-know is given. Benchmark users, bookings and admin notifications are removed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--warmup', type=int, default=20)
+        parser.add_argument('--yes-i-know', action='store_true',
+                            help='Run even though DEBUG is off, e.g. against a staging database')
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['yes_i_know']:
+            raise CommandError('DEBUG is off, so this may be a production database; '
+                               'pass --yes-i-know to benchmark it anyway.')
+
+        passenger = User.objects.create_user(
+            fullname='Benchmark Passenger', email=f'{uuid.uuid4().hex}@bench.local',
+            phone=uuid.uuid4().hex[:15], password='benchmark', role='User', is_active=True)
+        rider = User.objects.create_user(
+            fullname='Benchmark Rider', email=f'{uuid.uuid4().hex}@bench.local',
+            phone=uuid.uuid4().hex[:15], password='benchmark', role='Rider', is_active=True)
+        last_message = NotificationMessage.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+        client = APIClient(SERVER_NAME='localhost')
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(passenger).access_token}')
+        url = reverse('booking-create')
+        data = {'rider': rider.email, 'booking_type': 'ride', 'origin': '123 Street',
+                'destination': '456 Avenue', 'price': 1500}
+
+        try:
+            timings = []
+            for index in range(options['warmup'] + options['requests']):
+                start = time.perf_counter()
+                response = client.post(url, data, format='json')
+                elapsed = time.perf_counter() - start
+                if response.status_code != 201:
+                    raise RuntimeError(f'Unexpected response {response.status_code}: {response.data}')
+                if index >= options['warmup']:
+                    timings.append(elapsed)
+        finally:
+            Booking.objects.filter(user=passenger).delete()
+            NotificationMessage.objects.filter(id__gt=last_message, body__contains=passenger.fullname).delete()
+            passenger.delete()
+            rider.delete()
+
+        percentiles = statistics.quantiles(timings, n=100)
+        self.stdout.write(
+            f'{len(timings)} requests  p50 {percentiles[49] * 1000:7.2f} ms  '
+            f'p95 {percentiles[94] * 1000:7.2f} ms  p99 {percentiles[98] * 1000:7.2f} ms')
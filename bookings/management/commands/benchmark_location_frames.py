@@ -0,0 +1,54 @@
+"""
+Benchmark CPU cost of JSON versus binary rider location frames
+"""
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from bookings.frames import decode_location, encode_location
+
+class Command(BaseCommand):
+    help = ("Measure CPU time to decode (rider socket) and encode (tracking socket) "
+            "N location frames as JSON text and as binary frames.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--frames', type=int, default=100000)
+
+    def handle(self, *args, **options):
+        frames = options['frames']
+        latitudes = [6.5244 + index / 1e6 for index in range(frames)]
+        longitudes = [3.3792 - index / 1e6 for index in range(frames)]
+        timestamp = int(time.time())
+
+        json_frames = [json.dumps({'latitude': lat, 'longitude': lng})
+                       for lat, lng in zip(latitudes, longitudes)]
+        binary_frames = [encode_location(lat, lng, timestamp)
+                         for lat, lng in zip(latitudes, longitudes)]
+
+        def decode_json():
+            for text_data in json_frames:
+                data = json.loads(text_data)
+                _ = (data['latitude'], data['longitude'])
+
+        def decode_binary():
+            for bytes_data in binary_frames:
+                decode_location(bytes_data)
+
+        def encode_json():
+            for lat, lng in zip(latitudes, longitudes):
+                json.dumps({'latitude': lat, 'longitude': lng})
+
+        def encode_binary():
+            for lat, lng in zip(latitudes, longitudes):
+                encode_location(lat, lng, timestamp)
+
+        self.stdout.write(f'{frames} frames, CPU time (process_time)')
+        for label, run in (('decode json', decode_json), ('decode binary', decode_binary),
+                           ('encode json', encode_json), ('encode binary', encode_binary)):
+            start = time.process_time()
+            run()
+            self.stdout.write(f'  {label:<14} {(time.process_time() - start) * 1000:8.1f} ms')
+
+        self.stdout.write(f'  frame size     json ~{len(json_frames[0])} bytes, '
+                          f'binary {len(binary_frames[0])} bytes')
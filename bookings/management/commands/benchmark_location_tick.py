@@ -0,0 +1,111 @@
+"""
+Benchmark one tick of the rider location broadcaster
+"""
+# pylint: disable=no-member
+import json
+import statistics
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ecoride.redis_client import get_redis
+from users.models import User
+from bookings.models import Booking
+from bookings.locations import rider_location_key
+from bookings.sharding import HashRing
+from bookings.tasks import broadcast_rider_locations
+
+class Rollback(Exception):
+    """Raised to roll back the benchmark fixtures"""
+
+class Command(BaseCommand):
+    help = ("Time one send_rider_location tick for N active bookings, batched and "
+            "per-booking (legacy), and the slowest shard when split between --workers "
+            "broadcaster workers. Fixtures are rolled back and Redis keys removed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bookings', type=int, nargs='+', default=[1000, 10000])
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--skip-legacy', action='store_true')
+        parser.add_argument('--workers', type=int, default=0,
+                            help='Also time the slowest shard with this many sharded workers')
+
+    def handle(self, *args, **options):
+        for size in options['bookings']:
+            try:
+                with transaction.atomic():
+                    self.run(size, options['repeat'], options['skip_legacy'], options['workers'])
+                    raise Rollback
+            except Rollback:
+                pass
+
+    def run(self, size, repeat, skip_legacy, workers):
+        passenger = User.objects.create(
+            fullname='Benchmark Passenger', email=f'{uuid.uuid4().hex}@bench.local',
+            phone=uuid.uuid4().hex[:15], role='User')
+        riders = User.objects.bulk_create([
+            User(fullname='Benchmark Rider', email=f'{uuid.uuid4().hex}@bench.local',
+                 phone=uuid.uuid4().hex[:15], role='Rider')
+            for _ in range(size)
+        ])
+        bookings = Booking.objects.bulk_create([
+            Booking(user=passenger, rider=rider, booking_type='ride',
+                    origin='A', destination='B', price=1000)
+            for rider in riders
+        ])
+        booking_ids = [str(booking.id) for booking in bookings]
+
+        location_keys = [rider_location_key(rider.id) for rider in riders]
+        get_redis().mset({key: json.dumps({'lat': 6.5, 'long': 3.36}) for key in location_keys})
+
+        try:
+            batched = self.time(lambda: broadcast_rider_locations(booking_ids), repeat)
+            self.report(size, 'batched', batched)
+            if workers:
+                # Each shard runs in its own process, so a tick lasts as long as the slowest shard
+                worker_ids = [f'bench-{index}' for index in range(workers)]
+                ring = HashRing(worker_ids)
+                shards = [ring.shard(worker_id, booking_ids) for worker_id in worker_ids]
+                sharded = [max(self.time(lambda shard=shard: broadcast_rider_locations(shard), 1)[0]
+                               for shard in shards)
+                           for _ in range(repeat)]
+                self.report(size, f'{workers} shards', sharded)
+            if not skip_legacy:
+                legacy = self.time(lambda: legacy_tick(booking_ids), repeat)
+                self.report(size, 'legacy', legacy)
+        finally:
+            get_redis().delete(*location_keys)
+
+    def time(self, tick, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            tick()
+            timings.append(time.perf_counter() - start)
+        return timings
+
+    def report(self, size, label, timings):
+        self.stdout.write(
+            f'{size:>6} bookings  {label:<10} median {statistics.median(timings) * 1000:9.1f} ms'
+            f'  min {min(timings) * 1000:9.1f} ms')
+
+def legacy_tick(booking_ids):
+    """The per-booking loop send_rider_location used before batching"""
+    channel_layer = get_channel_layer()
+    for booking_id in booking_ids:
+        booking = Booking.objects.get(id=booking_id)
+        rider_location = get_redis().get(rider_location_key(booking.rider.id))
+        if rider_location:
+            rider_location_data = json.loads(rider_location.decode('utf-8'))
+            async_to_sync(channel_layer.group_send)(
+                f'booking_{booking_id}',
+                {
+                    'type': 'rider_location',
+                    'latitude': rider_location_data['lat'],
+                    'longitude': rider_location_data['long'],
+                }
+            )
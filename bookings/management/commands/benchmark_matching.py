@@ -0,0 +1,55 @@
+"""
+Benchmark one batch matching window against greedy assignment
+"""
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from bookings.matching import eta_matrix, min_cost_assignment
+
+class Command(BaseCommand):
+    help = ("Time min_cost_assignment on random pickups and riders spread over a city, "
+            "and compare total pickup ETA with greedy nearest-free-rider assignment.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', default=['500x500', '1000x1000', '2000x3000', '3000x2000'],
+                            help='BOOKINGSxRIDERS per window')
+        parser.add_argument('--span', type=float, default=0.3, help='Side of the city in degrees')
+        parser.add_argument('--max-eta', type=float, default=1200, help='Longest allowed pickup ETA (s)')
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(0)
+        span = options['span']
+        max_cost = options['max_eta']
+
+        for size in options['sizes']:
+            bookings, riders = (int(value) for value in size.split('x'))
+            cost = eta_matrix(
+                rng.uniform(6.4, 6.4 + span, bookings), rng.uniform(3.2, 3.2 + span, bookings),
+                rng.uniform(6.4, 6.4 + span, riders), rng.uniform(3.2, 3.2 + span, riders),
+            )
+
+            start = time.perf_counter()
+            pairs = min_cost_assignment(cost, max_cost)
+            elapsed = time.perf_counter() - start
+
+            greedy = self.greedy(cost, max_cost)
+            self.stdout.write(
+                f'{size:>10}  {elapsed * 1000:8.1f} ms  matched {len(pairs):5} '
+                f'mean ETA {self.mean(cost, pairs):6.0f} s  |  greedy matched {len(greedy):5} '
+                f'mean ETA {self.mean(cost, greedy):6.0f} s')
+
+    def greedy(self, cost, max_cost):
+        """Each booking in arrival order takes its nearest still-free rider"""
+        taken = np.zeros(cost.shape[1], dtype=bool)
+        pairs = []
+        for row in range(cost.shape[0]):
+            column = int(np.argmin(np.where(taken, np.inf, cost[row])))
+            if not taken[column] and cost[row, column] <= max_cost:
+                taken[column] = True
+                pairs.append((row, column))
+        return pairs
+
+    def mean(self, cost, pairs):
+        return float(np.mean([cost[row, column] for row, column in pairs])) if pairs else 0.0
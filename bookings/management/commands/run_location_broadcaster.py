@@ -0,0 +1,60 @@
+"""
+Run one worker of the sharded rider location broadcaster
+"""
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from bookings.sharding import HashRing, heartbeat_worker, remove_worker, live_workers
+from bookings.tasks import active_booking_ids, broadcast_rider_locations
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = ("Broadcast rider locations for this worker's shard of active bookings. "
+            "Start as many workers as needed; active bookings are split between the "
+            "live ones by consistent hash and rebalanced as workers join or leave.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--worker-id', default=f'{socket.gethostname()}-{os.getpid()}')
+        parser.add_argument('--interval', type=float, default=settings.RIDER_LOCATION_BROADCAST_INTERVAL)
+        parser.add_argument('--ticks', type=int, default=None,
+                            help='Stop after this many ticks (runs until stopped by default)')
+
+    def handle(self, *args, **options):
+        worker_id = options['worker_id']
+        interval = options['interval']
+
+        # Leave the ring cleanly on docker stop / kill as well as Ctrl-C
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+        ring = None
+        ticks = 0
+        try:
+            while options['ticks'] is None or ticks < options['ticks']:
+                started = time.monotonic()
+                ring = self.tick(worker_id, ring)
+                ticks += 1
+                time.sleep(max(0, interval - (time.monotonic() - started)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            remove_worker(worker_id)
+
+    def tick(self, worker_id, ring):
+        """Broadcast this worker's shard once, rebuilding the ring if membership changed"""
+        heartbeat_worker(worker_id)
+        workers = live_workers(settings.LOCATION_BROADCASTER_TTL)
+        if ring is None or ring.nodes != set(workers):
+            ring = HashRing(workers)
+            logger.info('Location broadcaster %s: %d live workers', worker_id, len(workers))
+
+        shard = ring.shard(worker_id, active_booking_ids())
+        broadcast_rider_locations(shard)
+        return ring
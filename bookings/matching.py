@@ -0,0 +1,133 @@
+"""
+Batched assignment of pending bookings to free riders.
+
+Every matching window the unassigned bookings and the free riders are
+paired all at once by solving the assignment problem on the pickup ETA
+matrix, instead of giving each booking its nearest rider in arrival order.
+"""
+import numpy as np
+from django.conf import settings
+
+from .dispatch import eligible_riders
+from .eta import SpeedModel, great_circle_distances, rider_positions
+from .rider_state import free_riders
+
+def eta_matrix(pickup_latitudes, pickup_longitudes, rider_latitudes, rider_longitudes,
+               speed_model=None):
+    """Pickup ETA in seconds of every rider (columns) to every booking (rows)"""
+    speed_model = speed_model or SpeedModel.from_settings()
+    distances = great_circle_distances(
+        pickup_latitudes[:, None], pickup_longitudes[:, None],
+        rider_latitudes[None, :], rider_longitudes[None, :],
+    )
+    return speed_model.eta(distances)
+
+def min_cost_assignment(cost, max_cost):
+    """
+    Minimum-cost assignment of rows to columns (Hungarian method).
+
+    Pairs costing more than ``max_cost`` are not allowed; rows left without
+    an allowed column are left out. Uses shortest augmenting paths with
+    dual potentials on a rectangular matrix, one vectorized pass over the
+    columns per path step, after a greedy start that assigns every row
+    whose cheapest column is still free. Returns ``[(row, column), ...]``.
+    """
+    # Only rows and columns with at least one allowed pair take part
+    allowed = cost <= max_cost
+    row_ids = np.flatnonzero(allowed.any(axis=1))
+    column_ids = np.flatnonzero(allowed.any(axis=0))
+    if not row_ids.size:
+        return []
+    cost = cost[np.ix_(row_ids, column_ids)]
+    allowed = allowed[np.ix_(row_ids, column_ids)]
+
+    # Disallowed pairs cost more than any set of allowed ones, so the most
+    # rows possible are matched first and the total cost minimised second
+    cost = np.where(allowed, cost, (max_cost + 1) * (min(cost.shape) + 1))
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    rows, columns = cost.shape
+
+    # Greedy start: reduce each row by its minimum and take it if that column is free
+    cheapest = np.argmin(cost, axis=1)
+    row_potential = cost[np.arange(rows), cheapest]
+    column_potential = np.zeros(columns)
+    column_for_row = np.full(rows, -1)
+    row_for_column = np.full(columns, -1)
+    _, first = np.unique(cheapest, return_index=True)
+    column_for_row[first] = cheapest[first]
+    row_for_column[cheapest[first]] = first
+
+    for start in np.flatnonzero(column_for_row == -1).tolist():
+        shortest = np.full(columns, np.inf)
+        path = np.full(columns, -1)
+        remaining = np.ones(columns, dtype=bool)
+        visited_rows, visited_columns = [start], []
+        distance, row = 0.0, start
+
+        # Dijkstra over reduced costs until a free column is reached
+        while True:
+            reduced = distance + cost[row] - row_potential[row] - column_potential
+            shorter = remaining & (reduced < shortest)
+            shortest[shorter] = reduced[shorter]
+            path[shorter] = row
+
+            column = int(np.argmin(np.where(remaining, shortest, np.inf)))
+            distance = shortest[column]
+            remaining[column] = False
+            visited_columns.append(column)
+            if row_for_column[column] == -1:
+                break
+            row = row_for_column[column]
+            visited_rows.append(row)
+
+        # Keep the potentials feasible, then flip the path
+        row_potential[start] += distance
+        if len(visited_rows) > 1:
+            others = np.array(visited_rows[1:])
+            row_potential[others] += distance - shortest[column_for_row[others]]
+        visited_columns = np.array(visited_columns)
+        column_potential[visited_columns] -= distance - shortest[visited_columns]
+
+        while True:
+            row = path[column]
+            row_for_column[column] = row
+            column_for_row[row], column = column, column_for_row[row]
+            if row == start:
+                break
+
+    pairs = enumerate(column_for_row.tolist())
+    if transposed:
+        pairs = ((row, column) for column, row in pairs)
+    return [(int(row_ids[row]), int(column_ids[column])) for row, column in pairs
+            if allowed[row, column]]
+
+def free_rider_positions():
+    """
+    Online riders that may take a booking in this window, with their positions,
+    as ``(rider_ids, latitudes, longitudes)``.
+    """
+    # Online riders with neither an offer nor a trip, as one set difference
+    free = free_riders()
+    eligible = eligible_riders(free, busy_states=())
+    return rider_positions([rider_id for rider_id in free if rider_id in eligible])
+
+def match_bookings(bookings, rider_ids, rider_latitudes, rider_longitudes):
+    """
+    Pair pending bookings with free riders at minimum total pickup ETA.
+
+    ``bookings`` is a list of ``(booking_id, pickup_latitude, pickup_longitude)``.
+    Returns ``[(booking_id, rider_id, eta_s), ...]``.
+    """
+    if not bookings or not rider_ids:
+        return []
+
+    pickups = np.array([(latitude, longitude) for _, latitude, longitude in bookings], dtype=np.float64)
+    cost = eta_matrix(pickups[:, 0], pickups[:, 1], rider_latitudes, rider_longitudes)
+    max_cost = SpeedModel.from_settings().eta(settings.DISPATCH_RADIUS_KM * 1000)
+
+    return [
+        (bookings[row][0], rider_ids[column], float(cost[row, column]))
+        for row, column in min_cost_assignment(cost, max_cost)
+    ]
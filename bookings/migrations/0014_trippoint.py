@@ -0,0 +1,27 @@
+# Generated by Django 5.1 on 2026-10-16 23:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookings', '0013_booking_payment_method'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TripPoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('recorded_at', models.DateTimeField()),
+                ('booking', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='trail_points', to='bookings.booking')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['booking', 'recorded_at'], name='bookings_tr_booking_43e842_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1 on 2026-10-16 23:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookings', '0014_trippoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='pickup_latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='pickup_longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
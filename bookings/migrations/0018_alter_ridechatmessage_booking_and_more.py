@@ -0,0 +1,25 @@
+# Generated by Django 5.1 on 2026-10-17 00:30
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookings', '0017_booking_scheduled_for_alter_booking_status_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ridechatmessage',
+            name='booking',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='chat_messages', to='bookings.booking'),
+        ),
+        migrations.AddIndex(
+            model_name='ridechatmessage',
+            index=models.Index(fields=['booking', 'timestamp', 'id'], name='bookings_ri_booking_0237d3_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1 on 2026-10-17 00:32
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookings', '0018_alter_ridechatmessage_booking_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ridechatmessage',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -6,6 +6,7 @@ Models related to Bookings
 from django.db import models
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 
 from users.models import User
 
@@ -19,6 +20,7 @@ class Booking(models.Model):
     ]
 
     BOOKING_STATUS_CHOICES = [
+        ('scheduled', 'Scheduled'),
         ('pending', 'Pending'),
         ('accepted', 'Accepted'),
         ('in_progress', 'In Progress'),
@@ -36,7 +38,7 @@ class Booking(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,\
                              related_name='bookings_as_user')
     rider = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,\
-                              related_name='bookings_as_rider')
+                              related_name='bookings_as_rider', null=True, blank=True)
     booking_type = models.CharField(choices=BOOKING_TYPE_CHOICES, max_length=10)
     payment_reference = models.CharField(max_length=50, null=True, blank=True, unique=True)
     status = models.CharField(max_length=20, choices=BOOKING_STATUS_CHOICES, default='pending')
@@ -48,6 +50,9 @@ class Booking(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     package_details = models.TextField(null=True, blank=True)
     payment_method = models.CharField(max_length=4, default="card")
+    pickup_latitude = models.FloatField(null=True, blank=True)
+    pickup_longitude = models.FloatField(null=True, blank=True)
+    scheduled_for = models.DateTimeField(null=True, blank=True)
 
     # Dispute fields
     is_disputed = models.BooleanField(default=False)
@@ -56,6 +61,9 @@ class Booking(models.Model):
     dispute_reason = models.TextField(null=True, blank=True)
     dispute_resolution = models.TextField(null=True, blank=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['status', 'scheduled_for'])]
+
     def __str__(self):
         return f'{self.booking_type} booking by {self.user}'
 
@@ -104,14 +112,32 @@ class Wallet(models.Model):
         return f"Wallet of {self.rider.fullname} - Balance: {self.balance}"
     
 class RideChatMessage(models.Model):
-    booking = models.ForeignKey(Booking, on_delete=models.CASCADE, related_name="chat_messages")
+    booking = models.ForeignKey(Booking, on_delete=models.CASCADE, related_name="chat_messages",\
+                                db_index=False)
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     message = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the message is sent, not when the buffered insert runs
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['booking', 'timestamp', 'id'])]
 
     def __str__(self):
         return f"Message from {self.sender} in booking {self.booking.id}"
 
+class TripPoint(models.Model):
+    """
+    A recorded rider position during a booking, flushed in bulk from Redis
+    """
+    booking = models.ForeignKey(Booking, on_delete=models.CASCADE, related_name="trail_points",\
+                                db_index=False)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    recorded_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=['booking', 'recorded_at'])]
+
 class WithdrawalRequest(models.Model):
     rider = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -0,0 +1,104 @@
+"""
+Offer deadlines of pending bookings kept as a timing wheel in Redis.
+
+Each second of the wheel is a set of the booking IDs due then, and a hash
+maps every booking to its slot, so setting, moving and cancelling a timer
+are O(1) whatever the number outstanding. A periodic tick drains the slots
+that have come due since the last tick.
+"""
+import time
+
+from django.conf import settings
+
+from ecoride.redis_client import get_redis
+
+# Hash of booking ID -> second its offer times out; the slots are sets named
+# OFFER_TIMER_SLOT_PREFIX + second
+OFFER_TIMER_DEADLINES_KEY = 'offer_timer_deadlines'
+OFFER_TIMER_SLOT_PREFIX = 'offer_timers:'
+# Last second the tick has drained
+OFFER_TIMER_CURSOR_KEY = 'offer_timer_cursor'
+
+# How far back a tick catches up after downtime; older slots expire on their own
+TIMER_CATCH_UP = 3600
+
+# Slot keys are built from ARGV[1], so the wheel must live on a single Redis node.
+# Move booking ARGV[2] to the slot of second ARGV[3], or just cancel it when ARGV[3] is empty.
+SET_OFFER_TIMER = """
+local previous = redis.call('HGET', KEYS[1], ARGV[2])
+if previous then
+    redis.call('SREM', ARGV[1] .. previous, ARGV[2])
+end
+if ARGV[3] == '' then
+    return redis.call('HDEL', KEYS[1], ARGV[2])
+end
+local slot = ARGV[1] .. ARGV[3]
+redis.call('SADD', slot, ARGV[2])
+redis.call('EXPIRE', slot, ARGV[4])
+redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+return 1
+"""
+
+# Empty the slots from second ARGV[2] to ARGV[3] and return the bookings in them
+POP_DUE_OFFER_TIMERS = """
+local due = {}
+for second = tonumber(ARGV[2]), tonumber(ARGV[3]) do
+    local slot = ARGV[1] .. second
+    local bookings = redis.call('SMEMBERS', slot)
+    if #bookings > 0 then
+        redis.call('DEL', slot)
+        redis.call('HDEL', KEYS[1], unpack(bookings))
+        for _, booking in ipairs(bookings) do
+            due[#due + 1] = booking
+        end
+    end
+end
+redis.call('SET', KEYS[2], ARGV[3])
+return due
+"""
+
+def schedule_offer_timeouts(booking_ids, timeout=None, now=None):
+    """(Re)arm the offer timeout of bookings, ``timeout`` seconds (default OFFER_TTL) from now"""
+    if timeout is None:
+        timeout = settings.OFFER_TTL
+    second = int((now or time.time()) + timeout)
+    redis_client = get_redis()
+    set_timer = redis_client.register_script(SET_OFFER_TIMER)
+    pipe = redis_client.pipeline(transaction=False)
+    for booking_id in booking_ids:
+        set_timer(keys=[OFFER_TIMER_DEADLINES_KEY],
+                  args=[OFFER_TIMER_SLOT_PREFIX, booking_id, second, timeout + TIMER_CATCH_UP],
+                  client=pipe)
+    pipe.execute()
+
+def schedule_offer_timeout(booking_id, timeout=None, now=None):
+    """(Re)arm the offer timeout of one booking"""
+    schedule_offer_timeouts([booking_id], timeout, now)
+
+def cancel_offer_timeout(booking_id):
+    """Disarm a booking's offer timeout; returns whether one was armed"""
+    redis_client = get_redis()
+    set_timer = redis_client.register_script(SET_OFFER_TIMER)
+    return bool(set_timer(keys=[OFFER_TIMER_DEADLINES_KEY], args=[OFFER_TIMER_SLOT_PREFIX, booking_id, '', 0]))
+
+def offer_deadline(booking_id):
+    """Unix second a booking's offer times out, or ``None``"""
+    deadline = get_redis().hget(OFFER_TIMER_DEADLINES_KEY, str(booking_id))
+    return None if deadline is None else int(deadline)
+
+def pop_due_offer_timeouts(now=None):
+    """
+    Disarm and return the IDs of bookings whose offer has timed out since the
+    last tick. Costs one set per elapsed second plus one step per booking due.
+    """
+    now = int(now or time.time())
+    redis_client = get_redis()
+    cursor = redis_client.get(OFFER_TIMER_CURSOR_KEY)
+    start = now - TIMER_CATCH_UP if cursor is None else max(int(cursor) + 1, now - TIMER_CATCH_UP)
+    if start > now:
+        return []
+
+    pop_due = redis_client.register_script(POP_DUE_OFFER_TIMERS)
+    due = pop_due(keys=[OFFER_TIMER_DEADLINES_KEY, OFFER_TIMER_CURSOR_KEY],
+                  args=[OFFER_TIMER_SLOT_PREFIX, start, now])
+    return [int(booking_id) for booking_id in due]
@@ -0,0 +1,218 @@
+"""
+Offers of pending bookings to riders: in offer mode a booking goes to several
+nearby riders and the first to accept claims it. Offers nobody answers in
+time are re-offered to the next riders, or the booking is cancelled.
+"""
+# pylint: disable=no-member
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from ecoride.redis_client import get_redis
+
+from .models import Booking
+from .dispatch import rank_riders, new_booking_notification
+from .offer_timers import cancel_offer_timeout, schedule_offer_timeout
+from .participants import booking_riders_changed
+from .rider_state import refresh_rider_states
+from .trails import start_trip
+
+def offer_riders_key(booking_id):
+    """Key of the set of rider IDs a pending booking was offered to"""
+    return f'booking_{booking_id}_offer_riders'
+
+def offer_claim_key(booking_id):
+    """Key set (NX) by the first rider to accept a booking's offer"""
+    return f'booking_{booking_id}_offer_claim'
+
+def offer_rounds_key(booking_id):
+    """Key counting how many times a pending booking's offer has timed out"""
+    return f'booking_{booking_id}_offer_rounds'
+
+def offer_lifetime():
+    """Seconds a booking may stay on offer over all its rounds"""
+    return settings.OFFER_TTL * (settings.OFFER_ROUNDS + 1)
+
+def send_notifications(notifications):
+    """Deliver ``(user_id, message)`` pairs over NotificationConsumer concurrently"""
+    # pylint: disable=import-outside-toplevel
+    from .tasks import group_send_many
+
+    async_to_sync(group_send_many)(get_channel_layer(), [
+        (f'user_{user_id}_notifications', {'type': 'send_notification', 'message': message})
+        for user_id, message in notifications
+    ])
+
+def next_riders(booking, exclude=(), limit=None):
+    """Best free riders for a booking's pickup that it has not been offered to yet"""
+    if booking.pickup_latitude is None:
+        return []
+    exclude = {str(rider_id) for rider_id in exclude}
+    ranked = [candidate for candidate in rank_riders(booking.pickup_latitude, booking.pickup_longitude)
+              if candidate[0] not in exclude]
+    return ranked[:limit]
+
+def offer_booking(booking, exclude=()):
+    """
+    Offer a pending booking to the OFFER_RIDERS best free riders near its
+    pickup point, leaving out ``exclude``, and arm its offer timeout.
+    Returns the IDs of the riders it was offered to.
+    """
+    schedule_offer_timeout(booking.id)
+    ranked = next_riders(booking, exclude, limit=settings.OFFER_RIDERS)
+    if not ranked:
+        return []
+
+    rider_ids = [rider_id for rider_id, _, _ in ranked]
+    pipe = get_redis().pipeline()
+    pipe.sadd(offer_riders_key(booking.id), *rider_ids)
+    pipe.expire(offer_riders_key(booking.id), offer_lifetime())
+    pipe.execute()
+
+    notifications = []
+    for rider_id, _, eta in ranked:
+        message = new_booking_notification(booking, eta)
+        message['type'] = 'booking_offer'
+        notifications.append((rider_id, message))
+    send_notifications(notifications)
+    return rider_ids
+
+def claim_offer(booking_id, rider_id):
+    """
+    Let a rider accept an offered booking; exactly one concurrent caller wins.
+
+    Losers are turned away by a Redis SET NX before touching Postgres, so
+    hundreds of simultaneous accepts cost one conditional UPDATE (guarded
+    by ``status='pending'`` in case the passenger cancelled meanwhile) and
+    no row-lock queue. The winner's passenger is told the booking was
+    accepted and every other offered rider that it was taken.
+    """
+    redis_client = get_redis()
+    rider_id = str(rider_id)
+    if not redis_client.sismember(offer_riders_key(booking_id), rider_id):
+        return False
+    if not redis_client.set(offer_claim_key(booking_id), rider_id, nx=True, ex=offer_lifetime()):
+        return False
+
+    claimed = Booking.objects.filter(id=booking_id, status='pending', rider__isnull=True)\
+        .update(rider_id=rider_id, status='accepted')
+    if not claimed:
+        redis_client.delete(offer_claim_key(booking_id))
+        return False
+
+    booking = Booking.objects.only('id', 'user_id').get(id=booking_id)
+    start_trip(rider_id, booking_id)
+    refresh_rider_states([rider_id])
+    booking_riders_changed([(booking_id, rider_id, None)])
+    cancel_offer_timeout(booking_id)
+
+    pipe = redis_client.pipeline()
+    pipe.smembers(offer_riders_key(booking_id))
+    pipe.delete(offer_riders_key(booking_id), offer_rounds_key(booking_id))
+    losers, _ = pipe.execute()
+
+    taken = {'type': 'booking_offer_taken', 'booking_id': booking.id,
+             'message': f"Booking {booking.id} has been taken by another rider."}
+    notifications = [(loser.decode('utf-8'), taken) for loser in losers if loser.decode('utf-8') != rider_id]
+    notifications.append((booking.user_id, {
+        'type': 'booking_accepted',
+        'booking_id': booking.id,
+        'message': f"Your booking {booking.id} has been accepted by the rider.",
+    }))
+    send_notifications(notifications)
+    return True
+
+def reassign_booking(booking, exclude):
+    """
+    Move a pending booking its rider never answered to the next best rider.
+    Returns the new rider's ID, or ``None`` if there is none or the booking
+    changed meanwhile.
+    """
+    ranked = next_riders(booking, exclude, limit=1)
+    if not ranked:
+        return None
+    rider_id, _, eta = ranked[0]
+
+    # Conditional, so a booking accepted or cancelled meanwhile is left alone
+    moved = Booking.objects.filter(id=booking.id, status='pending', rider_id=booking.rider_id)\
+        .update(rider_id=rider_id)
+    if not moved:
+        return None
+
+    previous_rider_id = booking.rider_id
+    refresh_rider_states([previous_rider_id, rider_id])
+    booking_riders_changed([(booking.id, rider_id, previous_rider_id)])
+    pipe = get_redis().pipeline()
+    pipe.sadd(offer_riders_key(booking.id), str(previous_rider_id), rider_id)
+    pipe.expire(offer_riders_key(booking.id), offer_lifetime())
+    pipe.execute()
+    schedule_offer_timeout(booking.id)
+
+    booking.rider_id = rider_id
+    send_notifications([
+        (previous_rider_id, {
+            'type': 'booking_offer_expired',
+            'booking_id': booking.id,
+            'message': f"Booking {booking.id} was not accepted in time and has been offered to another rider.",
+        }),
+        (rider_id, new_booking_notification(booking, eta)),
+    ])
+    return rider_id
+
+def expire_booking(booking):
+    """Cancel a pending booking nobody accepted and tell its passenger; returns whether it was cancelled"""
+    expired = Booking.objects.filter(id=booking.id, status='pending').update(status='cancelled')
+    if not expired:
+        return False
+
+    redis_client = get_redis()
+    pipe = redis_client.pipeline()
+    pipe.smembers(offer_riders_key(booking.id))
+    pipe.delete(offer_riders_key(booking.id), offer_rounds_key(booking.id), offer_claim_key(booking.id))
+    offered, _ = pipe.execute()
+    refresh_rider_states([booking.rider_id])
+
+    riders = {rider_id.decode('utf-8') for rider_id in offered}
+    if booking.rider_id:
+        riders.add(str(booking.rider_id))
+    withdrawn = {'type': 'booking_offer_expired', 'booking_id': booking.id,
+                 'message': f"Booking {booking.id} is no longer available."}
+    notifications = [(rider_id, withdrawn) for rider_id in riders]
+    notifications.append((booking.user_id, {
+        'type': 'booking_expired',
+        'booking_id': booking.id,
+        'message': f"No rider accepted your booking {booking.id}, so it has been cancelled.",
+    }))
+    send_notifications(notifications)
+    return True
+
+def expire_offer(booking_id):
+    """
+    Handle a pending booking whose offer timed out: re-offer it to the next
+    riders for up to OFFER_ROUNDS rounds, then cancel it and tell the
+    passenger. Returns ``'reoffered'``, ``'cancelled'`` or ``None`` if the
+    booking is no longer pending.
+    """
+    booking = Booking.objects.select_related('user').filter(id=booking_id, status='pending').first()
+    if booking is None:
+        return None
+
+    pipe = get_redis().pipeline()
+    pipe.incr(offer_rounds_key(booking.id))
+    pipe.expire(offer_rounds_key(booking.id), offer_lifetime())
+    pipe.smembers(offer_riders_key(booking.id))
+    rounds, _, offered = pipe.execute()
+    offered = {rider_id.decode('utf-8') for rider_id in offered}
+
+    if rounds < settings.OFFER_ROUNDS:
+        if booking.rider_id is None:
+            # Earlier riders may still accept; the offer just widens
+            offer_booking(booking, exclude=offered)
+            return 'reoffered'
+        if reassign_booking(booking, offered | {str(booking.rider_id)}):
+            return 'reoffered'
+        # Nobody else is free yet: give the current rider another round
+        schedule_offer_timeout(booking.id)
+        return 'reoffered'
+
+    return 'cancelled' if expire_booking(booking) else None
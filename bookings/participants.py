@@ -0,0 +1,86 @@
+"""
+Passenger and rider of each booking, cached in Redis for the life of the trip
+"""
+# pylint: disable=no-member
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from ecoride.redis_client import get_async_redis, get_redis
+
+from .locations import rider_bookings_key
+from .models import Booking
+
+# Once a rider has accepted, a booking's passenger and rider no longer change
+LIVE_STATUSES = ('accepted', 'in_progress')
+
+# Safety net in case a trip is never ended
+PARTICIPANTS_TTL = 24 * 60 * 60
+
+# Move a booking from its previous rider's push set (KEYS[3], if any) to the
+# new rider's (KEYS[2]), but only while a passenger is tracking it (KEYS[1]);
+# RideTrackingConsumer adds untracked bookings itself when they connect.
+MOVE_TRACKED_BOOKING = """
+if KEYS[3] then
+    redis.call('SREM', KEYS[3], ARGV[1])
+end
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 1 then
+    redis.call('SADD', KEYS[2], ARGV[1])
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+end
+"""
+
+def booking_participants_key(booking_id):
+    """Key of the hash of a live booking's user_id and rider_id"""
+    return f'booking_{booking_id}_participants'
+
+@database_sync_to_async
+def load_booking_participants(booking_id):
+    return Booking.objects.filter(id=booking_id).values('user_id', 'rider_id', 'status').first()
+
+async def booking_participants(booking_id):
+    """
+    ``(user_id, rider_id)`` of a booking as strings (``rider_id`` may be ``None``),
+    or ``(None, None)`` if there is no such booking.
+
+    One query the first time; accepted and in-progress bookings are then
+    answered from Redis until ``end_trip``.
+    """
+    redis_client = get_async_redis()
+    key = booking_participants_key(booking_id)
+    user_id, rider_id = await redis_client.hmget(key, 'user_id', 'rider_id')
+    if user_id is not None:
+        return user_id.decode('utf-8'), rider_id.decode('utf-8')
+
+    booking = await load_booking_participants(booking_id)
+    if booking is None:
+        return None, None
+    user_id = str(booking['user_id'])
+    rider_id = None if booking['rider_id'] is None else str(booking['rider_id'])
+
+    if booking['status'] in LIVE_STATUSES:
+        pipe = redis_client.pipeline()
+        pipe.hset(key, mapping={'user_id': user_id, 'rider_id': rider_id})
+        pipe.expire(key, PARTICIPANTS_TTL)
+        await pipe.execute()
+    return user_id, rider_id
+
+def booking_riders_changed(changes):
+    """
+    Point each ``(booking_id, rider_id, previous_rider_id)`` booking's location
+    pushes at its new rider and drop its cached participants.
+    """
+    redis_client = get_redis()
+    move = redis_client.register_script(MOVE_TRACKED_BOOKING)
+    pipe = redis_client.pipeline()
+    for booking_id, rider_id, previous_rider_id in changes:
+        pipe.delete(booking_participants_key(booking_id))
+        keys = ['active_bookings', rider_bookings_key(rider_id)]
+        if previous_rider_id is not None and str(previous_rider_id) != str(rider_id):
+            keys.append(rider_bookings_key(previous_rider_id))
+        move(keys=keys, args=[str(booking_id), settings.RIDER_BOOKINGS_TTL], client=pipe)
+    pipe.execute()
+
+def booking_riders_changed_on_commit(*changes):
+    """Run ``booking_riders_changed`` once the current transaction has committed"""
+    transaction.on_commit(lambda: booking_riders_changed(changes))
@@ -0,0 +1,61 @@
+"""
+Rider presence kept as a Redis sorted set scored by last-seen time
+"""
+import time
+
+from django.conf import settings
+
+from ecoride.redis_client import get_redis
+
+from .locations import RIDER_LOCATIONS_KEY
+
+# Sorted set of online rider IDs scored by the unix time they were last heard from
+RIDERS_LAST_SEEN_KEY = 'riders_last_seen'
+
+SWEEP_BATCH_SIZE = 1000
+
+# Remove up to ARGV[2] riders last seen before ARGV[1] from presence and the
+# location index in one atomic step, so a concurrent heartbeat is never lost.
+SWEEP_STALE_RIDERS = """
+local stale = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #stale > 0 then
+    redis.call('ZREM', KEYS[1], unpack(stale))
+    redis.call('ZREM', KEYS[2], unpack(stale))
+end
+return stale
+"""
+
+def touch_rider(pipe, rider_id, now=None):
+    """Queue a heartbeat for a rider on a (sync or async) pipeline"""
+    pipe.zadd(RIDERS_LAST_SEEN_KEY, {str(rider_id): now or time.time()})
+
+def remove_rider(pipe, rider_id):
+    """Queue taking a rider offline on a (sync or async) pipeline"""
+    pipe.zrem(RIDERS_LAST_SEEN_KEY, str(rider_id))
+    pipe.zrem(RIDER_LOCATIONS_KEY, str(rider_id))
+
+def active_riders(within_seconds=None):
+    """IDs of riders heard from in the last ``within_seconds`` (default RIDER_PRESENCE_TTL)"""
+    if within_seconds is None:
+        within_seconds = settings.RIDER_PRESENCE_TTL
+    return [rider_id.decode('utf-8') for rider_id in
+            get_redis().zrangebyscore(RIDERS_LAST_SEEN_KEY, time.time() - within_seconds, '+inf')]
+
+def sweep_stale_riders(max_age=None):
+    """
+    Take riders silent for more than ``max_age`` seconds offline.
+
+    Each batch costs O(log n + m) for m expired riders, however many are online.
+    """
+    if max_age is None:
+        max_age = settings.RIDER_PRESENCE_TTL
+    redis_client = get_redis()
+    sweep = redis_client.register_script(SWEEP_STALE_RIDERS)
+    cutoff = time.time() - max_age
+
+    swept = []
+    while True:
+        stale = sweep(keys=[RIDERS_LAST_SEEN_KEY, RIDER_LOCATIONS_KEY], args=[cutoff, SWEEP_BATCH_SIZE])
+        swept.extend(rider_id.decode('utf-8') for rider_id in stale)
+        if len(stale) < SWEEP_BATCH_SIZE:
+            return swept
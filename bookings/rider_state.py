@@ -0,0 +1,115 @@
+"""
+Rider availability (free, offered, on trip or offline) cached in Redis sets
+"""
+# pylint: disable=no-member
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+
+from ecoride.redis_client import get_redis
+
+from .models import Booking
+from .presence import RIDERS_LAST_SEEN_KEY
+
+FREE = 'free'
+OFFERED = 'offered'
+ON_TRIP = 'on_trip'
+OFFLINE = 'offline'
+
+# Sets of rider IDs with a pending offer and with an accepted or in-progress booking;
+# free and offline riders are whoever else is, or is not, in the presence set
+RIDERS_OFFERED_KEY = 'riders_offered'
+RIDERS_ON_TRIP_KEY = 'riders_on_trip'
+STATE_KEYS = {OFFERED: RIDERS_OFFERED_KEY, ON_TRIP: RIDERS_ON_TRIP_KEY}
+
+# Scratch key for the free-riders set difference, only ever used inside MULTI
+FREE_RIDERS_SCRATCH_KEY = 'riders_free_scratch'
+
+BOOKING_STATES = {'pending': OFFERED, 'accepted': ON_TRIP, 'in_progress': ON_TRIP}
+
+def busy_states(rider_bookings):
+    """Map rider IDs to OFFERED or ON_TRIP from ``(rider_id, status)`` pairs of live bookings"""
+    states = {}
+    for rider_id, status in rider_bookings:
+        if states.get(str(rider_id)) != ON_TRIP:
+            states[str(rider_id)] = BOOKING_STATES[status]
+    return states
+
+def live_bookings():
+    """Bookings that keep their rider busy"""
+    return Booking.objects.filter(status__in=BOOKING_STATES.keys(), rider__isnull=False)
+
+def refresh_rider_states(rider_ids):
+    """Recompute the cached state of some riders from their live bookings, atomically"""
+    rider_ids = [str(rider_id) for rider_id in rider_ids if rider_id]
+    if not rider_ids:
+        return
+    states = busy_states(live_bookings().filter(rider_id__in=rider_ids).values_list('rider_id', 'status'))
+
+    pipe = get_redis().pipeline()
+    for key in STATE_KEYS.values():
+        pipe.srem(key, *rider_ids)
+    for rider_id, state in states.items():
+        pipe.sadd(STATE_KEYS[state], rider_id)
+    pipe.execute()
+
+def refresh_rider_states_on_commit(*rider_ids):
+    """Refresh riders' cached state once the current transaction has committed"""
+    transaction.on_commit(lambda: refresh_rider_states(rider_ids))
+
+def reconcile_rider_states():
+    """
+    Rebuild the cached states from Postgres with one query, swapping every set
+    in a single MULTI. Returns how many riders had drifted.
+    """
+    states = busy_states(live_bookings().values_list('rider_id', 'status'))
+    by_state = defaultdict(set)
+    for rider_id, state in states.items():
+        by_state[state].add(rider_id)
+
+    redis_client = get_redis()
+    drifted = 0
+    pipe = redis_client.pipeline()
+    for state, key in STATE_KEYS.items():
+        cached = {rider_id.decode('utf-8') for rider_id in redis_client.smembers(key)}
+        drifted += len(cached ^ by_state[state])
+        pipe.delete(key)
+        if by_state[state]:
+            pipe.sadd(key, *by_state[state])
+    pipe.execute()
+    return drifted
+
+def busy_riders(states=(OFFERED, ON_TRIP)):
+    """IDs of riders in any of the given busy states, as one SUNION"""
+    return {rider_id.decode('utf-8') for rider_id in
+            get_redis().sunion([STATE_KEYS[state] for state in states])}
+
+def free_riders(within_seconds=None):
+    """IDs of online riders with no offer and no trip, as one server-side set difference"""
+    if within_seconds is None:
+        within_seconds = settings.RIDER_PRESENCE_TTL
+    pipe = get_redis().pipeline()
+    pipe.zdiffstore(FREE_RIDERS_SCRATCH_KEY, [RIDERS_LAST_SEEN_KEY, RIDERS_OFFERED_KEY, RIDERS_ON_TRIP_KEY])
+    pipe.zrangebyscore(FREE_RIDERS_SCRATCH_KEY, time.time() - within_seconds, '+inf')
+    pipe.delete(FREE_RIDERS_SCRATCH_KEY)
+    _, riders, _ = pipe.execute()
+    return [rider_id.decode('utf-8') for rider_id in riders]
+
+def rider_state(rider_id, within_seconds=None):
+    """FREE, OFFERED, ON_TRIP or OFFLINE for one rider"""
+    if within_seconds is None:
+        within_seconds = settings.RIDER_PRESENCE_TTL
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.sismember(RIDERS_ON_TRIP_KEY, str(rider_id))
+    pipe.sismember(RIDERS_OFFERED_KEY, str(rider_id))
+    pipe.zscore(RIDERS_LAST_SEEN_KEY, str(rider_id))
+    on_trip, offered, last_seen = pipe.execute()
+    if on_trip:
+        return ON_TRIP
+    if offered:
+        return OFFERED
+    if last_seen is not None and last_seen >= time.time() - within_seconds:
+        return FREE
+    return OFFLINE
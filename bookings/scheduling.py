@@ -0,0 +1,76 @@
+"""
+Bookings for a later time, held in a Redis due-queue until they are released into dispatch
+"""
+# pylint: disable=no-member
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from ecoride.redis_client import get_redis
+
+from .models import Booking
+
+# Sorted set of scheduled booking IDs scored by the unix time they are due
+SCHEDULED_BOOKINGS_KEY = 'scheduled_bookings'
+
+# Take up to ARGV[2] bookings due by ARGV[1] off the queue in one atomic step,
+# so concurrent schedulers never release the same booking twice.
+POP_DUE_BOOKINGS = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+end
+return due
+"""
+
+def is_scheduled(scheduled_for):
+    """Whether a booking for ``scheduled_for`` should wait instead of being dispatched now"""
+    lead = timedelta(seconds=settings.SCHEDULED_DISPATCH_LEAD)
+    return scheduled_for is not None and scheduled_for > timezone.now() + lead
+
+def queue_bookings(bookings):
+    """Add ``(booking_id, scheduled_for)`` pairs to the due-queue"""
+    mapping = {str(booking_id): scheduled_for.timestamp() for booking_id, scheduled_for in bookings}
+    if mapping:
+        get_redis().zadd(SCHEDULED_BOOKINGS_KEY, mapping)
+
+def unqueue_booking(booking_id):
+    """Take a booking off the due-queue, e.g. when it is cancelled"""
+    get_redis().zrem(SCHEDULED_BOOKINGS_KEY, str(booking_id))
+
+def pop_due_bookings(limit=None, now=None):
+    """
+    Take the bookings due within SCHEDULED_DISPATCH_LEAD seconds off the
+    queue, at most ``limit`` (default SCHEDULED_RELEASE_BATCH) at a time.
+    Costs O(log n + m) for m due bookings however many are queued.
+    """
+    limit = limit or settings.SCHEDULED_RELEASE_BATCH
+    horizon = (now or timezone.now()).timestamp() + settings.SCHEDULED_DISPATCH_LEAD
+    pop_due = get_redis().register_script(POP_DUE_BOOKINGS)
+    return [int(booking_id) for booking_id in
+            pop_due(keys=[SCHEDULED_BOOKINGS_KEY], args=[horizon, limit])]
+
+def release_bookings(booking_ids):
+    """
+    Turn scheduled bookings into pending ones with one conditional UPDATE,
+    leaving any cancelled meanwhile alone. Returns the released bookings.
+    """
+    bookings = list(
+        Booking.objects.filter(id__in=booking_ids, status='scheduled').select_related('user', 'rider')
+    )
+    Booking.objects.filter(id__in=[booking.id for booking in bookings], status='scheduled')\
+        .update(status='pending')
+    # Anything cancelled between the two queries is no longer scheduled
+    released = set(Booking.objects.filter(id__in=[booking.id for booking in bookings], status='pending')
+                   .values_list('id', flat=True))
+    return [booking for booking in bookings if booking.id in released]
+
+def requeue_scheduled_bookings():
+    """
+    Rebuild the due-queue from Postgres (via the status/scheduled_for index)
+    in case Redis lost it. Returns how many bookings are queued.
+    """
+    bookings = list(Booking.objects.filter(status='scheduled').values_list('id', 'scheduled_for'))
+    queue_bookings(bookings)
+    return len(bookings)
@@ -3,14 +3,20 @@ All serializers for bookings app
 """
 # pylint: disable=no-member
 
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 from rest_framework import serializers
 
 from users.models import User
-from ecoride.utils import send_notification, create_payment_reference
+from ecoride.utils import create_payment_reference
 
-from admins.models import NotificationMessage
-
-from .models import Booking, Wallet, WithdrawalRequest
+from .models import Booking, Wallet, WithdrawalRequest, TripPoint
+from .eta import rider_etas
+from .dispatch import dispatch
+from .rider_state import refresh_rider_states_on_commit
+from .scheduling import is_scheduled, queue_bookings
+from .tasks import notify_new_booking, offer_new_booking
 
 class RiderSerializer(serializers.ModelSerializer):
     """
@@ -20,6 +26,48 @@ class RiderSerializer(serializers.ModelSerializer):
         model = User
         fields = ['id', 'fullname', 'email', 'phone', 'address', 'state_of_residence']
 
+class NearbyRiderSerializer(RiderSerializer):
+    """
+    Available rider with their distance (in km) and ETA (in seconds) from the requested point
+    """
+    distance = serializers.FloatField(read_only=True)
+    eta = serializers.IntegerField(read_only=True, allow_null=True)
+
+    class Meta(RiderSerializer.Meta):
+        fields = RiderSerializer.Meta.fields + ['distance', 'eta']
+
+class NearbyRidersQuerySerializer(serializers.Serializer):
+    """
+    Query parameters for the nearest riders lookup
+    """
+    # pylint: disable=abstract-method
+    lat = serializers.FloatField(min_value=-85.05112878, max_value=85.05112878)
+    lng = serializers.FloatField(min_value=-180, max_value=180)
+    radius = serializers.FloatField(min_value=0.1, max_value=50, default=5)
+    limit = serializers.IntegerField(min_value=1, max_value=50, default=10)
+
+class ActiveRidersQuerySerializer(serializers.Serializer):
+    """
+    Query parameters for restricting riders to those recently heard from
+    """
+    # pylint: disable=abstract-method
+    active_within = serializers.IntegerField(min_value=1, max_value=3600, required=False)
+
+class TripPointSerializer(serializers.ModelSerializer):
+    """
+    Serializer for a point on a booking's GPS trail
+    """
+    class Meta:
+        model = TripPoint
+        fields = ['latitude', 'longitude', 'recorded_at']
+
+class TrailQuerySerializer(serializers.Serializer):
+    """
+    Query parameters for the booking trail
+    """
+    # pylint: disable=abstract-method
+    max_points = serializers.IntegerField(min_value=2, max_value=5000, default=500)
+
 class BookingSerializer(serializers.ModelSerializer):
     """
     Serializer for ride and delivery bookings
@@ -35,50 +83,80 @@ class BookingCreateSerializer(serializers.ModelSerializer):
     id = serializers.ReadOnlyField()
     status = serializers.ReadOnlyField()
     price = serializers.DecimalField(max_digits=10, decimal_places=2, coerce_to_string=False)
+    pickup_latitude = serializers.FloatField(min_value=-90, max_value=90, required=False)
+    pickup_longitude = serializers.FloatField(min_value=-180, max_value=180, required=False)
+    pickup_eta = serializers.IntegerField(read_only=True, allow_null=True)
 
     class Meta:
         model = Booking
         fields = ['id', 'booking_type', 'origin', 'destination', 'price',\
-                  'package_details', 'status', "payment_reference"]
+                  'package_details', 'status', "payment_reference",\
+                  'pickup_latitude', 'pickup_longitude', 'pickup_eta', 'scheduled_for']
+
+    def validate_scheduled_for(self, value):
+        if value is not None and value <= timezone.now():
+            raise serializers.ValidationError("A booking can only be scheduled for a future time.")
+        return value
+
+    def validate(self, attrs):
+        if ('pickup_latitude' in attrs) != ('pickup_longitude' in attrs):
+            raise serializers.ValidationError(
+                "pickup_latitude and pickup_longitude must be provided together.")
+        if not self.initial_data.get('rider') and 'pickup_latitude' not in attrs:
+            raise serializers.ValidationError(
+                {"rider": "Provide a rider email or a pickup point to dispatch a rider automatically."})
+        return attrs
 
     def create(self, validated_data):
+        pickup_latitude = validated_data.get('pickup_latitude')
+        pickup_longitude = validated_data.get('pickup_longitude')
+
         user = self.context['request'].user
         rider_email = self.initial_data.get('rider')
-        try:
-            rider = User.objects.get(email=rider_email, role='Rider')
-        except User.DoesNotExist as exc:
-            raise serializers.ValidationError({"rider": "No rider found with the provided email."}) from exc
+        pickup_eta = None
+        scheduled = is_scheduled(validated_data.get('scheduled_for'))
+        if rider_email:
+            try:
+                rider = User.objects.get(email=rider_email, role='Rider')
+            except User.DoesNotExist as exc:
+                raise serializers.ValidationError({"rider": "No rider found with the provided email."}) from exc
+
+            # ETA of the chosen rider to the pickup point, when the passenger shared it
+            if pickup_latitude is not None and not scheduled:
+                eta = rider_etas(pickup_latitude, pickup_longitude, [rider.id]).get(str(rider.id))
+                if eta:
+                    pickup_eta = eta[1]
+        elif scheduled or settings.DISPATCH_MODE in ('batch', 'offer'):
+            # Dispatched when it falls due, by the batch matcher or to the first nearby rider to accept
+            rider = None
+        else:
+            # Dispatch mode: the engine picks the best free rider near the pickup point
+            best = dispatch(pickup_latitude, pickup_longitude)
+            if best is None:
+                raise serializers.ValidationError({"rider": "No rider is available near the pickup point."})
+            rider_id, _, pickup_eta = best
+            rider = User.objects.get(id=rider_id)
 
         validated_data['rider'] = rider
         validated_data['user'] = user
-
-        # Create the booking
-        booking = super().create(validated_data)
-        payment_reference = create_payment_reference("ride", booking.id)
-        booking.payment_reference = payment_reference
-        booking.save()
-
-        notification_data = {
-            'type': 'new_booking_notification',
-            'booking_id': booking.id,
-            'booking_type': booking.booking_type,
-            'destination': booking.destination,
-            'origin': booking.origin,
-            'price': str(booking.price),
-            'payment_reference': booking.payment_reference,
-            'package_details': booking.package_details,
-            'passenger_name': booking.user.fullname,
-            'passenger_email': booking.user.email,
-            'passenger_phone': booking.user.phone,
-            'passenger_address': booking.user.address,
-        }
-
-        send_notification(rider.id, notification_data)
-
-        NotificationMessage(
-            title="New ride request",
-            body=f"{booking.user.fullname} booked a {booking.booking_type} with {booking.rider.fullname}"
-        ).save()
+        if scheduled:
+            validated_data['status'] = 'scheduled'
+
+        # Generate the payment reference up front so the booking is a single INSERT
+        validated_data['payment_reference'] = create_payment_reference("ride")
+
+        with transaction.atomic():
+            booking = super().create(validated_data)
+            booking.pickup_eta = None if pickup_eta is None else round(pickup_eta)
+            if scheduled:
+                # Held in the due-queue until SCHEDULED_DISPATCH_LEAD seconds before it is due
+                transaction.on_commit(lambda: queue_bookings([(booking.id, booking.scheduled_for)]))
+            elif rider is not None:
+                # Rider state, notification and admin record only once the booking is committed
+                refresh_rider_states_on_commit(rider.id)
+                transaction.on_commit(lambda: notify_new_booking.delay(booking.id, booking.pickup_eta))
+            elif settings.DISPATCH_MODE == 'offer':
+                transaction.on_commit(lambda: offer_new_booking.delay(booking.id))
         return booking
 
 class BookingStatusUpdateSerializer(serializers.ModelSerializer):
@@ -0,0 +1,64 @@
+"""
+Consistent-hash partitioning of active bookings across location broadcaster workers
+"""
+import bisect
+import hashlib
+import time
+
+from ecoride.redis_client import get_redis
+
+# Sorted set of live broadcaster worker IDs scored by their last heartbeat
+BROADCASTER_WORKERS_KEY = 'location_broadcaster_workers'
+
+# Virtual nodes per worker; more points on the ring even out shard sizes
+RING_REPLICAS = 100
+
+def ring_hash(key):
+    """Stable 64-bit position of ``key`` on the ring, identical in every process"""
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+class HashRing:
+    """
+    Consistent hash ring mapping keys to workers.
+
+    Adding or removing a worker only moves the keys that hashed to its
+    virtual nodes, so every other worker keeps its shard.
+    """
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        self.nodes = frozenset(nodes)
+        points = sorted(
+            (ring_hash(f'{node}#{replica}'), node)
+            for node in self.nodes
+            for replica in range(replicas)
+        )
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def node_for(self, key):
+        """Worker owning ``key``, or ``None`` if the ring is empty"""
+        if not self.hashes:
+            return None
+        index = bisect.bisect(self.hashes, ring_hash(str(key))) % len(self.hashes)
+        return self.owners[index]
+
+    def shard(self, node, keys):
+        """The subset of ``keys`` owned by ``node``"""
+        return [key for key in keys if self.node_for(key) == node]
+
+def heartbeat_worker(worker_id, now=None):
+    """Announce that a broadcaster worker is alive"""
+    get_redis().zadd(BROADCASTER_WORKERS_KEY, {worker_id: now or time.time()})
+
+def remove_worker(worker_id):
+    """Hand a worker's shard back to the others straight away"""
+    get_redis().zrem(BROADCASTER_WORKERS_KEY, worker_id)
+
+def live_workers(ttl, now=None):
+    """IDs of broadcaster workers that sent a heartbeat in the last ``ttl`` seconds"""
+    now = now or time.time()
+    redis_client = get_redis()
+    pipe = redis_client.pipeline()
+    pipe.zremrangebyscore(BROADCASTER_WORKERS_KEY, '-inf', now - ttl)
+    pipe.zrange(BROADCASTER_WORKERS_KEY, 0, -1)
+    _, workers = pipe.execute()
+    return [worker_id.decode('utf-8') for worker_id in workers]
@@ -1,45 +1,330 @@
+import asyncio
 import json
-import redis
+import uuid
 from celery import shared_task
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import models
+from django.db.models import Case, When, Value
 
-from .models import Booking
+from admins.models import NotificationMessage
 
-# Set up Redis connection
-r = redis.StrictRedis(host='redis', port=6379, db=0)
+from ecoride.redis_client import acquire_lock, extend_lock, get_redis, release_lock
+from ecoride.utils import send_notification
+
+from .models import Booking, TripPoint
+from .chat import RIDE_CHAT_FLUSH_LOCK_KEY, RIDE_CHAT_FLUSH_LOCK_TIMEOUT, flush_chat_buffer
+from .dispatch import new_booking_notification
+from .locations import rider_bookings_key, rider_location_key
+from .matching import free_rider_positions, match_bookings
+from .offer_timers import pop_due_offer_timeouts, schedule_offer_timeout, schedule_offer_timeouts
+from .offers import expire_offer, offer_booking
+from .participants import booking_riders_changed
+from .presence import sweep_stale_riders
+from .rider_state import refresh_rider_states, reconcile_rider_states
+from .scheduling import pop_due_bookings, release_bookings, requeue_scheduled_bookings
+from .trails import TRIP_TRAILS_KEY, TRIP_TRAILS_FLUSH_LOCK_KEY, TRIM_FLUSHED_TRAIL,\
+    trail_key, next_stream_id, parse_trail_entry, rider_trips_key
+
+BOOKING_MATCHING_LOCK_KEY = 'booking_matching_lock'
+# Seconds the matching lock is held for, renewed before the matches are saved
+BOOKING_MATCHING_LOCK_TIMEOUT = 30
+
+# Upper bound on concurrent group_send calls in flight during one tick, kept
+# below the channel layer's default Redis connection pool size (100)
+GROUP_SEND_BATCH_SIZE = 50
 
 @shared_task
 def send_rider_location():
-   # Get all active bookings from Redis
-    active_bookings = r.smembers('active_bookings')
+    broadcast_rider_locations(active_booking_ids())
+
+def active_booking_ids():
+    """IDs of the bookings passengers are currently tracking"""
+    # Get all active bookings from Redis
+    active_bookings = get_redis().smembers('active_bookings')
+
+    booking_ids = [booking_id.decode("utf-8") for booking_id in active_bookings]
+    return [booking_id for booking_id in booking_ids if booking_id.isdigit()]
+
+def broadcast_rider_locations(booking_ids):
+    """
+    Send the latest location of each booking's rider to its tracking group.
+
+    Costs one query for every booking's rider, one MGET for every rider's
+    location and one event-loop pass for all channel-layer sends, however
+    many bookings are active.
+    """
+    if not booking_ids:
+        return 0
+
+    bookings = list(Booking.objects.filter(id__in=booking_ids, rider__isnull=False).values_list('id', 'rider_id'))
+    rider_ids = list({rider_id for _, rider_id in bookings})
+
+    locations = dict(zip(rider_ids, get_redis().mget([rider_location_key(rider_id) for rider_id in rider_ids])))
+
+    messages = []
+    for booking_id, rider_id in bookings:
+        rider_location = locations[rider_id]
+        if not rider_location:
+            continue
+
+        rider_location_data = json.loads(rider_location)
+        messages.append((
+            f'booking_{booking_id}',
+            {
+                'type': 'rider_location',  # This should match the method name expected in the consumer
+                'latitude': rider_location_data['lat'],
+                'longitude': rider_location_data['long'],
+                'heading': rider_location_data.get('heading'),
+                'speed': rider_location_data.get('speed'),
+            }
+        ))
+
+    async_to_sync(group_send_many)(get_channel_layer(), messages)
+    return len(messages)
+
+async def group_send_many(channel_layer, messages):
+    """Send ``(group, event)`` pairs concurrently, in bounded batches"""
+    for start in range(0, len(messages), GROUP_SEND_BATCH_SIZE):
+        await asyncio.gather(*(
+            channel_layer.group_send(group, event)
+            for group, event in messages[start:start + GROUP_SEND_BATCH_SIZE]
+        ))
+
+@shared_task
+def flush_trip_trails():
+    """
+    Drain every trip's trail stream into TripPoint rows with one bulk insert,
+    then trim the flushed entries from Redis.
+    """
+    redis_client = get_redis()
+    lock = acquire_lock(TRIP_TRAILS_FLUSH_LOCK_KEY, 60)
+    if lock is None:
+        return 0  # Another flush is still running
+
+    try:
+        booking_ids = [booking_id.decode('utf-8') for booking_id in redis_client.smembers(TRIP_TRAILS_KEY)]
+        if not booking_ids:
+            return 0
+
+        pipe = redis_client.pipeline(transaction=False)
+        for booking_id in booking_ids:
+            pipe.xrange(trail_key(booking_id))
+        streams = dict(zip(booking_ids, pipe.execute()))
+
+        # Trails of bookings deleted in the meantime are discarded
+        existing_ids = set(Booking.objects.filter(id__in=booking_ids).values_list('id', flat=True))
+
+        points = [
+            TripPoint(booking_id=booking_id, latitude=latitude, longitude=longitude, recorded_at=recorded_at)
+            for booking_id, entries in streams.items() if int(booking_id) in existing_ids
+            for latitude, longitude, recorded_at in (parse_trail_entry(*entry) for entry in entries)
+        ]
+        TripPoint.objects.bulk_create(points, batch_size=1000)
+
+        trim = redis_client.register_script(TRIM_FLUSHED_TRAIL)
+        pipe = redis_client.pipeline(transaction=False)
+        for booking_id, entries in streams.items():
+            min_id = next_stream_id(entries[-1][0]) if entries else '0'
+            trim(keys=[trail_key(booking_id), TRIP_TRAILS_KEY], args=[min_id, booking_id], client=pipe)
+        pipe.execute()
+
+        return len(points)
+    finally:
+        release_lock(TRIP_TRAILS_FLUSH_LOCK_KEY, lock)
+
+@shared_task
+def flush_ride_chat():
+    """Write the buffered ride chat messages to Postgres in bulk"""
+    lock = acquire_lock(RIDE_CHAT_FLUSH_LOCK_KEY, RIDE_CHAT_FLUSH_LOCK_TIMEOUT)
+    if lock is None:
+        return 0  # Another flush is still running
 
-    # Get the channel layer for WebSocket communication
-    channel_layer = get_channel_layer()
+    try:
+        return flush_chat_buffer(lock=lock)
+    finally:
+        release_lock(RIDE_CHAT_FLUSH_LOCK_KEY, lock)
 
-    for booking_id in active_bookings:
-        booking_id = booking_id.decode("utf-8")  # Convert from bytes to string
+@shared_task
+def sweep_rider_presence():
+    """
+    Take riders whose heartbeat expired offline and forget tracked or served
+    bookings whose trip is over but whose socket never closed cleanly, both
+    overall and in the per-rider sets of the riders just swept.
+    """
+    swept = sweep_stale_riders()
+
+    redis_client = get_redis()
+    keys = ['active_bookings'] + [key for rider_id in swept
+                                  for key in (rider_bookings_key(rider_id), rider_trips_key(rider_id))]
+    pipe = redis_client.pipeline()
+    for key in keys:
+        pipe.smembers(key)
+    tracked = {key: {booking_id.decode('utf-8') for booking_id in members}
+               for key, members in zip(keys, pipe.execute())}
+
+    tracked_ids = set().union(*tracked.values())
+    live_ids = {
+        str(booking_id) for booking_id in
+        Booking.objects.filter(id__in=[booking_id for booking_id in tracked_ids if booking_id.isdigit()],
+                               status__in=['pending', 'accepted', 'in_progress'])
+        .values_list('id', flat=True)
+    }
+    pipe = redis_client.pipeline()
+    for key, booking_ids in tracked.items():
+        if booking_ids - live_ids:
+            pipe.srem(key, *(booking_ids - live_ids))
+    pipe.execute()
+
+    return len(swept)
+
+@shared_task
+def notify_new_booking(booking_id, pickup_eta=None):
+    """Offer a newly created booking to its rider and record it for the admins"""
+    booking = Booking.objects.select_related('user', 'rider').filter(id=booking_id).first()
+    if booking is None or booking.rider is None:
+        return
 
-        # Retrieve the booking from the database
-        try:
-            booking = Booking.objects.get(id=booking_id)
-        except Booking.DoesNotExist:
-            continue  # Skip if booking does not exist
+    send_notification(booking.rider_id, new_booking_notification(booking, pickup_eta))
+    if booking.status == 'pending':
+        schedule_offer_timeout(booking.id)
 
-        # Get the associated rider's ID
-        rider_id = booking.rider.id
+    NotificationMessage(
+        title="New ride request",
+        body=f"{booking.user.fullname} booked a {booking.booking_type} with {booking.rider.fullname}"
+    ).save()
 
-        # Get the associated rider's location from Redis (assuming it's stored in 'rider_<id>_location')
-        rider_location = r.get(f'rider_{rider_id}_location')
+@shared_task
+def offer_new_booking(booking_id):
+    """Offer a newly created booking to the nearest free riders"""
+    booking = Booking.objects.select_related('user').filter(id=booking_id, status='pending').first()
+    if booking is None:
+        return 0
+    return len(offer_booking(booking))
+
+@shared_task
+def match_pending_bookings():
+    """
+    Pair every unassigned pending booking with a free rider at minimum total
+    pickup ETA, then send all of this window's offers at once.
+    """
+    lock = acquire_lock(BOOKING_MATCHING_LOCK_KEY, BOOKING_MATCHING_LOCK_TIMEOUT)
+    if lock is None:
+        return 0  # The previous window is still being matched
 
-        if rider_location:
-            rider_location_data = json.loads(rider_location.decode('utf-8'))
+    try:
+        bookings = list(
+            Booking.objects.filter(status='pending', rider__isnull=True, pickup_latitude__isnull=False)
+            .order_by('created_at')
+            .values_list('id', 'pickup_latitude', 'pickup_longitude')[:settings.MATCHING_BATCH_SIZE]
+        )
+        if not bookings:
+            return 0
+
+        matches = match_bookings(bookings, *free_rider_positions())
+        if not matches:
+            return 0
+        # A pass that outlived its lock may race another one for the same riders
+        if not extend_lock(BOOKING_MATCHING_LOCK_KEY, lock, BOOKING_MATCHING_LOCK_TIMEOUT):
+            return 0
+
+        # One conditional UPDATE, so bookings cancelled meanwhile are left alone
+        etas = {booking_id: eta for booking_id, _, eta in matches}
+        Booking.objects.filter(id__in=etas.keys(), status='pending', rider__isnull=True).update(
+            rider_id=Case(
+                *(When(id=booking_id, then=Value(uuid.UUID(rider_id))) for booking_id, rider_id, _ in matches),
+                output_field=models.UUIDField(),
+            )
+        )
+        offered = list(
+            Booking.objects.filter(id__in=etas.keys(), status='pending').select_related('user', 'rider')
+        )
+        assigned = {booking_id: rider_id for booking_id, rider_id, _ in matches}
+        offered = [booking for booking in offered if str(booking.rider_id) == assigned[booking.id]]
+        refresh_rider_states([booking.rider_id for booking in offered])
+        booking_riders_changed([(booking.id, booking.rider_id, None) for booking in offered])
+        schedule_offer_timeouts([booking.id for booking in offered])
 
-            async_to_sync(channel_layer.group_send)(
-                f'booking_{booking_id}',
-                {
-                    'type': 'rider_location',  # This should match the method name expected in the consumer
-                    'latitude': rider_location_data['lat'],
-                    'longitude': rider_location_data['long'],
-                }
+        async_to_sync(group_send_many)(get_channel_layer(), [
+            (f'user_{booking.rider_id}_notifications',
+             {'type': 'send_notification', 'message': new_booking_notification(booking, etas[booking.id])})
+            for booking in offered
+        ])
+        NotificationMessage.objects.bulk_create([
+            NotificationMessage(
+                title="New ride request",
+                body=f"{booking.user.fullname} booked a {booking.booking_type} with {booking.rider.fullname}"
             )
+            for booking in offered
+        ])
+        return len(offered)
+    finally:
+        release_lock(BOOKING_MATCHING_LOCK_KEY, lock)
+
+@shared_task
+def expire_booking_offers():
+    """
+    Re-offer or cancel every pending booking whose offer timed out since the
+    last tick. Returns how many were handled.
+    """
+    outcomes = [expire_offer(booking_id) for booking_id in pop_due_offer_timeouts()]
+    return sum(1 for outcome in outcomes if outcome)
+
+def dispatch_released_bookings(bookings):
+    """
+    Send scheduled bookings that just became pending into dispatch: riders
+    named in advance are notified, the rest are offered or matched in one batch.
+    """
+    if not bookings:
+        return
+    schedule_offer_timeouts([booking.id for booking in bookings])
+
+    assigned = [booking for booking in bookings if booking.rider_id]
+    refresh_rider_states([booking.rider_id for booking in assigned])
+    async_to_sync(group_send_many)(get_channel_layer(), [
+        (f'user_{booking.rider_id}_notifications',
+         {'type': 'send_notification', 'message': new_booking_notification(booking)})
+        for booking in assigned
+    ])
+    NotificationMessage.objects.bulk_create([
+        NotificationMessage(
+            title="Scheduled ride request",
+            body=f"{booking.user.fullname}'s scheduled {booking.booking_type} with {booking.rider.fullname} is due"
+        )
+        for booking in assigned
+    ])
+
+    unassigned = [booking for booking in bookings if booking.rider_id is None]
+    if not unassigned:
+        return
+    if settings.DISPATCH_MODE == 'offer':
+        for booking in unassigned:
+            offer_booking(booking)
+    else:
+        match_pending_bookings.delay()
+
+@shared_task
+def release_scheduled_bookings():
+    """
+    Release every booking due within SCHEDULED_DISPATCH_LEAD seconds into
+    dispatch, SCHEDULED_RELEASE_BATCH at a time. Returns how many were released.
+    """
+    released = 0
+    while True:
+        due = pop_due_bookings()
+        bookings = release_bookings(due)
+        dispatch_released_bookings(bookings)
+        released += len(bookings)
+        if len(due) < settings.SCHEDULED_RELEASE_BATCH:
+            return released
+
+@shared_task
+def rebuild_scheduled_booking_queue():
+    """Re-add every scheduled booking to the due-queue, in case Redis lost it"""
+    return requeue_scheduled_bookings()
+
+@shared_task
+def reconcile_rider_state_cache():
+    """Correct any drift between the cached rider states and the bookings in Postgres"""
+    return reconcile_rider_states()
@@ -3,12 +3,69 @@ Testing for Bookings endpoints
 """
 # pylint: disable=no-member
 
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import numpy as np
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+from django.db import DatabaseError, connection
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APITestCase
 from rest_framework_simplejwt.tokens import RefreshToken
+from admins.models import NotificationMessage
+from ecoride.asgi import JWTAuthMiddleware, Principal
+from ecoride.redis_client import acquire_lock, get_redis, get_async_redis, release_lock
+from supports.chat import ticket_chat_key
+from supports.models import SupportTicket
+from supports.urls import websocket_urlpatterns as supports_websocket_urlpatterns
 from users.models import User
-from .models import Booking
+from .consumers import RiderLocationConsumer
+from .dispatch import rank_riders
+from .eta import SpeedModel, great_circle_distances
+from .frames import LOCATION_SUBPROTOCOL, decode_location, encode_location
+from .models import Booking, Wallet, TripPoint, RideChatMessage
+from . import presence
+from .matching import match_bookings, min_cost_assignment
+from .chat import RIDE_CHAT_BUFFER_KEY, RIDE_CHAT_DEAD_LETTERS_KEY, RIDE_CHAT_FLUSH_FAILURES_KEY,\
+    RIDE_CHAT_FLUSH_LOCK_KEY, buffer_chat_message, flush_chat_buffer, recent_chat_key
+from .participants import booking_participants_key
+from .offer_timers import OFFER_TIMER_DEADLINES_KEY, cancel_offer_timeout, offer_deadline,\
+    pop_due_offer_timeouts, schedule_offer_timeout, schedule_offer_timeouts
+from .scheduling import SCHEDULED_BOOKINGS_KEY, queue_bookings, requeue_scheduled_bookings,\
+    unqueue_booking
+from .offers import claim_offer, expire_offer, offer_claim_key, offer_riders_key, offer_rounds_key
+from .locations import RIDER_LOCATIONS_KEY, LocationThrottle, haversine, rider_location_key,\
+    rider_bookings_key
+from .tasks import BOOKING_MATCHING_LOCK_KEY, broadcast_rider_locations, flush_trip_trails, sweep_rider_presence,\
+    match_pending_bookings, reconcile_rider_state_cache, notify_new_booking, offer_new_booking,\
+    release_scheduled_bookings, flush_ride_chat
+from .rider_state import FREE, OFFERED, ON_TRIP, OFFLINE, RIDERS_ON_TRIP_KEY, busy_riders,\
+    free_riders, refresh_rider_states, rider_state
+from .sharding import BROADCASTER_WORKERS_KEY, HashRing, heartbeat_worker, live_workers
+from .trails import TRIP_TRAILS_FLUSH_LOCK_KEY, TRIP_TRAILS_KEY, append_trail_points, end_trip,\
+    rider_trips_key, start_trip, trail_key
+from .urls import websocket_urlpatterns
+from .views import BookingStatusUpdateView
 
 class BookingTests(APITestCase):
     def setUp(self):
@@ -86,6 +143,206 @@ class BookingTests(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_list_nearest_riders(self):
+        """
+        Test that a nearby search returns eligible riders sorted by distance.
+        """
+        far_rider = User.objects.create_user(
+            fullname='Far Rider',
+            email='far.rider@example.com',
+            phone='09087654783',
+            password='riderpassword',
+            role='Rider',
+            is_active=True
+        )
+        broke_rider = User.objects.create_user(
+            fullname='Broke Rider',
+            email='broke.rider@example.com',
+            phone='09087654784',
+            password='riderpassword',
+            role='Rider',
+            is_active=True
+        )
+        Wallet.objects.create(rider=self.rider, balance=0)
+        Wallet.objects.create(rider=far_rider, balance=0)
+        Wallet.objects.create(rider=broke_rider, balance=-6000)
+
+        redis_client = get_redis()
+        redis_client.geoadd(RIDER_LOCATIONS_KEY, [3.3792, 6.5244, str(far_rider.id)])
+        redis_client.geoadd(RIDER_LOCATIONS_KEY, [3.3600, 6.5000, str(self.rider.id)])
+        redis_client.geoadd(RIDER_LOCATIONS_KEY, [3.3601, 6.5001, str(broke_rider.id)])
+        self.addCleanup(redis_client.zrem, RIDER_LOCATIONS_KEY, str(far_rider.id),
+                        str(self.rider.id), str(broke_rider.id))
+
+        self.authenticate_user()
+        response = self.client.get(self.get_avalailable_riders_url,
+                                   {'lat': 6.5, 'lng': 3.36, 'radius': 10, 'limit': 5})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([rider['id'] for rider in response.data],
+                         [str(self.rider.id), str(far_rider.id)])
+        self.assertLess(response.data[0]['distance'], response.data[1]['distance'])
+        self.assertLess(response.data[0]['eta'], response.data[1]['eta'])
+
+    def test_list_nearest_riders_with_invalid_params(self):
+        """
+        Test that a nearby search without a longitude is rejected.
+        """
+        self.authenticate_user()
+        response = self.client.get(self.get_avalailable_riders_url, {'lat': 6.5})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('lng', response.data)
+
+    def test_list_recently_active_riders(self):
+        """
+        Test that active_within keeps only riders heard from recently.
+        """
+        idle_rider = User.objects.create_user(
+            fullname='Idle Rider',
+            email='idle.rider@example.com',
+            phone='09087654785',
+            password='riderpassword',
+            role='Rider',
+            is_active=True
+        )
+        Wallet.objects.create(rider=self.rider, balance=0)
+        Wallet.objects.create(rider=idle_rider, balance=0)
+
+        pipe = get_redis().pipeline()
+        presence.touch_rider(pipe, self.rider.id)
+        presence.touch_rider(pipe, idle_rider.id, now=timezone.now().timestamp() - 120)
+        pipe.execute()
+        self.addCleanup(get_redis().zrem, presence.RIDERS_LAST_SEEN_KEY,
+                        str(self.rider.id), str(idle_rider.id))
+
+        self.authenticate_user()
+        response = self.client.get(self.get_avalailable_riders_url, {'active_within': 60})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([rider['id'] for rider in response.data], [str(self.rider.id)])
+
+    def test_sweep_rider_presence(self):
+        """
+        Test that the sweep takes silent riders offline and drops finished bookings from tracking,
+        including from the swept riders' own booking sets, which also expire.
+        """
+        live_booking = Booking.objects.create(
+            user=self.user, rider=self.rider, booking_type='delivery', origin='123 Street',
+            destination='456 Avenue', price=1500.00, status='in_progress')
+        redis_client = get_redis()
+        pipe = redis_client.pipeline()
+        presence.touch_rider(pipe, self.rider.id, now=timezone.now().timestamp() - 600)
+        pipe.geoadd(RIDER_LOCATIONS_KEY, [3.36, 6.5, str(self.rider.id)])
+        pipe.sadd('active_bookings', str(self.booking.id))
+        pipe.sadd(rider_bookings_key(self.rider.id), str(self.booking.id), str(live_booking.id))
+        pipe.execute()
+        start_trip(self.rider.id, self.booking.id)
+        self.addCleanup(redis_client.srem, 'active_bookings', str(self.booking.id))
+        self.addCleanup(redis_client.delete, rider_bookings_key(self.rider.id), rider_trips_key(self.rider.id))
+        self.addCleanup(presence.remove_rider, redis_client, self.rider.id)
+        self.assertGreater(redis_client.ttl(rider_trips_key(self.rider.id)), 0)
+
+        Booking.objects.filter(id=self.booking.id).update(status='completed')
+
+        self.assertEqual(sweep_rider_presence(), 1)
+        self.assertNotIn(str(self.rider.id), presence.active_riders(3600))
+        self.assertIsNone(redis_client.geopos(RIDER_LOCATIONS_KEY, str(self.rider.id))[0])
+        self.assertFalse(redis_client.sismember('active_bookings', str(self.booking.id)))
+        self.assertEqual(redis_client.smembers(rider_bookings_key(self.rider.id)), {str(live_booking.id).encode()})
+        self.assertFalse(redis_client.exists(rider_trips_key(self.rider.id)))
+
+    def test_broadcast_rider_locations_is_batched(self):
+        """
+        Test that one broadcaster tick costs a single query regardless of active bookings.
+        """
+        second_booking = Booking.objects.create(
+            user=self.user,
+            rider=self.rider,
+            booking_type='delivery',
+            origin='123 Street',
+            destination='456 Avenue',
+            price=1500.00
+        )
+        get_redis().set(rider_location_key(self.rider.id), '{"lat": 6.5, "long": 3.36}')
+        self.addCleanup(get_redis().delete, rider_location_key(self.rider.id))
+
+        with self.assertNumQueries(1):
+            sent = broadcast_rider_locations([str(self.booking.id), str(second_booking.id)])
+
+        self.assertEqual(sent, 2)
+
+    def test_flush_trip_trails(self):
+        """
+        Test that buffered trail points are bulk inserted and trimmed from Redis.
+        """
+        redis_client = get_redis()
+        self.addCleanup(redis_client.delete, trail_key(self.booking.id))
+        self.addCleanup(redis_client.srem, TRIP_TRAILS_KEY, str(self.booking.id))
+
+        pipe = redis_client.pipeline()
+        for step in range(3):
+            append_trail_points(pipe, [str(self.booking.id)], 6.5 + step / 1000, 3.36)
+        pipe.execute()
+
+        self.assertEqual(flush_trip_trails(), 3)
+        self.assertEqual(list(TripPoint.objects.filter(booking=self.booking)
+                              .order_by('recorded_at', 'id').values_list('latitude', flat=True)),
+                         [6.5, 6.501, 6.502])
+        self.assertFalse(redis_client.exists(trail_key(self.booking.id)))
+        self.assertFalse(redis_client.sismember(TRIP_TRAILS_KEY, str(self.booking.id)))
+
+    def test_flush_lock_is_only_released_by_its_holder(self):
+        """
+        Test that a flush skips while the lock is held and a stale holder cannot release someone else's lock.
+        """
+        self.addCleanup(get_redis().delete, TRIP_TRAILS_FLUSH_LOCK_KEY)
+        stale = acquire_lock(TRIP_TRAILS_FLUSH_LOCK_KEY, 60)
+        self.assertIsNone(acquire_lock(TRIP_TRAILS_FLUSH_LOCK_KEY, 60))
+        self.assertEqual(flush_trip_trails(), 0)
+
+        # The stale holder's lock expired and another worker took it
+        get_redis().delete(TRIP_TRAILS_FLUSH_LOCK_KEY)
+        current = acquire_lock(TRIP_TRAILS_FLUSH_LOCK_KEY, 60)
+        self.assertFalse(release_lock(TRIP_TRAILS_FLUSH_LOCK_KEY, stale))
+        self.assertEqual(get_redis().get(TRIP_TRAILS_FLUSH_LOCK_KEY), current.encode())
+        self.assertTrue(release_lock(TRIP_TRAILS_FLUSH_LOCK_KEY, current))
+
+    def test_booking_trail_is_downsampled(self):
+        """
+        Test that the trail endpoint returns at most max_points evenly spaced points.
+        """
+        start = timezone.now()
+        TripPoint.objects.bulk_create([
+            TripPoint(booking=self.booking, latitude=6.5 + step / 1000, longitude=3.36,
+                      recorded_at=start + timedelta(seconds=step))
+            for step in range(10)
+        ])
+
+        self.authenticate_user()
+        response = self.client.get(reverse('booking-trail', args=[self.booking.id]), {'max_points': 5})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([point['latitude'] for point in response.data],
+                         [6.5, 6.502, 6.504, 6.506, 6.508])
+
+    def test_booking_trail_of_another_user(self):
+        """
+        Test that a user cannot read the trail of a booking that is not theirs.
+        """
+        self.authenticate_rider()
+        other_booking = Booking.objects.create(
+            user=self.user,
+            rider=self.admin,
+            booking_type='ride',
+            origin='123 Street',
+            destination='456 Avenue',
+            price=1500.00
+        )
+        response = self.client.get(reverse('booking-trail', args=[other_booking.id]))
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_create_booking_as_user(self):
         """
         Test creating a booking (as a User).
@@ -103,6 +360,186 @@ class BookingTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(response.data['status'], 'pending')
 
+    def test_create_booking_is_a_single_insert(self):
+        """
+        Test that creating a booking writes one row and defers notifications until commit.
+        """
+        self.authenticate_user()
+        data = {
+            'rider': self.rider.email,
+            'booking_type': 'ride',
+            'origin': '123 Street',
+            'destination': '456 Avenue',
+            'price': 1500.00
+        }
+        with CaptureQueriesContext(connection) as queries, \
+                self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(self.new_booking_url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(response.data['payment_reference'].startswith('ride_'))
+        writes = [query['sql'] for query in queries.captured_queries
+                  if query['sql'].startswith(('INSERT', 'UPDATE'))]
+        self.assertEqual(len(writes), 1)
+        self.assertIn('bookings_booking', writes[0])
+        self.assertEqual(len(callbacks), 2)
+        self.assertFalse(NotificationMessage.objects.exists())
+
+        notify_new_booking(response.data['id'])
+        self.assertEqual(NotificationMessage.objects.get().title, 'New ride request')
+
+    def test_create_booking_with_pickup_eta(self):
+        """
+        Test that sharing the pickup point returns the rider's ETA to it.
+        """
+        redis_client = get_redis()
+        redis_client.geoadd(RIDER_LOCATIONS_KEY, [3.3792, 6.5244, str(self.rider.id)])
+        self.addCleanup(redis_client.zrem, RIDER_LOCATIONS_KEY, str(self.rider.id))
+
+        self.authenticate_user()
+        data = {
+            'rider': self.rider.email,
+            'booking_type': 'ride',
+            'origin': '123 Street',
+            'destination': '456 Avenue',
+            'price': 1500.00,
+            'pickup_latitude': 6.5244,
+            'pickup_longitude': 3.3882,
+        }
+        response = self.client.post(self.new_booking_url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        # ~995 m * 1.3 at 25 km/h plus 60 s
+        self.assertAlmostEqual(response.data['pickup_eta'], 246, delta=2)
+
+    def test_create_booking_with_dispatch(self):
+        """
+        Test that a booking without a rider goes to the nearest free, solvent rider.
+        """
+        busy_rider, broke_rider, free_rider = (
+            User.objects.create_user(
+                fullname=f'{name} Rider',
+                email=f'{name.lower()}.rider@example.com',
+                phone=f'0908765479{index}',
+                password='riderpassword',
+                role='Rider',
+                is_active=True
+            )
+            for index, name in enumerate(['Busy', 'Broke', 'Free'])
+        )
+        Wallet.objects.create(rider=busy_rider, balance=0)
+        Wallet.objects.create(rider=broke_rider, balance=-6000)
+        Wallet.objects.create(rider=free_rider, balance=0)
+        Booking.objects.create(user=self.user, rider=busy_rider, booking_type='ride', origin='A',
+                               destination='B', price=1000, status='in_progress')
+        refresh_rider_states([busy_rider.id])
+        self.addCleanup(refresh_rider_states, [busy_rider.id])
+
+        redis_client = get_redis()
+        redis_client.geoadd(RIDER_LOCATIONS_KEY, [3.3601, 6.5001, str(busy_rider.id)])
+        redis_client.geoadd(RIDER_LOCATIONS_KEY, [3.3602, 6.5002, str(broke_rider.id)])
+        redis_client.geoadd(RIDER_LOCATIONS_KEY, [3.3700, 6.5100, str(free_rider.id)])
+        self.addCleanup(redis_client.zrem, RIDER_LOCATIONS_KEY, str(busy_rider.id),
+                        str(broke_rider.id), str(free_rider.id))
+
+        with self.assertNumQueries(1):
+            ranked = rank_riders(6.5, 3.36)
+        self.assertEqual([rider_id for rider_id, _, _ in ranked], [str(free_rider.id)])
+
+        self.authenticate_user()
+        data = {
+            'booking_type': 'ride',
+            'origin': '123 Street',
+            'destination': '456 Avenue',
+            'price': 1500.00,
+            'pickup_latitude': 6.5,
+            'pickup_longitude': 3.36,
+        }
+        response = self.client.post(self.new_booking_url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Booking.objects.get(id=response.data['id']).rider, free_rider)
+        self.assertIsNotNone(response.data['pickup_eta'])
+
+    def test_create_booking_with_dispatch_and_no_rider_nearby(self):
+        """
+        Test that dispatch fails cleanly when no rider is near the pickup point.
+        """
+        self.authenticate_user()
+        data = {
+            'booking_type': 'ride',
+            'origin': '123 Street',
+            'destination': '456 Avenue',
+            'price': 1500.00,
+            'pickup_latitude': -33.9,
+            'pickup_longitude': 18.4,
+        }
+        response = self.client.post(self.new_booking_url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('rider', response.data)
+
+    @override_settings(DISPATCH_MODE='batch')
+    def test_batch_matching_minimises_total_pickup_eta(self):
+        """
+        Test that a window of bookings is matched optimally rather than greedily.
+        """
+        near_rider, far_rider = (
+            User.objects.create_user(
+                fullname=f'{name} Rider',
+                email=f'{name.lower()}.rider@example.com',
+                phone=f'0908765480{index}',
+                password='riderpassword',
+                role='Rider',
+                is_active=True
+            )
+            for index, name in enumerate(['West', 'East'])
+        )
+        Wallet.objects.create(rider=near_rider, balance=0)
+        Wallet.objects.create(rider=far_rider, balance=0)
+        redis_client = get_redis()
+        redis_client.geoadd(RIDER_LOCATIONS_KEY, [3.300, 6.5, str(near_rider.id)])
+        redis_client.geoadd(RIDER_LOCATIONS_KEY, [3.320, 6.5, str(far_rider.id)])
+        presence.touch_rider(redis_client, near_rider.id)
+        presence.touch_rider(redis_client, far_rider.id)
+        self.addCleanup(presence.remove_rider, redis_client, near_rider.id)
+        self.addCleanup(presence.remove_rider, redis_client, far_rider.id)
+
+        self.authenticate_user()
+        booking_ids = []
+        for longitude in (3.309, 3.295):
+            response = self.client.post(self.new_booking_url, {
+                'booking_type': 'ride',
+                'origin': '123 Street',
+                'destination': '456 Avenue',
+                'price': 1500.00,
+                'pickup_latitude': 6.5,
+                'pickup_longitude': longitude,
+            }, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            booking_ids.append(response.data['id'])
+        self.assertFalse(Booking.objects.filter(id__in=booking_ids, rider__isnull=False).exists())
+
+        self.addCleanup(refresh_rider_states, [near_rider.id, far_rider.id])
+
+        # A pass whose lock expired and went to another worker saves nothing and leaves that lock alone
+        def outlive_lock(*args):
+            redis_client.set(BOOKING_MATCHING_LOCK_KEY, 'another-pass')
+            return match_bookings(*args)
+        self.addCleanup(redis_client.delete, BOOKING_MATCHING_LOCK_KEY)
+        with patch('bookings.tasks.match_bookings', side_effect=outlive_lock):
+            self.assertEqual(match_pending_bookings(), 0)
+        self.assertFalse(Booking.objects.filter(id__in=booking_ids, rider__isnull=False).exists())
+        self.assertEqual(redis_client.get(BOOKING_MATCHING_LOCK_KEY), b'another-pass')
+        redis_client.delete(BOOKING_MATCHING_LOCK_KEY)
+
+        self.assertEqual(match_pending_bookings(), 2)
+
+        # Greedy in arrival order would give the first booking the west rider
+        self.assertEqual(Booking.objects.get(id=booking_ids[0]).rider, far_rider)
+        self.assertEqual(Booking.objects.get(id=booking_ids[1]).rider, near_rider)
+        self.assertEqual(match_pending_bookings(), 0)
+
     def test_create_booking_as_rider(self):
         """
         Test that a Rider cannot create a booking.
@@ -193,6 +630,250 @@ class BookingTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn('accepted', response.data['detail'])
 
+    def test_rider_state_follows_status_transitions(self):
+        """
+        Test that the rider state cache follows the booking through its lifecycle.
+        """
+        redis_client = get_redis()
+        presence.touch_rider(redis_client, self.rider.id)
+        self.addCleanup(presence.remove_rider, redis_client, self.rider.id)
+        refresh_rider_states([self.rider.id])
+        self.addCleanup(refresh_rider_states, [self.rider.id])
+        self.assertEqual(rider_state(self.rider.id), OFFERED)
+        self.addCleanup(redis_client.delete, rider_trips_key(self.rider.id))
+
+        self.authenticate_rider()
+        url = reverse('booking-status-update', args=[self.booking.id])
+        for new_status, expected_state in (('accepted', ON_TRIP), ('in_progress', ON_TRIP),
+                                           ('completed', FREE)):
+            on_trip = redis_client.sismember(rider_trips_key(self.rider.id), str(self.booking.id))
+            with self.captureOnCommitCallbacks() as callbacks:
+                response = self.client.patch(url, {'status': new_status}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            # The rider's trip set is left alone until the status change has committed
+            self.assertEqual(redis_client.sismember(rider_trips_key(self.rider.id), str(self.booking.id)), on_trip)
+            for callback in callbacks:
+                callback()
+            self.assertEqual(rider_state(self.rider.id), expected_state)
+            self.assertEqual(str(self.rider.id) in free_riders(), expected_state == FREE)
+            self.assertEqual(redis_client.sismember(rider_trips_key(self.rider.id), str(self.booking.id)),
+                             expected_state == ON_TRIP)
+
+        presence.remove_rider(redis_client, self.rider.id)
+        self.assertEqual(rider_state(self.rider.id), OFFLINE)
+
+    def test_reconcile_rider_states(self):
+        """
+        Test that reconciliation repairs a cache that drifted from Postgres.
+        """
+        redis_client = get_redis()
+        redis_client.sadd(RIDERS_ON_TRIP_KEY, str(self.rider.id))
+        self.addCleanup(refresh_rider_states, [self.rider.id])
+
+        self.assertGreaterEqual(reconcile_rider_state_cache(), 1)
+        self.assertEqual(busy_riders((ON_TRIP,)) & {str(self.rider.id)}, set())
+        self.assertIn(str(self.rider.id), busy_riders((OFFERED,)))
+
+    def test_offer_timers_are_cancelled_and_popped_when_due(self):
+        """
+        Test that the offer timing wheel pops exactly the timers that came due and were not cancelled.
+        """
+        now = time.time()
+        booking_ids = range(10 ** 9, 10 ** 9 + 10000)
+        schedule_offer_timeouts(booking_ids, timeout=30, now=now)
+        redis_client = get_redis()
+        self.addCleanup(redis_client.hdel, OFFER_TIMER_DEADLINES_KEY, *booking_ids)
+        for booking_id in booking_ids[::2]:
+            self.assertTrue(cancel_offer_timeout(booking_id))
+
+        self.assertNotIn(booking_ids[1], pop_due_offer_timeouts(now + 29))
+        due = set(pop_due_offer_timeouts(now + 31))
+        self.assertTrue(set(booking_ids[1::2]) <= due)
+        self.assertFalse(set(booking_ids[::2]) & due)
+        self.assertIsNone(offer_deadline(booking_ids[1]))
+        self.assertFalse(cancel_offer_timeout(booking_ids[1]))
+
+    def test_unanswered_booking_is_reoffered_then_cancelled(self):
+        """
+        Test that a booking its rider ignores moves to the next rider, and is cancelled after OFFER_ROUNDS rounds.
+        """
+        next_rider = User.objects.create_user(
+            fullname='Next Rider',
+            email='next.rider@example.com',
+            phone='09087654790',
+            password='riderpassword',
+            role='Rider',
+            is_active=True
+        )
+        Wallet.objects.create(rider=self.rider, balance=0)
+        Wallet.objects.create(rider=next_rider, balance=0)
+        Booking.objects.filter(id=self.booking.id).update(pickup_latitude=6.5, pickup_longitude=3.36)
+        redis_client = get_redis()
+        redis_client.geoadd(RIDER_LOCATIONS_KEY, [3.3601, 6.5001, str(self.rider.id)])
+        redis_client.geoadd(RIDER_LOCATIONS_KEY, [3.3602, 6.5002, str(next_rider.id)])
+        self.addCleanup(redis_client.zrem, RIDER_LOCATIONS_KEY, str(self.rider.id), str(next_rider.id))
+        self.addCleanup(redis_client.delete, offer_riders_key(self.booking.id), offer_rounds_key(self.booking.id))
+        self.addCleanup(cancel_offer_timeout, self.booking.id)
+        self.addCleanup(refresh_rider_states, [self.rider.id, next_rider.id])
+
+        with override_settings(OFFER_ROUNDS=3):
+            self.assertEqual(expire_offer(self.booking.id), 'reoffered')
+            self.booking.refresh_from_db()
+            self.assertEqual(self.booking.rider, next_rider)
+            self.assertEqual(rider_state(next_rider.id), OFFERED)
+            self.assertIsNotNone(offer_deadline(self.booking.id))
+
+            # Nobody else is free, so the new rider keeps it for another round
+            self.assertEqual(expire_offer(self.booking.id), 'reoffered')
+            self.booking.refresh_from_db()
+            self.assertEqual(self.booking.rider, next_rider)
+
+            self.assertEqual(expire_offer(self.booking.id), 'cancelled')
+            self.booking.refresh_from_db()
+            self.assertEqual(self.booking.status, 'cancelled')
+            self.assertIsNone(expire_offer(self.booking.id))
+
+    def test_accept_loses_to_a_concurrent_reassignment(self):
+        """
+        Test that a rider accepting an offer that just timed out and moved to another rider gets a conflict.
+        """
+        next_rider = User.objects.create_user(
+            fullname='Next Rider',
+            email='next.rider@example.com',
+            phone='09087654790',
+            password='riderpassword',
+            role='Rider',
+            is_active=True
+        )
+        Wallet.objects.create(rider=next_rider, balance=0)
+        Booking.objects.filter(id=self.booking.id).update(pickup_latitude=6.5, pickup_longitude=3.36)
+        redis_client = get_redis()
+        redis_client.geoadd(RIDER_LOCATIONS_KEY, [3.3602, 6.5002, str(next_rider.id)])
+        self.addCleanup(redis_client.zrem, RIDER_LOCATIONS_KEY, str(next_rider.id))
+        self.addCleanup(redis_client.delete, offer_riders_key(self.booking.id), offer_rounds_key(self.booking.id))
+        self.addCleanup(cancel_offer_timeout, self.booking.id)
+        self.addCleanup(refresh_rider_states, [self.rider.id, next_rider.id])
+        self.authenticate_rider()
+
+        # The offer times out after the view has loaded the booking but before it writes
+        get_object = BookingStatusUpdateView.get_object
+        def get_object_then_reassign(view):
+            booking = get_object(view)
+            self.assertEqual(expire_offer(booking.id), 'reoffered')
+            return booking
+
+        with patch.object(BookingStatusUpdateView, 'get_object', get_object_then_reassign),\
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(self.update_booking_status_url, {'status': 'accepted'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.booking.refresh_from_db()
+        self.assertEqual((self.booking.rider, self.booking.status), (next_rider, 'pending'))
+
+    def test_accepting_a_booking_cancels_its_offer_timeout(self):
+        """
+        Test that a booking's offer timeout is disarmed once its rider accepts it.
+        """
+        schedule_offer_timeout(self.booking.id)
+        self.addCleanup(cancel_offer_timeout, self.booking.id)
+        self.addCleanup(end_trip, self.rider.id, self.booking.id)
+        self.addCleanup(refresh_rider_states, [self.rider.id])
+        self.authenticate_rider()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(self.update_booking_status_url, {'status': 'accepted'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNone(offer_deadline(self.booking.id))
+
+    def test_create_scheduled_booking(self):
+        """
+        Test that a booking for a later time is held in the due-queue instead of being dispatched.
+        """
+        self.authenticate_user()
+        scheduled_for = timezone.now() + timedelta(days=1)
+        data = {
+            'booking_type': 'ride',
+            'origin': '123 Street',
+            'destination': 'Airport',
+            'price': 1500.00,
+            'pickup_latitude': -33.9,
+            'pickup_longitude': 18.4,
+            'scheduled_for': scheduled_for.isoformat(),
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.new_booking_url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.addCleanup(unqueue_booking, response.data['id'])
+        booking = Booking.objects.get(id=response.data['id'])
+        self.assertEqual((booking.status, booking.rider), ('scheduled', None))
+        self.assertAlmostEqual(get_redis().zscore(SCHEDULED_BOOKINGS_KEY, str(booking.id)),
+                               scheduled_for.timestamp(), places=3)
+
+        data['scheduled_for'] = (timezone.now() - timedelta(minutes=1)).isoformat()
+        response = self.client.post(self.new_booking_url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('scheduled_for', response.data)
+
+    @override_settings(DISPATCH_MODE='offer', SCHEDULED_RELEASE_BATCH=10, SCHEDULED_DISPATCH_LEAD=600)
+    def test_due_scheduled_bookings_are_released_in_batches(self):
+        """
+        Test that the scheduler releases only due bookings, in batches, and skips cancelled ones.
+        """
+        now = timezone.now()
+        due = Booking.objects.bulk_create([
+            Booking(user=self.user, rider=self.rider if index % 5 == 0 else None, booking_type='ride',
+                    origin='A', destination='Airport', price=1000, status='scheduled',
+                    pickup_latitude=-33.9, pickup_longitude=18.4,
+                    scheduled_for=now + timedelta(minutes=5), payment_reference=f'scheduled-{index}')
+            for index in range(25)
+        ])
+        later = Booking.objects.create(user=self.user, booking_type='ride', origin='A', destination='Airport',
+                                       price=1000, status='scheduled', scheduled_for=now + timedelta(hours=2))
+        queue_bookings([(booking.id, booking.scheduled_for) for booking in due + [later]])
+        Booking.objects.filter(id=due[1].id).update(status='cancelled')
+
+        booking_ids = [booking.id for booking in due + [later]]
+        for booking_id in booking_ids:
+            self.addCleanup(unqueue_booking, booking_id)
+            self.addCleanup(cancel_offer_timeout, booking_id)
+        self.addCleanup(refresh_rider_states, [self.rider.id])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(release_scheduled_bookings(), 24)
+        self.assertLess(len(queries), len(due))
+
+        statuses = dict(Booking.objects.filter(id__in=booking_ids).values_list('id', 'status'))
+        self.assertEqual(statuses[due[0].id], 'pending')
+        self.assertEqual(statuses[due[1].id], 'cancelled')
+        self.assertEqual(statuses[later.id], 'scheduled')
+        self.assertEqual(rider_state(self.rider.id), OFFERED)
+        self.assertIsNotNone(offer_deadline(due[2].id))
+        self.assertIsNotNone(get_redis().zscore(SCHEDULED_BOOKINGS_KEY, str(later.id)))
+
+        get_redis().zrem(SCHEDULED_BOOKINGS_KEY, str(later.id))
+        self.assertGreaterEqual(requeue_scheduled_bookings(), 1)
+        self.assertIsNotNone(get_redis().zscore(SCHEDULED_BOOKINGS_KEY, str(later.id)))
+
+    @override_settings(DISPATCH_MODE='batch', SCHEDULED_DISPATCH_LEAD=600)
+    def test_released_bookings_are_matched_by_a_separate_task(self):
+        """
+        Test that in batch mode the scheduler queues a matching pass rather than running it itself.
+        """
+        booking = Booking.objects.create(user=self.user, booking_type='ride', origin='A', destination='Airport',
+                                         price=1000, status='scheduled', pickup_latitude=-33.9,
+                                         pickup_longitude=18.4, scheduled_for=timezone.now() + timedelta(minutes=5))
+        queue_bookings([(booking.id, booking.scheduled_for)])
+        self.addCleanup(unqueue_booking, booking.id)
+        self.addCleanup(cancel_offer_timeout, booking.id)
+
+        with patch('bookings.tasks.match_pending_bookings.delay') as delay:
+            self.assertEqual(release_scheduled_bookings(), 1)
+        delay.assert_called_once_with()
+        booking.refresh_from_db()
+        self.assertEqual((booking.status, booking.rider), ('pending', None))
+
     def test_update_booking_status_with_invalid_booking(self):
         """
         Test updating a booking's status with an invalid booking ID.
@@ -215,3 +896,802 @@ class BookingTests(APITestCase):
         response = self.client.get(self.get_all_bookings_url)
 
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(MONNIFY_IP='127.0.0.1', MONNIFY_SECRET='monnify-secret')
+    def test_payments_for_bookings_without_a_rider_are_rejected(self):
+        """
+        Test that cash payments and card payment webhooks for a booking nobody has been assigned are refused.
+        """
+        Booking.objects.filter(id=self.booking.id).update(rider=None, payment_reference='ref-unassigned')
+
+        self.authenticate_user()
+        response = self.client.patch(reverse('pay-with-cash', args=[self.booking.id]), {'amount': 1500},
+                                     format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        payload = json.dumps({
+            'eventType': 'SUCCESSFUL_TRANSACTION',
+            'eventData': {'paymentStatus': 'PAID', 'amountPaid': '1500.00', 'paymentReference': 'ref-unassigned'},
+        }).encode('utf-8')
+        response = self.client.post(
+            reverse('payment-webhook'), payload, content_type='application/json', REMOTE_ADDR='127.0.0.1',
+            HTTP_MONNIFY_SIGNATURE=hmac.new(b'monnify-secret', payload, hashlib.sha512).hexdigest())
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('no rider', response.data['msg'])
+        self.assertFalse(Booking.objects.get(id=self.booking.id).paid)
+
+class LocationThrottleTests(SimpleTestCase):
+    def test_frames_are_coalesced_and_latest_is_kept(self):
+        """
+        Test that frames inside the interval are deferred, tiny moves dropped and the latest kept.
+        """
+        throttle = LocationThrottle(min_distance=10, min_interval=1.0)
+
+        self.assertEqual(throttle.offer(6.5, 3.36, now=0.0), LocationThrottle.ACCEPT)
+        self.assertEqual(throttle.offer(6.50005, 3.36, now=2.0), LocationThrottle.DROP)  # ~5.5m
+        self.assertEqual(throttle.offer(6.501, 3.36, now=2.1), LocationThrottle.ACCEPT)
+        self.assertEqual(throttle.offer(6.502, 3.36, now=2.2), LocationThrottle.DEFER)
+        self.assertEqual(throttle.offer(6.503, 3.36, now=2.3), LocationThrottle.DEFER)
+
+        self.assertAlmostEqual(throttle.retry_after(now=2.3), 0.8)
+        self.assertEqual(throttle.take_pending(now=3.1), (6.503, 3.36))
+        self.assertEqual(throttle.drain_counters(), (3, 2))
+        self.assertEqual(throttle.drain_counters(), (0, 0))
+
+        # Moving away and straight back leaves nothing stale to flush
+        self.assertEqual(throttle.offer(6.504, 3.36, now=3.2), LocationThrottle.DEFER)
+        self.assertEqual(throttle.offer(6.50305, 3.36, now=3.3), LocationThrottle.DROP)
+        self.assertIsNone(throttle.take_pending(now=4.2))
+        self.assertEqual(throttle.drain_counters(), (0, 2))
+
+class EtaTests(SimpleTestCase):
+    def test_distances_match_scalar_haversine(self):
+        """
+        Test that the vectorized distances agree with the per-rider haversine.
+        """
+        latitudes = np.array([6.5244, 6.6, 9.0765, -33.9])
+        longitudes = np.array([3.3792, 3.35, 7.3986, 18.4])
+
+        distances = great_circle_distances(6.5, 3.36, latitudes, longitudes)
+
+        for distance, latitude, longitude in zip(distances, latitudes, longitudes):
+            self.assertAlmostEqual(distance, haversine(6.5, 3.36, latitude, longitude), places=3)
+
+    def test_speed_model(self):
+        """
+        Test that ETAs stretch distance by the detour factor and add the overhead.
+        """
+        speed_model = SpeedModel(speed_kmh=36, detour_factor=1.5, overhead=30)
+
+        self.assertEqual(speed_model.eta(np.array([0.0, 1000.0])).tolist(), [30.0, 180.0])
+
+class MinCostAssignmentTests(SimpleTestCase):
+    def test_assignment_is_optimal(self):
+        """
+        Test that the assignment matches a brute-force optimum on small matrices.
+        """
+        rng = np.random.default_rng(7)
+        for _ in range(50):
+            rows, columns = rng.integers(1, 6, size=2).tolist()
+            cost = rng.uniform(0, 10, size=(rows, columns))
+
+            pairs = min_cost_assignment(cost, max_cost=10)
+
+            best = min(
+                sum(cost[row, column] for row, column in zip(permutation, range(columns)))
+                if rows > columns else
+                sum(cost[row, column] for row, column in zip(range(rows), permutation))
+                for permutation in itertools.permutations(range(max(rows, columns)), min(rows, columns))
+            )
+            self.assertEqual(len(pairs), min(rows, columns))
+            self.assertAlmostEqual(sum(cost[row, column] for row, column in pairs), best)
+
+    def test_disallowed_pairs_are_left_out(self):
+        """
+        Test that pairs above max_cost are never matched, even if a row stays unmatched.
+        """
+        cost = np.array([[1.0, 50.0], [2.0, 60.0], [70.0, 80.0]])
+
+        self.assertEqual(min_cost_assignment(cost, max_cost=55), [(0, 1), (1, 0)])
+
+class HashRingTests(SimpleTestCase):
+    def test_bookings_are_spread_across_workers(self):
+        """
+        Test that every booking has exactly one owner and shards are roughly even.
+        """
+        booking_ids = [str(booking_id) for booking_id in range(10000)]
+        ring = HashRing(['w1', 'w2', 'w3', 'w4'])
+
+        shards = [ring.shard(worker_id, booking_ids) for worker_id in ('w1', 'w2', 'w3', 'w4')]
+
+        self.assertEqual(sorted(sum(shards, [])), sorted(booking_ids))
+        for shard in shards:
+            self.assertGreater(len(shard), 1750)
+            self.assertLess(len(shard), 3250)
+
+    def test_only_departed_workers_bookings_move(self):
+        """
+        Test that a worker leaving only reassigns the bookings it owned.
+        """
+        booking_ids = [str(booking_id) for booking_id in range(10000)]
+        before = HashRing(['w1', 'w2', 'w3', 'w4'])
+        after = HashRing(['w1', 'w2', 'w4'])
+
+        moved = [booking_id for booking_id in booking_ids
+                 if before.node_for(booking_id) != after.node_for(booking_id)]
+
+        self.assertEqual(moved, before.shard('w3', booking_ids))
+
+    def test_silent_workers_leave_the_ring(self):
+        """
+        Test that workers without a recent heartbeat are no longer live.
+        """
+        self.addCleanup(get_redis().delete, BROADCASTER_WORKERS_KEY)
+        heartbeat_worker('w1', now=1000)
+        heartbeat_worker('w2', now=1008)
+
+        self.assertEqual(live_workers(ttl=10, now=1015), ['w2'])
+
+class RiderLocationFanoutTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            fullname='Jane Doe',
+            email='jane@example.com',
+            phone='09087654321',
+            password='password123',
+            role='User',
+            is_active=True
+        )
+        self.rider = User.objects.create_user(
+            fullname='John Rider',
+            email='rider@example.com',
+            phone='09087654782',
+            password='riderpassword',
+            role='Rider',
+            is_active=True
+        )
+        self.booking = Booking.objects.create(
+            user=self.user,
+            rider=self.rider,
+            booking_type='ride',
+            origin='123 Street',
+            destination='456 Avenue',
+            price=1500.00
+        )
+        self.user_token = RefreshToken.for_user(self.user).access_token
+        self.rider_token = RefreshToken.for_user(self.rider).access_token
+        self.application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+        redis_client = get_redis()
+        self.addCleanup(redis_client.delete, rider_location_key(self.rider.id), rider_bookings_key(self.rider.id),
+                        booking_participants_key(self.booking.id))
+        self.addCleanup(redis_client.zrem, RIDER_LOCATIONS_KEY, str(self.rider.id))
+
+    @async_to_sync
+    async def test_location_is_pushed_to_tracking_passenger(self):
+        """
+        Test that a rider's location reaches the passenger tracking their booking without polling.
+        """
+        tracker = WebsocketCommunicator(
+            self.application, f'/ws/tracking/{self.booking.id}/?token={self.user_token}')
+        connected, _ = await tracker.connect()
+        self.assertTrue(connected)
+        self.assertIn(str(self.booking.id).encode(), get_redis().smembers(rider_bookings_key(self.rider.id)))
+
+        rider = WebsocketCommunicator(
+            self.application, f'/ws/rider/location/?token={self.rider_token}')
+        connected, _ = await rider.connect()
+        self.assertTrue(connected)
+
+        await rider.send_json_to({'latitude': 6.5, 'longitude': 3.36})
+        self.assertEqual(await tracker.receive_json_from(), {'latitude': 6.5, 'longitude': 3.36})
+
+        await rider.disconnect()
+        await tracker.disconnect()
+        self.assertNotIn(str(self.booking.id).encode(), get_redis().smembers(rider_bookings_key(self.rider.id)))
+
+    @async_to_sync
+    async def test_tracking_an_unassigned_booking_follows_its_rider(self):
+        """
+        Test that a passenger tracking a booking before it has a rider gets the rider's locations once assigned.
+        """
+        booking = await database_sync_to_async(Booking.objects.create)(
+            user=self.user, booking_type='ride', origin='123 Street', destination='456 Avenue', price=1500.00)
+        redis_client = get_redis()
+        self.addCleanup(redis_client.delete, offer_riders_key(booking.id), offer_claim_key(booking.id),
+                        rider_trips_key(self.rider.id), booking_participants_key(booking.id))
+        self.addCleanup(refresh_rider_states, [self.rider.id])
+        self.addCleanup(cancel_offer_timeout, booking.id)
+
+        tracker = WebsocketCommunicator(self.application, f'/ws/tracking/{booking.id}/?token={self.user_token}')
+        connected, _ = await tracker.connect()
+        self.assertTrue(connected)
+        self.assertFalse(redis_client.exists(rider_bookings_key(None)))
+
+        redis_client.sadd(offer_riders_key(booking.id), str(self.rider.id))
+        self.assertTrue(await database_sync_to_async(claim_offer)(booking.id, self.rider.id))
+        self.assertIn(str(booking.id).encode(), redis_client.smembers(rider_bookings_key(self.rider.id)))
+
+        rider = WebsocketCommunicator(self.application, f'/ws/rider/location/?token={self.rider_token}')
+        connected, _ = await rider.connect()
+        self.assertTrue(connected)
+        await rider.send_json_to({'latitude': 6.5, 'longitude': 3.36})
+        self.assertEqual(await tracker.receive_json_from(), {'latitude': 6.5, 'longitude': 3.36})
+
+        await rider.disconnect()
+        await tracker.disconnect()
+        self.assertNotIn(str(booking.id).encode(), redis_client.smembers(rider_bookings_key(self.rider.id)))
+
+    @async_to_sync
+    async def test_binary_location_frames(self):
+        """
+        Test that clients negotiating the binary subprotocol exchange packed location frames.
+        """
+        tracker = WebsocketCommunicator(
+            self.application, f'/ws/tracking/{self.booking.id}/?token={self.user_token}',
+            subprotocols=[LOCATION_SUBPROTOCOL])
+        connected, subprotocol = await tracker.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, LOCATION_SUBPROTOCOL)
+
+        rider = WebsocketCommunicator(
+            self.application, f'/ws/rider/location/?token={self.rider_token}',
+            subprotocols=[LOCATION_SUBPROTOCOL])
+        connected, subprotocol = await rider.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, LOCATION_SUBPROTOCOL)
+
+        # A malformed frame is ignored and the socket keeps working
+        await rider.send_to(bytes_data=b'\x00' * 7)
+        with self.assertRaises(ValueError):
+            decode_location(b'\x00' * 7)
+        await rider.send_to(bytes_data=encode_location(6.5, 3.25, 1700000000, heading=90.0, speed=8.5))
+        latitude, longitude, timestamp, heading, speed = decode_location(await tracker.receive_from())
+
+        self.assertAlmostEqual(latitude, 6.5, places=5)
+        self.assertAlmostEqual(longitude, 3.25, places=5)
+        self.assertGreater(timestamp, 1700000000)
+        self.assertEqual((heading, speed), (90.0, 8.5))
+        self.assertEqual(json.loads(get_redis().get(rider_location_key(self.rider.id))),
+                         {'lat': latitude, 'long': longitude, 'heading': 90.0, 'speed': 8.5})
+
+        await rider.disconnect()
+        await tracker.disconnect()
+
+    @override_settings(RIDER_LOCATION_MIN_DISTANCE=5, RIDER_LOCATION_MIN_INTERVAL=50)
+    @async_to_sync
+    async def test_throttled_location_writes_latest_frame(self):
+        """
+        Test that a burst of frames is coalesced and the latest position is still stored.
+        """
+        consumer = RiderLocationConsumer()
+        consumer.user = self.rider
+        consumer.channel_layer = get_channel_layer()
+        # The consumer never disconnects, so take the rider offline afterwards
+        self.addCleanup(presence.remove_rider, get_redis(), self.rider.id)
+
+        for step in range(5):
+            await consumer.receive(text_data=json.dumps({'latitude': 6.5 + step / 1000, 'longitude': 3.36}))
+        self.assertEqual(json.loads(get_redis().get(rider_location_key(self.rider.id))),
+                         {'lat': 6.5, 'long': 3.36})
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(json.loads(get_redis().get(rider_location_key(self.rider.id))),
+                         {'lat': 6.504, 'long': 3.36})
+        self.assertEqual(consumer.throttle.drain_counters(), (0, 0))
+
+class BookingOfferTests(TransactionTestCase):
+    CONCURRENT_ACCEPTS = 200
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            fullname='Jane Doe',
+            email='jane@example.com',
+            phone='09087654321',
+            password='password123',
+            role='User',
+            is_active=True
+        )
+        self.riders = User.objects.bulk_create([
+            User(fullname=f'Rider {index}', email=f'rider{index}@example.com',
+                 phone=f'0908{index:07}', role='Rider', is_active=True)
+            for index in range(self.CONCURRENT_ACCEPTS)
+        ])
+        Wallet.objects.bulk_create([Wallet(rider=rider, balance=0) for rider in self.riders])
+        self.booking = Booking.objects.create(
+            user=self.user,
+            booking_type='ride',
+            origin='123 Street',
+            destination='456 Avenue',
+            price=1500.00,
+            pickup_latitude=6.5,
+            pickup_longitude=3.36,
+        )
+        redis_client = get_redis()
+        self.addCleanup(redis_client.delete, offer_riders_key(self.booking.id), offer_claim_key(self.booking.id))
+        self.addCleanup(refresh_rider_states, [rider.id for rider in self.riders])
+        self.addCleanup(redis_client.delete, *(rider_trips_key(rider.id) for rider in self.riders))
+        self.addCleanup(cancel_offer_timeout, self.booking.id)
+
+    def test_exactly_one_concurrent_accept_wins(self):
+        """
+        Test that hundreds of simultaneous accepts of one offer produce exactly one winner.
+        """
+        get_redis().sadd(offer_riders_key(self.booking.id), *(str(rider.id) for rider in self.riders))
+        barrier = threading.Barrier(self.CONCURRENT_ACCEPTS)
+
+        def accept(rider):
+            barrier.wait()
+            try:
+                return claim_offer(self.booking.id, rider.id)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.CONCURRENT_ACCEPTS) as executor:
+            results = list(executor.map(accept, self.riders))
+
+        self.assertEqual(results.count(True), 1)
+        winner = self.riders[results.index(True)]
+        self.booking.refresh_from_db()
+        self.assertEqual((self.booking.rider_id, self.booking.status), (winner.id, 'accepted'))
+        self.assertFalse(claim_offer(self.booking.id, self.riders[0].id))
+
+    @async_to_sync
+    async def test_losers_are_told_the_booking_was_taken(self):
+        """
+        Test that nearby riders are offered the booking and the slower one learns it was taken.
+        """
+        first, second = self.riders[:2]
+        redis_client = get_async_redis()
+        await redis_client.geoadd(RIDER_LOCATIONS_KEY, [3.3601, 6.5001, str(first.id)])
+        await redis_client.geoadd(RIDER_LOCATIONS_KEY, [3.3602, 6.5002, str(second.id)])
+        self.addCleanup(get_redis().zrem, RIDER_LOCATIONS_KEY, str(first.id), str(second.id))
+
+        application = JWTAuthMiddleware(URLRouter(supports_websocket_urlpatterns))
+        sockets = []
+        for rider in (first, second):
+            token = await database_sync_to_async(lambda rider=rider: str(RefreshToken.for_user(rider).access_token))()
+            socket = WebsocketCommunicator(application, f'/ws/notifications/?token={token}')
+            connected, _ = await socket.connect()
+            self.assertTrue(connected)
+            sockets.append(socket)
+
+        with override_settings(OFFER_RIDERS=2):
+            self.assertEqual(await database_sync_to_async(offer_new_booking)(self.booking.id), 2)
+        for socket in sockets:
+            offer = await socket.receive_json_from()
+            self.assertEqual(offer['message']['type'], 'booking_offer')
+            self.assertEqual(offer['message']['booking_id'], self.booking.id)
+
+        await sockets[0].send_json_to({'type': 'accept_offer', 'booking_id': self.booking.id})
+        self.assertEqual(await sockets[0].receive_json_from(),
+                         {'type': 'offer_accepted', 'booking_id': self.booking.id})
+        taken = await sockets[1].receive_json_from()
+        self.assertEqual(taken['message']['type'], 'booking_offer_taken')
+
+        await sockets[1].send_json_to({'type': 'accept_offer', 'booking_id': self.booking.id})
+        self.assertEqual(await sockets[1].receive_json_from(),
+                         {'type': 'booking_offer_taken', 'booking_id': self.booking.id})
+
+        for socket in sockets:
+            await socket.disconnect()
+
+class WebsocketAuthTests(TransactionTestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(
+                fullname=f'Rider {index}',
+                email=f'rider{index}@example.com',
+                phone=f'0908765478{index}',
+                password='riderpassword',
+                role='Rider',
+                is_active=True
+            )
+            for index in range(3)
+        ]
+        self.tokens = [str(RefreshToken.for_user(user).access_token) for user in self.users]
+
+    def test_reconnect_storm_costs_one_query_per_user(self):
+        """
+        Test that hundreds of simultaneous connects with the same tokens look each user up once.
+        """
+        middleware = JWTAuthMiddleware(None)
+        tokens = [self.tokens[0], str(RefreshToken.for_user(self.users[0]).access_token), self.tokens[1]]
+
+        async def storm():
+            return await asyncio.gather(*(middleware.authenticate(tokens[index % 3]) for index in range(300)))
+
+        with CaptureQueriesContext(connection) as queries:
+            principals = async_to_sync(storm)()
+            again = async_to_sync(middleware.authenticate)(self.tokens[0])
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(principals[0], Principal(self.users[0].id, 'Rider', False, 'rider0@example.com'))
+        self.assertEqual(set(principals), {principals[0], principals[2]})
+        self.assertEqual(again, principals[0])
+
+    def test_invalid_tokens_and_cache_bounds(self):
+        """
+        Test that bad or expired tokens get no principal and the caches stay within their bound.
+        """
+        middleware = JWTAuthMiddleware(None, max_size=2)
+        expired = RefreshToken.for_user(self.users[0]).access_token
+        expired.set_exp(lifetime=-timedelta(seconds=1))
+
+        for token in [None, 'not-a-jwt', str(expired)]:
+            self.assertIsNone(async_to_sync(middleware.authenticate)(token))
+        for token in self.tokens:
+            self.assertIsNotNone(async_to_sync(middleware.authenticate)(token))
+        self.assertEqual(list(middleware.tokens.entries), self.tokens[1:])
+        self.assertEqual(len(middleware.principals.entries), 2)
+
+    @async_to_sync
+    async def test_consumers_get_the_principal_from_scope(self):
+        """
+        Test that consumers accept a connection authenticated by the middleware and refuse one without a token.
+        """
+        application = JWTAuthMiddleware(URLRouter(supports_websocket_urlpatterns))
+        socket = WebsocketCommunicator(application, f'/ws/notifications/?token={self.tokens[0]}')
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+        await socket.disconnect()
+
+        socket = WebsocketCommunicator(application, '/ws/notifications/')
+        connected, _ = await socket.connect()
+        self.assertFalse(connected)
+
+class ConsumerQueryBudgetTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            fullname='Jane Doe',
+            email='jane@example.com',
+            phone='09087654321',
+            password='password123',
+            role='User',
+            is_active=True
+        )
+        self.rider = User.objects.create_user(
+            fullname='John Rider',
+            email='rider@example.com',
+            phone='09087654782',
+            password='riderpassword',
+            role='Rider',
+            is_active=True
+        )
+        self.booking = Booking.objects.create(
+            user=self.user,
+            rider=self.rider,
+            booking_type='ride',
+            origin='123 Street',
+            destination='456 Avenue',
+            price=1500.00,
+            status='accepted'
+        )
+        self.ticket = SupportTicket.objects.create(user=self.user)
+        self.user_token = str(RefreshToken.for_user(self.user).access_token)
+        self.rider_token = str(RefreshToken.for_user(self.rider).access_token)
+
+        # Principals are already cached, so the budgets below are the consumers' own queries
+        self.application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns + supports_websocket_urlpatterns))
+        for token in (self.user_token, self.rider_token):
+            async_to_sync(self.application.authenticate)(token)
+        cached_keys = (booking_participants_key(self.booking.id), recent_chat_key(self.booking.id),
+                       ticket_chat_key(self.ticket.id))
+        get_redis().delete(*cached_keys)
+        self.addCleanup(get_redis().delete, *cached_keys)
+
+    def connect(self, path, token):
+        """Open and close one websocket connection, returning whether it was accepted"""
+        async def connect_and_leave():
+            socket = WebsocketCommunicator(self.application, f'{path}?token={token}')
+            connected, _ = await socket.connect()
+            if connected:
+                await socket.disconnect()
+            return connected
+        return async_to_sync(connect_and_leave)()
+
+    def test_rider_location_and_notification_connects_are_query_free(self):
+        """
+        Test that rider location and notification sockets connect without touching Postgres.
+        """
+        with self.assertNumQueries(0):
+            self.assertTrue(self.connect('/ws/rider/location/', self.rider_token))
+        with self.assertNumQueries(0):
+            self.assertTrue(self.connect('/ws/notifications/', self.user_token))
+
+    def test_tracking_connect_checks_the_booking_once_per_trip(self):
+        """
+        Test that tracking looks the booking up with one query, then from the trip cache.
+        """
+        with self.assertNumQueries(1):
+            self.assertTrue(self.connect(f'/ws/tracking/{self.booking.id}/', self.user_token))
+        with self.assertNumQueries(0):
+            self.assertTrue(self.connect(f'/ws/tracking/{self.booking.id}/', self.user_token))
+
+    def test_ride_chat_connect_checks_the_booking_once_per_trip(self):
+        """
+        Test that ride chat checks the booking with one cached query and turns outsiders away.
+        """
+        # One association check, then the chat history; both are cached for the next connect
+        with self.assertNumQueries(2):
+            self.assertTrue(self.connect(f'/ws/chat/{self.booking.id}/', self.rider_token))
+        with self.assertNumQueries(0):
+            self.assertTrue(self.connect(f'/ws/chat/{self.booking.id}/', self.user_token))
+
+        outsider = User.objects.create_user(fullname='Outsider', email='out@example.com',
+                                            phone='09087654000', password='password123', role='User')
+        token = str(RefreshToken.for_user(outsider).access_token)
+        self.assertFalse(self.connect(f'/ws/chat/{self.booking.id}/', token))
+
+    def test_support_chat_connect(self):
+        """
+        Test the query budget of joining an existing support ticket.
+        """
+        # The ticket, then its history, which is cached for the next connect
+        with self.assertNumQueries(2):
+            self.assertTrue(self.connect(f'/ws/support/{self.ticket.id}/', self.user_token))
+        with self.assertNumQueries(1):
+            self.assertTrue(self.connect(f'/ws/support/{self.ticket.id}/', self.user_token))
+
+    def test_ended_trip_forgets_its_participants(self):
+        """
+        Test that ending a trip drops its cached participants.
+        """
+        self.assertTrue(self.connect(f'/ws/tracking/{self.booking.id}/', self.user_token))
+        self.assertTrue(get_redis().exists(booking_participants_key(self.booking.id)))
+        end_trip(self.rider.id, self.booking.id)
+        self.assertFalse(get_redis().exists(booking_participants_key(self.booking.id)))
+
+class RideChatTests(TransactionTestCase):
+    MESSAGES = 120
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            fullname='Jane Doe',
+            email='jane@example.com',
+            phone='09087654321',
+            password='password123',
+            role='User',
+            is_active=True
+        )
+        self.rider = User.objects.create_user(
+            fullname='John Rider',
+            email='rider@example.com',
+            phone='09087654782',
+            password='riderpassword',
+            role='Rider',
+            is_active=True
+        )
+        self.booking = Booking.objects.create(
+            user=self.user,
+            rider=self.rider,
+            booking_type='delivery',
+            origin='123 Street',
+            destination='456 Avenue',
+            price=1500.00,
+            status='in_progress'
+        )
+        # Inserted in one statement, so many messages share a timestamp and only the id orders them
+        RideChatMessage.objects.bulk_create([
+            RideChatMessage(booking=self.booking, sender=self.rider if index % 2 else self.user,
+                            message=f'Message {index}')
+            for index in range(self.MESSAGES)
+        ])
+        self.token = str(RefreshToken.for_user(self.rider).access_token)
+        self.application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+        redis_client = get_redis()
+        redis_client.delete(RIDE_CHAT_BUFFER_KEY, recent_chat_key(self.booking.id))
+        self.addCleanup(redis_client.delete, booking_participants_key(self.booking.id), RIDE_CHAT_BUFFER_KEY,
+                        RIDE_CHAT_FLUSH_FAILURES_KEY, RIDE_CHAT_DEAD_LETTERS_KEY, recent_chat_key(self.booking.id))
+
+    @override_settings(RIDE_CHAT_HISTORY_PAGE=50)
+    @async_to_sync
+    async def test_history_is_one_frame_per_page(self):
+        """
+        Test that the latest messages arrive in one frame and older pages follow the cursor without gaps.
+        """
+        socket = WebsocketCommunicator(self.application, f'/ws/chat/{self.booking.id}/?token={self.token}')
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+
+        pages = [await socket.receive_json_from()]
+        while pages[-1]['next_cursor']:
+            await socket.send_json_to({'type': 'chat_history', 'before': pages[-1]['next_cursor']})
+            pages.append(await socket.receive_json_from())
+        self.assertTrue(await socket.receive_nothing())
+
+        self.assertEqual([len(page['messages']) for page in pages], [50, 50, 20])
+        self.assertEqual(pages[0]['messages'][-1]['message'], f'Message {self.MESSAGES - 1}')
+        history = [message['message'] for page in reversed(pages) for message in page['messages']]
+        self.assertEqual(history, [f'Message {index}' for index in range(self.MESSAGES)])
+
+        for cursor in ('not-a-cursor', 12345, ['a', 'list']):
+            await socket.send_json_to({'type': 'chat_history', 'before': cursor})
+            self.assertEqual(await socket.receive_json_from(),
+                             {'type': 'error', 'message': 'Invalid history cursor.'})
+        await socket.disconnect()
+
+    @override_settings(RIDE_CHAT_HISTORY_PAGE=50, RECENT_CHAT_MESSAGES=100, RECENT_CHAT_CLOSED_TTL=60)
+    def test_reconnects_are_served_from_the_recent_message_cache(self):
+        """
+        Test that the latest page comes from a capped Redis list that new messages join and that expires after the trip.
+        """
+        def latest_page():
+            async def connect():
+                socket = WebsocketCommunicator(self.application, f'/ws/chat/{self.booking.id}/?token={self.token}')
+                connected, _ = await socket.connect()
+                self.assertTrue(connected)
+                page = await socket.receive_json_from()
+                await socket.disconnect()
+                return page
+            return async_to_sync(connect)()
+
+        first = latest_page()
+        self.assertEqual(get_redis().llen(recent_chat_key(self.booking.id)), 100)
+        with self.assertNumQueries(0):
+            second = latest_page()
+        self.assertEqual(second, first)
+        self.assertNotIn('id', second['messages'][0])
+
+        async def send():
+            socket = WebsocketCommunicator(self.application, f'/ws/chat/{self.booking.id}/?token={self.token}')
+            await socket.connect()
+            await socket.receive_json_from()
+            await socket.send_json_to({'message': 'Almost there'})
+            await socket.receive_json_from()
+            await socket.disconnect()
+        async_to_sync(send)()
+
+        with self.assertNumQueries(0):
+            page = latest_page()
+        self.assertEqual(page['messages'][-1]['message'], 'Almost there')
+        self.assertEqual(page['messages'][0], first['messages'][1])
+        self.assertEqual(get_redis().llen(recent_chat_key(self.booking.id)), 100)
+
+        end_trip(self.rider.id, self.booking.id)
+        self.assertLessEqual(get_redis().ttl(recent_chat_key(self.booking.id)), 60)
+
+    @override_settings(RIDE_CHAT_FLUSH_SIZE=100)
+    def test_messages_are_broadcast_then_written_behind(self):
+        """
+        Test that chat lines reach the other participant without a query and are later inserted in bulk.
+        """
+        user_token = str(RefreshToken.for_user(self.user).access_token)
+        RideChatMessage.objects.all().delete()
+
+        async def chat():
+            rider = WebsocketCommunicator(self.application, f'/ws/chat/{self.booking.id}/?token={self.token}')
+            user = WebsocketCommunicator(self.application, f'/ws/chat/{self.booking.id}/?token={user_token}')
+            for socket in (rider, user):
+                connected, _ = await socket.connect()
+                self.assertTrue(connected)
+                await socket.receive_json_from()  # History
+
+            for index in range(10):
+                await rider.send_json_to({'message': f'On my way {index}'})
+            received = [await user.receive_json_from() for _ in range(10)]
+            for socket in (rider, user):
+                await socket.disconnect()
+            return received
+
+        with CaptureQueriesContext(connection) as queries:
+            received = async_to_sync(chat)()
+        # Two principals, one membership check and one history page, then cached; nothing per message
+        self.assertEqual(len(queries), 4)
+        self.assertFalse([query for query in queries if query['sql'].startswith('INSERT')])
+        self.assertEqual(received[0]['user'], str(self.rider.id))
+        self.assertEqual(RideChatMessage.objects.count(), 0)
+
+        # BEGIN, one booking check, one bulk INSERT, COMMIT
+        with self.assertNumQueries(4):
+            self.assertEqual(flush_ride_chat(), 10)
+        saved = list(RideChatMessage.objects.order_by('id'))
+        self.assertEqual([message.message for message in saved], [f'On my way {index}' for index in range(10)])
+        self.assertEqual(saved[0].timestamp.isoformat(), received[0]['timestamp'])
+        self.assertEqual(get_redis().llen(RIDE_CHAT_BUFFER_KEY), 0)
+
+    @override_settings(RIDE_CHAT_FLUSH_SIZE=10, RIDE_CHAT_FLUSH_MAX_FAILURES=2)
+    def test_failed_flushes_are_retried_and_nothing_is_lost(self):
+        """
+        Test that a failing batch stays buffered, is retried, and its bad row ends up in the dead letters.
+        """
+        RideChatMessage.objects.all().delete()
+        now = timezone.now()
+        senders = [self.user.id, uuid.uuid4(), self.rider.id]  # The second sender does not exist
+        for index, sender_id in enumerate(senders):
+            async_to_sync(buffer_chat_message)(self.booking.id, sender_id, f'Message {index}', now)
+
+        with self.assertRaises(DatabaseError):
+            flush_chat_buffer()
+        self.assertEqual(get_redis().llen(RIDE_CHAT_BUFFER_KEY), 3)
+        self.assertEqual(RideChatMessage.objects.count(), 0)
+
+        self.assertEqual(flush_chat_buffer(), 2)
+        self.assertEqual(sorted(RideChatMessage.objects.values_list('message', flat=True)),
+                         ['Message 0', 'Message 2'])
+        redis_client = get_redis()
+        self.assertEqual(redis_client.llen(RIDE_CHAT_BUFFER_KEY), 0)
+        self.assertEqual(json.loads(redis_client.lindex(RIDE_CHAT_DEAD_LETTERS_KEY, 0))['sender_id'], str(senders[1]))
+        self.assertEqual(redis_client.hget(RIDE_CHAT_FLUSH_FAILURES_KEY, 'consecutive'), b'0')
+
+    @override_settings(RIDE_CHAT_FLUSH_SIZE=2, RIDE_CHAT_FLUSH_MAX_BATCHES=2)
+    def test_flushes_are_capped_and_stop_once_their_lock_is_lost(self):
+        """
+        Test that one flush inserts a bounded number of batches and never outlives its lock.
+        """
+        RideChatMessage.objects.all().delete()
+        now = timezone.now()
+        for index in range(5):
+            async_to_sync(buffer_chat_message)(self.booking.id, self.user.id, f'Message {index}', now)
+        redis_client = get_redis()
+        self.addCleanup(redis_client.delete, RIDE_CHAT_FLUSH_LOCK_KEY)
+
+        self.assertEqual(flush_ride_chat(), 4)
+        self.assertEqual(redis_client.llen(RIDE_CHAT_BUFFER_KEY), 1)
+        self.assertFalse(redis_client.exists(RIDE_CHAT_FLUSH_LOCK_KEY))
+
+        # A flush whose lock expired and was taken by another leaves the buffer to it
+        lock = acquire_lock(RIDE_CHAT_FLUSH_LOCK_KEY, 60)
+        redis_client.set(RIDE_CHAT_FLUSH_LOCK_KEY, 'another-flush')
+        self.assertEqual(flush_chat_buffer(lock=lock), 0)
+        self.assertEqual(flush_ride_chat(), 0)
+        self.assertEqual(redis_client.get(RIDE_CHAT_FLUSH_LOCK_KEY), b'another-flush')
+
+        redis_client.delete(RIDE_CHAT_FLUSH_LOCK_KEY)
+        self.assertEqual(flush_ride_chat(), 1)
+        self.assertEqual(RideChatMessage.objects.count(), 5)
+
+@override_settings(RIDER_LOCATION_MIN_DISTANCE=0, RIDER_LOCATION_MIN_INTERVAL=0)
+class RiderLocationLoadTests(SimpleTestCase):
+    RIDERS = 1000
+    FRAMES_PER_RIDER = 5
+    MONITOR_INTERVAL = 0.005
+
+    @async_to_sync
+    async def test_event_loop_lag_while_riders_stream_locations(self):
+        """
+        Test that 1,000 riders streaming locations at once never stall the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        channel_layer = get_channel_layer()
+        consumers = []
+        for _ in range(self.RIDERS):
+            consumer = RiderLocationConsumer()
+            consumer.user = SimpleNamespace(id=uuid.uuid4())
+            consumer.channel_layer = channel_layer
+            consumers.append(consumer)
+
+        lags = []
+        streaming = True
+
+        async def monitor():
+            while streaming:
+                start = loop.time()
+                await asyncio.sleep(self.MONITOR_INTERVAL)
+                lags.append(loop.time() - start - self.MONITOR_INTERVAL)
+
+        async def stream(consumer, index):
+            for frame in range(self.FRAMES_PER_RIDER):
+                await consumer.receive(text_data=json.dumps({
+                    'latitude': 6.4 + index / 10000,
+                    'longitude': 3.3 + frame / 10000,
+                }))
+
+        monitor_task = asyncio.create_task(monitor())
+        try:
+            await asyncio.gather(*(stream(consumer, index) for index, consumer in enumerate(consumers)))
+        finally:
+            streaming = False
+            await monitor_task
+
+            rider_ids = [str(consumer.user.id) for consumer in consumers]
+            redis_client = get_async_redis()
+            await redis_client.delete(*(rider_location_key(rider_id) for rider_id in rider_ids))
+            # These consumers never disconnect, so take their riders offline here
+            pipe = redis_client.pipeline()
+            for rider_id in rider_ids:
+                presence.remove_rider(pipe, rider_id)
+            await pipe.execute()
+
+        # A blocking Redis client starves the monitor for the whole run (a single
+        # ~1s sample for 5,000 frames); with the asyncio client it keeps ticking.
+        self.assertGreater(len(lags), 10)
+        self.assertLess(statistics.quantiles(lags, n=20)[-1], 0.1)
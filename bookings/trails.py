@@ -0,0 +1,78 @@
+"""
+GPS trail of each trip, buffered in capped Redis Streams and flushed in bulk to Postgres
+"""
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+from ecoride.chat_cache import expire_recent_messages
+from ecoride.redis_client import get_redis
+
+from .chat import recent_chat_key
+from .participants import booking_participants_key
+
+# Set of booking IDs whose trail stream may hold points not yet flushed to Postgres
+TRIP_TRAILS_KEY = 'trip_trails'
+TRIP_TRAILS_FLUSH_LOCK_KEY = 'trip_trails_flush_lock'
+
+# Drop flushed entries and forget the stream once it is empty, atomically so a
+# concurrent XADD (which re-adds the booking ID) is never lost.
+TRIM_FLUSHED_TRAIL = """
+redis.call('XTRIM', KEYS[1], 'MINID', ARGV[1])
+if redis.call('XLEN', KEYS[1]) == 0 then
+    redis.call('DEL', KEYS[1])
+    redis.call('SREM', KEYS[2], ARGV[2])
+end
+"""
+
+def rider_trips_key(rider_id):
+    """Key of the set of accepted or in-progress booking IDs a rider is serving"""
+    return f'rider_{rider_id}_trips'
+
+def trail_key(booking_id):
+    """Key of the capped stream of a booking's recorded positions"""
+    return f'booking_{booking_id}_trail'
+
+def start_trip(rider_id, booking_id):
+    """Start recording the rider's positions on the booking's trail"""
+    pipe = get_redis().pipeline()
+    pipe.sadd(rider_trips_key(rider_id), str(booking_id))
+    pipe.expire(rider_trips_key(rider_id), settings.RIDER_BOOKINGS_TTL)
+    pipe.execute()
+
+def end_trip(rider_id, booking_id):
+    """
+    Stop recording the rider's positions on the booking's trail, forget its
+    participants and let its recent chat messages expire
+    """
+    pipe = get_redis().pipeline()
+    pipe.srem(rider_trips_key(rider_id), str(booking_id))
+    pipe.delete(booking_participants_key(booking_id))
+    expire_recent_messages(pipe, recent_chat_key(booking_id))
+    pipe.execute()
+
+def append_trail_points(pipe, booking_ids, latitude, longitude):
+    """Queue one position onto each booking's trail stream on a (sync or async) pipeline"""
+    for booking_id in booking_ids:
+        pipe.xadd(trail_key(booking_id), {'lat': latitude, 'lng': longitude},
+                  maxlen=settings.TRIP_TRAIL_MAXLEN, approximate=True)
+    pipe.sadd(TRIP_TRAILS_KEY, *booking_ids)
+
+def next_stream_id(entry_id):
+    """Smallest stream ID strictly greater than ``entry_id``"""
+    milliseconds, sequence = entry_id.decode('utf-8').split('-')
+    return f'{milliseconds}-{int(sequence) + 1}'
+
+def parse_trail_entry(entry_id, fields):
+    """Turn a stream entry into ``(latitude, longitude, recorded_at)``"""
+    milliseconds = int(entry_id.decode('utf-8').split('-')[0])
+    return (
+        float(fields[b'lat']),
+        float(fields[b'lng']),
+        datetime.fromtimestamp(milliseconds / 1000, tz=timezone.utc),
+    )
+
+def unflushed_trail(booking_id):
+    """Points of a booking's trail still waiting in Redis, oldest first"""
+    return [parse_trail_entry(entry_id, fields)
+            for entry_id, fields in get_redis().xrange(trail_key(booking_id))]
@@ -6,7 +6,7 @@ from .views import AvailableRidersListView, BookingCreateView,\
     BookingListView, BookingStatusUpdateView, CashPaymentView,\
     MonnifyTransactionWebhookView, InitializeTransactionAndChargeCardView,\
     MonnifyDisbursementWebhookView, RequestWithdrawal, InitiateDisbursement,\
-    AuthorizeDisbursement, RequestNewOTP
+    AuthorizeDisbursement, RequestNewOTP, BookingTrailView
 
 from . import consumers
 
@@ -16,6 +16,7 @@ urlpatterns = [
     path('', BookingListView.as_view(), name='booking-list'),
     path('<int:pk>/status/', BookingStatusUpdateView.as_view(), \
          name='booking-status-update'),
+    path('<int:pk>/trail/', BookingTrailView.as_view(), name='booking-trail'),
     path('payment/cash/<int:pk>/', CashPaymentView.as_view(), name="pay-with-cash"),
     path('webhook/monnify/transaction/', MonnifyTransactionWebhookView.as_view(), name="payment-webhook"),
     path('webhook/monnify/disbursement/', MonnifyDisbursementWebhookView.as_view(), name="disbursement-webhook"),
@@ -2,6 +2,7 @@
 Bookings related views
 """
 # pylint: disable=no-member
+import math
 from decimal import Decimal
 
 from drf_yasg import openapi
@@ -9,6 +10,10 @@ from drf_yasg.utils import swagger_auto_schema
 
 from django.shortcuts import get_object_or_404
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Window
+from django.db.models.functions import Mod, RowNumber
+from django.utils import timezone
 
 from rest_framework import generics, status
 from rest_framework.views import APIView
@@ -21,21 +26,47 @@ from ecoride.utils import send_notification, create_payment_reference
 from users.models import User
 from users.permissions import IsUser
 
-from .models import Booking, Wallet, WithdrawalRequest
+from .models import Booking, Wallet, WithdrawalRequest, TripPoint
 from .serializers import BookingSerializer, BookingCreateSerializer, BookingStatusUpdateSerializer,\
-                        RiderSerializer, WalletBalanceSerializer, RequestWithdrawalSerializer
+                        RiderSerializer, WalletBalanceSerializer, RequestWithdrawalSerializer,\
+                        NearbyRiderSerializer, NearbyRidersQuerySerializer, TripPointSerializer,\
+                        TrailQuerySerializer, ActiveRidersQuerySerializer
+from .locations import nearest_riders
+from .eta import rider_etas
+from .presence import active_riders
+from .offer_timers import cancel_offer_timeout
+from .participants import booking_riders_changed_on_commit
+from .scheduling import unqueue_booking
+from .rider_state import ON_TRIP, busy_riders, refresh_rider_states_on_commit
+from .trails import start_trip, end_trip, unflushed_trail
 from.mixins import MonnifyMixin, MonnifyWebhookMixin
 
 class AvailableRidersListView(generics.ListAPIView):
     """
-    View for getting list of online riders
+    View for getting list of online riders.
+
+    When ``lat`` and ``lng`` are supplied, only the ``limit`` nearest eligible
+    riders within ``radius`` km are returned, sorted by distance, with their ETA.
+    ``active_within`` keeps only riders heard from in the last N seconds.
     """
     permission_classes = (IsAuthenticated, IsUser,)
     serializer_class = RiderSerializer
 
     @swagger_auto_schema(
-        operation_description="Get a list of online riders",
+        operation_description="Get a list of online riders, optionally the nearest ones to a point",
         security=[{'Bearer': []}],
+        manual_parameters=[
+            openapi.Parameter('lat', openapi.IN_QUERY, type=openapi.TYPE_NUMBER,
+                              description='Latitude of the pickup point'),
+            openapi.Parameter('lng', openapi.IN_QUERY, type=openapi.TYPE_NUMBER,
+                              description='Longitude of the pickup point'),
+            openapi.Parameter('radius', openapi.IN_QUERY, type=openapi.TYPE_NUMBER,
+                              description='Search radius in km (default 5, max 50)'),
+            openapi.Parameter('limit', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                              description='Maximum number of riders returned (default 10, max 50)'),
+            openapi.Parameter('active_within', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                              description='Only riders heard from in the last N seconds (max 3600)'),
+        ],
         responses={
             status.HTTP_200_OK: openapi.Response(
                 description="A list of available riders"
@@ -72,13 +103,57 @@ class AvailableRidersListView(generics.ListAPIView):
         }
     )
 
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    def is_nearby_search(self):
+        params = self.request.query_params
+        return 'lat' in params or 'lng' in params
+
+    def get_serializer_class(self):
+        if self.is_nearby_search():
+            return NearbyRiderSerializer
+        return RiderSerializer
+
     def get_queryset(self):
-        return User.objects.filter(
+        eligible_riders = User.objects.filter(
             is_active=True, 
             role='Rider', 
             rider_wallet__balance__gt=-5000
             )
 
+        # Riders already on a trip, from the rider state cache rather than a join
+        eligible_riders = eligible_riders.exclude(id__in=busy_riders((ON_TRIP,)))
+
+        presence = ActiveRidersQuerySerializer(data=self.request.query_params)
+        presence.is_valid(raise_exception=True)
+        if 'active_within' in presence.validated_data:
+            eligible_riders = eligible_riders.filter(
+                id__in=active_riders(presence.validated_data['active_within']))
+
+        if not self.is_nearby_search():
+            return eligible_riders
+
+        query = NearbyRidersQuerySerializer(data=self.request.query_params)
+        query.is_valid(raise_exception=True)
+        params = query.validated_data
+
+        # Bounded GEOSEARCH on the live location index, then a single
+        # primary-key lookup to drop riders that are not eligible
+        distances = dict(nearest_riders(params['lat'], params['lng'],
+                                        params['radius'], params['limit']))
+        riders = list(eligible_riders.filter(id__in=distances.keys()).distinct())
+
+        # Vectorized ETA from every candidate's live position to the point
+        etas = rider_etas(params['lat'], params['lng'], [rider.id for rider in riders])
+
+        for rider in riders:
+            rider.distance = round(distances[str(rider.id)], 3)
+            rider.eta = round(etas[str(rider.id)][1]) if str(rider.id) in etas else None
+        riders.sort(key=lambda rider: rider.distance)
+
+        return riders[:params['limit']]
+
 # Create a new booking (either ride or delivery)
 class BookingCreateView(generics.CreateAPIView):
     """
@@ -92,11 +167,12 @@ class BookingCreateView(generics.CreateAPIView):
                               "Only users with the 'User' role can hit this endpoint.",
         request_body=openapi.Schema(
             type=openapi.TYPE_OBJECT,
-            required=['rider', 'booking_type', 'origin', 'destination', 'price'],
+            required=['booking_type', 'origin', 'destination', 'price'],
             properties={
                 'rider': openapi.Schema(
                     type=openapi.TYPE_STRING,
-                    description='Email address of the rider',
+                    description='Email address of the rider. Leave out to have the nearest '
+                                'free rider to the pickup point dispatched automatically',
                     example='rider@mail.com'
                 ),
                 'booking_type': openapi.Schema(
@@ -125,6 +201,24 @@ class BookingCreateView(generics.CreateAPIView):
                     example='Fragile item',
                     nullable=True
                 ),
+                'pickup_latitude': openapi.Schema(
+                    type=openapi.TYPE_NUMBER,
+                    description='Latitude of the pickup point (required without rider, enables pickup_eta)',
+                    example=6.5244
+                ),
+                'pickup_longitude': openapi.Schema(
+                    type=openapi.TYPE_NUMBER,
+                    description='Longitude of the pickup point (required without rider, enables pickup_eta)',
+                    example=3.3792
+                ),
+                'scheduled_for': openapi.Schema(
+                    type=openapi.TYPE_STRING,
+                    format=openapi.FORMAT_DATETIME,
+                    description='Book for a later time; the booking stays scheduled and is '
+                                'dispatched shortly before then',
+                    example='2026-12-24T06:30:00Z',
+                    nullable=True
+                ),
             }
         ),
         security=[{'Bearer': []}],
@@ -139,7 +233,8 @@ class BookingCreateView(generics.CreateAPIView):
                         "destination": "456 Avenue, City",
                         "price": "1500.00",
                         "package_details": "Fragile item",
-                        "status": "pending"
+                        "status": "pending",
+                        "pickup_eta": 240
                     }
                 }
             ),
@@ -281,6 +376,7 @@ class BookingStatusUpdateView(generics.UpdateAPIView):
         if user.role == 'User':
             return Booking.objects.filter(user=user)
 
+    @transaction.atomic
     def update(self, request, *args, **kwargs):
         booking = self.get_object()
         user = request.user
@@ -294,18 +390,24 @@ class BookingStatusUpdateView(generics.UpdateAPIView):
                 # Handle payment confirmation for the rider
                 return Response({'detail': 'Booking completion confirmed successfully.'}, status=status.HTTP_200_OK)
 
-            if new_status == 'cancelled' and booking.status in ['accepted', 'in_progress', 'pending']:
+            if new_status == 'cancelled' and booking.status in ['scheduled', 'accepted', 'in_progress', 'pending']:
                 # Handle cancellation and notify rider
+                if booking.status == 'scheduled':
+                    transaction.on_commit(lambda: unqueue_booking(booking.id))
                 booking.status = 'cancelled'
                 booking.save()
+                refresh_rider_states_on_commit(booking.rider_id)
+                transaction.on_commit(lambda: cancel_offer_timeout(booking.id))
 
-                # Notify the rider about cancellation
-                notification_data = {
-                    'type': 'booking_cancelled',
-                    'booking_id': booking.id,
-                    'message': f"Booking {booking.id} has been cancelled by the user.",
-                }
-                send_notification(booking.rider.id, notification_data)
+                # Notify the rider about cancellation, unless no rider was matched yet
+                if booking.rider_id:
+                    transaction.on_commit(lambda: end_trip(booking.rider_id, booking.id))
+                    notification_data = {
+                        'type': 'booking_cancelled',
+                        'booking_id': booking.id,
+                        'message': f"Booking {booking.id} has been cancelled by the user.",
+                    }
+                    send_notification(booking.rider_id, notification_data)
                 
                 return Response({'detail': 'Booking cancelled successfully.'}, status=status.HTTP_200_OK)
 
@@ -313,6 +415,8 @@ class BookingStatusUpdateView(generics.UpdateAPIView):
                 # Mark the booking as completed
                 booking.status = 'completed'
                 booking.save()
+                refresh_rider_states_on_commit(booking.rider_id)
+                transaction.on_commit(lambda: end_trip(booking.rider_id, booking.id))
 
                 # Notify the rider that the booking is completed
                 notification_data = {
@@ -333,9 +437,16 @@ class BookingStatusUpdateView(generics.UpdateAPIView):
                 return Response({'detail': 'This booking has already been completed.'}, status=status.HTTP_400_BAD_REQUEST)
 
             if new_status == 'accepted' and booking.status == 'pending':
-                # Update status to accepted and notify user
+                # Conditional, so an offer that timed out and moved to another rider meanwhile stays theirs
+                accepted = Booking.objects.filter(id=booking.id, status='pending', rider=user)\
+                    .update(status='accepted', updated_at=timezone.now())
+                if not accepted:
+                    return Response({'detail': 'This booking is no longer offered to you.'}, status=status.HTTP_409_CONFLICT)
                 booking.status = 'accepted'
-                booking.save()
+                refresh_rider_states_on_commit(booking.rider_id)
+                booking_riders_changed_on_commit((booking.id, booking.rider_id, None))
+                transaction.on_commit(lambda: cancel_offer_timeout(booking.id))
+                transaction.on_commit(lambda: start_trip(booking.rider_id, booking.id))
 
                 # Notify the user that the booking was accepted
                 notification_data = {
@@ -351,6 +462,7 @@ class BookingStatusUpdateView(generics.UpdateAPIView):
                 # Update status to in_progress and notify user
                 booking.status = 'in_progress'
                 booking.save()
+                refresh_rider_states_on_commit(booking.rider_id)
 
                 # Notify the user that the booking is in progress
                 notification_data = {
@@ -366,6 +478,8 @@ class BookingStatusUpdateView(generics.UpdateAPIView):
                 # Mark the booking as completed
                 booking.status = 'completed'
                 booking.save()
+                refresh_rider_states_on_commit(booking.rider_id)
+                transaction.on_commit(lambda: end_trip(booking.rider_id, booking.id))
 
                 # Notify the user that the booking is completed
                 notification_data = {
@@ -379,8 +493,13 @@ class BookingStatusUpdateView(generics.UpdateAPIView):
 
             if new_status == 'cancelled':
                 # Update status to cancelled and notify user
+                if booking.status == 'scheduled':
+                    transaction.on_commit(lambda: unqueue_booking(booking.id))
                 booking.status = 'cancelled'
                 booking.save()
+                refresh_rider_states_on_commit(booking.rider_id)
+                transaction.on_commit(lambda: cancel_offer_timeout(booking.id))
+                transaction.on_commit(lambda: end_trip(booking.rider_id, booking.id))
 
                 # Notify the user that the booking was cancelled by the rider
                 notification_data = {
@@ -394,6 +513,83 @@ class BookingStatusUpdateView(generics.UpdateAPIView):
 
         return Response({'detail': 'Invalid status update.'}, status=status.HTTP_400_BAD_REQUEST)
 
+class BookingTrailView(generics.GenericAPIView):
+    """
+    View for getting the recorded GPS trail of a booking
+    """
+    serializer_class = TripPointSerializer
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_description="Get the recorded GPS trail of a booking, downsampled to at most "
+                              "max_points evenly spaced points (default 500).",
+        security=[{'Bearer': []}],
+        manual_parameters=[
+            openapi.Parameter('max_points', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                              description='Maximum number of points returned (default 500, max 5000)'),
+        ],
+        responses={
+            status.HTTP_200_OK: openapi.Response(
+                description="Trail points, oldest first",
+                examples={
+                    "application/json": [
+                        {
+                            "latitude": 6.5244,
+                            "longitude": 3.3792,
+                            "recorded_at": "2024-09-13T12:00:00Z"
+                        }
+                    ]
+                }
+            ),
+            status.HTTP_404_NOT_FOUND: openapi.Response(
+                description="Booking not found",
+                examples={
+                    "application/json": {
+                        "detail": "No Booking matches the given query."
+                    }
+                }
+            ),
+        }
+    )
+    def get(self, request, *args, **kwargs):
+        booking = self.get_object()
+        query = TrailQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        max_points = query.validated_data['max_points']
+
+        points = TripPoint.objects.filter(booking=booking)
+        stored_count = points.count()
+        pending = unflushed_trail(booking.id)
+
+        # Keep every stride-th point of the whole trail; the stored part is
+        # sampled in the database so only the kept rows are fetched
+        stride = max(1, math.ceil((stored_count + len(pending)) / max_points))
+        if stride > 1:
+            points = points.annotate(
+                row=Window(RowNumber(), order_by=[F('recorded_at'), F('id')])
+            ).annotate(bucket=Mod(F('row') - 1, stride)).filter(bucket=0)
+
+        trail = [
+            {'latitude': latitude, 'longitude': longitude, 'recorded_at': recorded_at}
+            for latitude, longitude, recorded_at in
+            points.order_by('recorded_at', 'id').values_list('latitude', 'longitude', 'recorded_at')
+        ]
+        trail += [
+            {'latitude': latitude, 'longitude': longitude, 'recorded_at': recorded_at}
+            for index, (latitude, longitude, recorded_at) in enumerate(pending, start=stored_count)
+            if index % stride == 0
+        ]
+
+        return Response(self.get_serializer(trail, many=True).data)
+
+    def get_queryset(self):
+        user = self.request.user
+        if user.role == 'Rider':
+            return Booking.objects.filter(rider=user)
+        if user.role == 'User':
+            return Booking.objects.filter(user=user)
+        return Booking.objects.all()
+
 class CashPaymentView(generics.UpdateAPIView):
     permission_classes = [IsAuthenticated]
     queryset = Wallet.objects.all()
@@ -459,8 +655,10 @@ class CashPaymentView(generics.UpdateAPIView):
                 booking = Booking.objects.get(user= user, id=look_up_value)
         except Booking.DoesNotExist as exc:
             raise NotFound("Bookings with the given id does not exist!") from exc
+        if booking.rider_id is None:
+            raise ValidationError("This booking has no rider to pay yet.")
 
-        obj = get_object_or_404(queryset, rider=booking.rider)
+        obj = get_object_or_404(queryset, rider_id=booking.rider_id)
         self.check_object_permissions(self.request, obj)
         return obj
     
@@ -492,7 +690,7 @@ class CashPaymentView(generics.UpdateAPIView):
                         'message': f"Please confirm your passenger {booking.user.fullname} for booking {booking.id}\
                             has paid the sum of {amount}",
                     }
-                    send_notification(booking.rider.id, notification_data)
+                    send_notification(booking.rider_id, notification_data)
             except ValueError as exc:
                 raise ValueError("Invalid amount provided") from exc
         else:
@@ -528,6 +726,15 @@ class MonnifyTransactionWebhookView(MonnifyWebhookMixin, generics.CreateAPIView)
                         status=status.HTTP_400_BAD_REQUEST
                     )
 
+                if booking.rider_id is None:
+                    return Response(
+                        {
+                            "status": "failed",
+                            "msg": "The booking with the payment reference has no rider yet"
+                        },
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+
                 wallet = booking.rider.rider_wallet.first()
                 wallet.deposit(rider_commission)
                 wallet.save()
@@ -7,10 +7,16 @@ For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
 
+import asyncio
 import os
+import time
+from collections import OrderedDict, namedtuple
+from urllib.parse import parse_qs
+
+import jwt
 from django.core.asgi import get_asgi_application
+from channels.db import database_sync_to_async
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 
 # Set the default settings module for the 'ecoride' project
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecoride.settings')
@@ -18,14 +24,109 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecoride.settings')
 # Get the ASGI application
 django_asgi_app = get_asgi_application()
 
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
 from bookings import urls as bookings_urls
-from supports import urls as supports_urls  
+from supports import urls as supports_urls
+
+# What websocket consumers know about the connected user, without a model instance
+Principal = namedtuple('Principal', ['id', 'role', 'is_staff', 'email'])
+
+class LRUCache:
+    """Bounded mapping that forgets the least recently used entry first"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def set(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        self.entries.pop(key, None)
+
+@database_sync_to_async
+def get_principal(user_id):
+    """The Principal of a user, with one query, or ``None``"""
+    user = get_user_model().objects.filter(id=user_id).values('id', 'role', 'is_staff', 'email').first()
+    return Principal(**user) if user else None
+
+class JWTAuthMiddleware:
+    """
+    Authenticates a websocket connection once, from the JWT in its ``token``
+    query parameter, and puts a Principal (or ``None``) in ``scope['principal']``.
+
+    Verified tokens and looked-up principals are kept in bounded LRU caches,
+    principals for WS_PRINCIPAL_TTL seconds, and concurrent lookups of the same
+    user share one query, so a reconnect storm costs one query per user.
+    """
+    def __init__(self, inner, max_size=None, principal_ttl=None):
+        self.inner = inner
+        max_size = max_size or settings.WS_AUTH_CACHE_SIZE
+        self.tokens = LRUCache(max_size)      # token -> (user_id, expiry)
+        self.principals = LRUCache(max_size)  # user_id -> (principal, cached until)
+        self.principal_ttl = settings.WS_PRINCIPAL_TTL if principal_ttl is None else principal_ttl
+        self.lookups = {}                     # user_id -> lookup in flight
+
+    async def __call__(self, scope, receive, send):
+        token = parse_qs(scope.get('query_string', b'').decode()).get('token', [None])[0]
+        scope = dict(scope, principal=await self.authenticate(token))
+        return await self.inner(scope, receive, send)
+
+    def verify(self, token):
+        """The user ID a token was issued for, or ``None`` if it is invalid or expired"""
+        verified = self.tokens.get(token)
+        if verified is None:
+            try:
+                claims = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
+            except jwt.InvalidTokenError:
+                return None
+            verified = (claims.get('user_id'), claims.get('exp', float('inf')))
+            self.tokens.set(token, verified)
+
+        user_id, expiry = verified
+        if expiry <= time.time():
+            self.tokens.pop(token)
+            return None
+        return user_id
+
+    async def authenticate(self, token):
+        """The Principal for a token, or ``None``"""
+        user_id = self.verify(token) if token else None
+        if user_id is None:
+            return None
+
+        cached = self.principals.get(user_id)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+
+        lookup = self.lookups.get(user_id)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self.load_principal(user_id))
+            self.lookups[user_id] = lookup
+            lookup.add_done_callback(lambda _: self.lookups.pop(user_id, None))
+        return await asyncio.shield(lookup)
+
+    async def load_principal(self, user_id):
+        principal = await get_principal(user_id)
+        if principal is not None:
+            self.principals.set(user_id, (principal, time.monotonic() + self.principal_ttl))
+        return principal
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,  # Handles HTTP requests
-    "websocket": AuthMiddlewareStack(
+    "websocket": JWTAuthMiddleware(
         URLRouter(
             bookings_urls.websocket_urlpatterns + supports_urls.websocket_urlpatterns
         )
     ),
-})
\ No newline at end of file
+})
@@ -15,8 +15,59 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
 app.conf.beat_schedule = {
-    'send-rider-location-every-5-seconds': {
-        'task': 'bookings.tasks.send_rider_location',  # reference the task by name
-        'schedule': 5.0,  # run every 5 seconds
+    'flush-trip-trails': {
+        'task': 'bookings.tasks.flush_trip_trails',
+        'schedule': float(os.getenv('TRIP_TRAIL_FLUSH_INTERVAL', '10.0')),
+    },
+    'flush-ride-chat': {
+        'task': 'bookings.tasks.flush_ride_chat',
+        'schedule': float(os.getenv('RIDE_CHAT_FLUSH_INTERVAL', '2.0')),
+    },
+    'sweep-rider-presence': {
+        'task': 'bookings.tasks.sweep_rider_presence',
+        'schedule': float(os.getenv('RIDER_PRESENCE_SWEEP_INTERVAL', '30.0')),
+    },
+    'expire-booking-offers': {
+        'task': 'bookings.tasks.expire_booking_offers',
+        'schedule': float(os.getenv('OFFER_TIMER_TICK', '1.0')),
+    },
+    'release-scheduled-bookings': {
+        'task': 'bookings.tasks.release_scheduled_bookings',
+        'schedule': float(os.getenv('SCHEDULED_RELEASE_INTERVAL', '30.0')),
+    },
+    'rebuild-scheduled-booking-queue': {
+        'task': 'bookings.tasks.rebuild_scheduled_booking_queue',
+        'schedule': float(os.getenv('SCHEDULED_QUEUE_REBUILD_INTERVAL', '600.0')),
+    },
+    'reconcile-rider-states': {
+        'task': 'bookings.tasks.reconcile_rider_state_cache',
+        'schedule': float(os.getenv('RIDER_STATE_RECONCILE_INTERVAL', '60.0')),
+    },
+    'assign-waiting-tickets': {
+        'task': 'supports.tasks.assign_unassigned_tickets',
+        'schedule': float(os.getenv('SUPPORT_ASSIGN_INTERVAL', '30.0')),
+    },
+    'sweep-admin-presence': {
+        'task': 'supports.tasks.sweep_admin_presence',
+        'schedule': float(os.getenv('SUPPORT_ADMIN_PRESENCE_SWEEP_INTERVAL', '30.0')),
+    },
+    'reconcile-admin-loads': {
+        'task': 'supports.tasks.reconcile_admin_load_cache',
+        'schedule': float(os.getenv('SUPPORT_LOAD_RECONCILE_INTERVAL', '300.0')),
     },
 }
+
+# Rider locations are pushed from the websocket consumer; polling is only a fallback
+# (mirrors RIDER_LOCATION_FANOUT in settings, read here before Django is set up)
+if os.getenv('RIDER_LOCATION_FANOUT', 'push') == 'poll':
+    app.conf.beat_schedule['send-rider-location'] = {
+        'task': 'bookings.tasks.send_rider_location',  # reference the task by name
+        'schedule': float(os.getenv('RIDER_LOCATION_POLL_INTERVAL', '5.0')),
+    }
+
+# Pending bookings are matched in batches only in DISPATCH_MODE "batch"
+if os.getenv('DISPATCH_MODE', 'instant') == 'batch':
+    app.conf.beat_schedule['match-pending-bookings'] = {
+        'task': 'bookings.tasks.match_pending_bookings',
+        'schedule': float(os.getenv('MATCHING_INTERVAL', '2.0')),
+    }
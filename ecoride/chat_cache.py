@@ -0,0 +1,76 @@
+"""
+Recent messages of each chat conversation, kept in a capped Redis list so
+reconnects are served without touching Postgres.
+
+Every list holds the frames of the last RECENT_CHAT_MESSAGES messages, oldest
+first, exactly as they are sent over the socket. It is appended to on send,
+before the message is stored, and filled from Postgres on a miss. A list that
+reaches back to the start of its conversation begins with RECENT_CHAT_START,
+so short conversations are complete without asking Postgres either.
+
+Open conversations keep their list for RECENT_CHAT_TTL seconds after the last
+message; once the booking or ticket closes it is dropped RECENT_CHAT_CLOSED_TTL
+seconds later.
+"""
+import json
+
+from django.conf import settings
+
+from .redis_client import get_async_redis
+
+# First element of a list that holds its whole conversation
+RECENT_CHAT_START = b'{"start": true}'
+
+# Prepend older frames ARGV[5..] to the list, then the start marker ARGV[2] unless
+# it is empty, but only if its head is still ARGV[1] (empty: the list did not exist),
+# so two connections filling the same miss never add the same messages twice.
+FILL_RECENT_MESSAGES = """
+local head = redis.call('LINDEX', KEYS[1], 0)
+if (head or '') ~= ARGV[1] then
+    return 0
+end
+for index = #ARGV, 5, -1 do
+    redis.call('LPUSH', KEYS[1], ARGV[index])
+end
+if ARGV[2] ~= '' then
+    redis.call('LPUSH', KEYS[1], ARGV[2])
+end
+redis.call('LTRIM', KEYS[1], -tonumber(ARGV[3]), -1)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+def push_recent_message(pipe, key, frame):
+    """Queue appending a message frame to a conversation's list on a (sync or async) pipeline"""
+    pipe.rpush(key, json.dumps(frame))
+    pipe.ltrim(key, -settings.RECENT_CHAT_MESSAGES, -1)
+    pipe.expire(key, settings.RECENT_CHAT_TTL)
+
+def expire_recent_messages(pipe, key):
+    """Queue dropping a closed conversation's list after RECENT_CHAT_CLOSED_TTL seconds"""
+    pipe.expire(key, settings.RECENT_CHAT_CLOSED_TTL)
+
+async def recent_messages(key, load_older):
+    """
+    The frames of a conversation's last RECENT_CHAT_MESSAGES messages, oldest
+    first, and whether they go back to its start.
+
+    Served from the list alone when it is full or complete. Otherwise
+    ``load_older(oldest_frame, limit)`` (``oldest_frame`` is ``None`` on a miss)
+    is awaited for up to ``limit`` older frames, oldest first, and whether
+    nothing older remains, and the list is filled with them.
+    """
+    redis_client = get_async_redis()
+    entries = await redis_client.lrange(key, 0, -1)
+    complete = bool(entries) and entries[0] == RECENT_CHAT_START
+    frames = [json.loads(entry) for entry in entries[1 if complete else 0:]]
+
+    limit = settings.RECENT_CHAT_MESSAGES
+    if complete or len(frames) >= limit:
+        return frames, complete
+
+    older, complete = await load_older(frames[0] if frames else None, limit - len(frames))
+    fill = redis_client.register_script(FILL_RECENT_MESSAGES)
+    await fill(keys=[key], args=[entries[0] if entries else '', RECENT_CHAT_START if complete else '', limit,
+                                 settings.RECENT_CHAT_TTL, *[json.dumps(frame) for frame in older]])
+    return older + frames, complete
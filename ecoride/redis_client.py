@@ -0,0 +1,79 @@
+"""
+Shared, pooled Redis clients configured from settings.
+
+Use ``get_redis`` from synchronous code (views, Celery tasks) and
+``get_async_redis`` from ``async def`` code such as websocket consumers, so
+Redis round trips never block the event loop.
+"""
+
+import asyncio
+import uuid
+import weakref
+
+import redis
+from redis import asyncio as aioredis
+
+from django.conf import settings
+
+_redis = None
+
+# redis.asyncio connections belong to the event loop that opened them, so
+# each loop gets its own pool. Daphne runs a single loop per process.
+_async_redis = weakref.WeakKeyDictionary()
+
+# Delete lock KEYS[1] only while it still holds its holder's token ARGV[1], so a
+# holder that outlived the lock's expiry never releases someone else's.
+RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Push lock KEYS[1]'s expiry to ARGV[2] seconds from now, only while it still
+# holds its holder's token ARGV[1]
+EXTEND_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+def get_redis():
+    """Process-wide synchronous Redis client"""
+    global _redis  # pylint: disable=global-statement
+    if _redis is None:
+        _redis = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
+            settings.REDIS_URL,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+        ))
+    return _redis
+
+def get_async_redis():
+    """asyncio Redis client bound to the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_redis.get(loop)
+    if client is None:
+        client = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool.from_url(
+            settings.REDIS_URL,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+        ))
+        _async_redis[loop] = client
+    return client
+
+def acquire_lock(key, timeout):
+    """Take a lock for ``timeout`` seconds; returns its token, or ``None`` if it is already held"""
+    token = uuid.uuid4().hex
+    return token if get_redis().set(key, token, nx=True, ex=timeout) else None
+
+def release_lock(key, token):
+    """Release a lock if it is still held with ``token``; returns whether it was"""
+    release = get_redis().register_script(RELEASE_LOCK)
+    return bool(release(keys=[key], args=[token]))
+
+def extend_lock(key, token, timeout):
+    """Keep a lock held with ``token`` for another ``timeout`` seconds; returns whether it still was"""
+    extend = get_redis().register_script(EXTEND_LOCK)
+    return bool(extend(keys=[key], args=[token, timeout]))
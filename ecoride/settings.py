@@ -174,6 +174,12 @@ REST_FRAMEWORK = {
 }
 
 # Simple JWT settings
+# Websocket connections are authenticated once in ecoride.asgi.JWTAuthMiddleware,
+# which remembers up to WS_AUTH_CACHE_SIZE tokens and users, the latter for
+# WS_PRINCIPAL_TTL seconds (how long a role change can take to reach new sockets).
+WS_AUTH_CACHE_SIZE = int(os.getenv('WS_AUTH_CACHE_SIZE', '10000'))
+WS_PRINCIPAL_TTL = int(os.getenv('WS_PRINCIPAL_TTL', '300'))
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=1) if not DEBUG else timedelta(days=1),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
@@ -235,18 +241,117 @@ SWAGGER_SETTINGS = {
 
 BASE_URL = os.getenv("BASE_URL")
 
+# Redis used for live rider state (locations, presence, chat caches)
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/0')
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', '50'))
+REDIS_POOL_TIMEOUT = float(os.getenv('REDIS_POOL_TIMEOUT', '5'))
+
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://redis:6379/0')
 CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', 'redis://redis:6379/0')
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 
+# How rider locations reach passengers tracking a booking:
+# "push" fans each update out from RiderLocationConsumer as it arrives,
+# "poll" falls back to the send_rider_location Celery beat task,
+# "sharded" splits active bookings between `manage.py run_location_broadcaster`
+# workers, each sending its shard every RIDER_LOCATION_BROADCAST_INTERVAL seconds.
+RIDER_LOCATION_FANOUT = os.getenv('RIDER_LOCATION_FANOUT', 'push')
+RIDER_LOCATION_BROADCAST_INTERVAL = float(os.getenv('RIDER_LOCATION_BROADCAST_INTERVAL', '1.0'))
+
+# A broadcaster worker silent for this many seconds loses its shard to the others
+LOCATION_BROADCASTER_TTL = int(os.getenv('LOCATION_BROADCASTER_TTL', '10'))
+
+# Per-connection coalescing of rider location frames: a frame is written only
+# if it moved at least MIN_DISTANCE metres and arrived MIN_INTERVAL ms after
+# the last written one (the latest deferred frame is written when it expires).
+RIDER_LOCATION_MIN_DISTANCE = float(os.getenv('RIDER_LOCATION_MIN_DISTANCE', '5'))
+RIDER_LOCATION_MIN_INTERVAL = int(os.getenv('RIDER_LOCATION_MIN_INTERVAL', '1000'))
+
+# Riders not heard from for RIDER_PRESENCE_TTL seconds are considered offline;
+# a stationary rider's dropped frames still refresh presence every
+# RIDER_HEARTBEAT_INTERVAL seconds.
+RIDER_PRESENCE_TTL = int(os.getenv('RIDER_PRESENCE_TTL', '60'))
+RIDER_HEARTBEAT_INTERVAL = int(os.getenv('RIDER_HEARTBEAT_INTERVAL', '15'))
+# A rider's sets of tracked and served bookings expire RIDER_BOOKINGS_TTL
+# seconds after they were last written or the rider was last heard from.
+RIDER_BOOKINGS_TTL = int(os.getenv('RIDER_BOOKINGS_TTL', '86400'))
+
+# Speed model for rider ETAs: great-circle distance stretched by DETOUR_FACTOR
+# to approximate road distance, covered at SPEED_KMH, plus OVERHEAD seconds.
+RIDER_ETA_SPEED_KMH = float(os.getenv('RIDER_ETA_SPEED_KMH', '25'))
+RIDER_ETA_DETOUR_FACTOR = float(os.getenv('RIDER_ETA_DETOUR_FACTOR', '1.3'))
+RIDER_ETA_OVERHEAD = int(os.getenv('RIDER_ETA_OVERHEAD', '60'))
+
+# Automatic dispatch considers the DISPATCH_CANDIDATES nearest riders within
+# DISPATCH_RADIUS_KM of the pickup point.
+DISPATCH_RADIUS_KM = float(os.getenv('DISPATCH_RADIUS_KM', '5'))
+DISPATCH_CANDIDATES = int(os.getenv('DISPATCH_CANDIDATES', '20'))
+
+# "instant" dispatches each booking as it is created; "batch" leaves it
+# unassigned for the match_pending_bookings task, which pairs up to
+# MATCHING_BATCH_SIZE pending bookings with free riders every window;
+# "offer" sends it to the OFFER_RIDERS nearest free riders and the first to
+# accept within OFFER_TTL seconds gets it.
+# In every mode a booking left pending for OFFER_TTL seconds is offered to the
+# next riders, and cancelled once that has happened OFFER_ROUNDS times.
+DISPATCH_MODE = os.getenv('DISPATCH_MODE', 'instant')
+MATCHING_BATCH_SIZE = int(os.getenv('MATCHING_BATCH_SIZE', '2000'))
+OFFER_RIDERS = int(os.getenv('OFFER_RIDERS', '5'))
+OFFER_TTL = int(os.getenv('OFFER_TTL', '60'))
+OFFER_ROUNDS = int(os.getenv('OFFER_ROUNDS', '3'))
+
+# Bookings for a later time wait in a due-queue and are released into dispatch
+# SCHEDULED_DISPATCH_LEAD seconds ahead, SCHEDULED_RELEASE_BATCH at a time.
+SCHEDULED_DISPATCH_LEAD = int(os.getenv('SCHEDULED_DISPATCH_LEAD', '600'))
+SCHEDULED_RELEASE_BATCH = int(os.getenv('SCHEDULED_RELEASE_BATCH', '500'))
+
+# Ride chat history is sent on connect, and on request, RIDE_CHAT_HISTORY_PAGE messages at a time
+RIDE_CHAT_HISTORY_PAGE = int(os.getenv('RIDE_CHAT_HISTORY_PAGE', '50'))
+
+# Ride chat messages are broadcast at once and inserted in bulk, whenever
+# RIDE_CHAT_FLUSH_SIZE are buffered and every RIDE_CHAT_FLUSH_INTERVAL seconds;
+# a batch failing RIDE_CHAT_FLUSH_MAX_FAILURES times in a row is inserted row by row.
+# One flush inserts at most RIDE_CHAT_FLUSH_MAX_BATCHES batches and leaves the rest
+# to the next.
+RIDE_CHAT_FLUSH_SIZE = int(os.getenv('RIDE_CHAT_FLUSH_SIZE', '100'))
+RIDE_CHAT_FLUSH_MAX_FAILURES = int(os.getenv('RIDE_CHAT_FLUSH_MAX_FAILURES', '5'))
+RIDE_CHAT_FLUSH_MAX_BATCHES = int(os.getenv('RIDE_CHAT_FLUSH_MAX_BATCHES', '50'))
+
+# Ride and support chats keep their last RECENT_CHAT_MESSAGES messages in Redis for
+# reconnects, for RECENT_CHAT_TTL seconds after the last message, or
+# RECENT_CHAT_CLOSED_TTL seconds once the booking or ticket is closed.
+RECENT_CHAT_MESSAGES = int(os.getenv('RECENT_CHAT_MESSAGES', '100'))
+RECENT_CHAT_TTL = int(os.getenv('RECENT_CHAT_TTL', str(60 * 60 * 24)))
+RECENT_CHAT_CLOSED_TTL = int(os.getenv('RECENT_CHAT_CLOSED_TTL', '600'))
+
+# Support chat history is sent, and paged back on request, SUPPORT_CHAT_HISTORY_BATCH
+# messages per frame
+SUPPORT_CHAT_HISTORY_BATCH = int(os.getenv('SUPPORT_CHAT_HISTORY_BATCH', '50'))
+
+# Admins page through the unassigned ticket queue SUPPORT_TICKET_PAGE_SIZE tickets at a
+# time by default, and at most SUPPORT_TICKET_MAX_PAGE_SIZE
+SUPPORT_TICKET_PAGE_SIZE = int(os.getenv('SUPPORT_TICKET_PAGE_SIZE', '50'))
+SUPPORT_TICKET_MAX_PAGE_SIZE = int(os.getenv('SUPPORT_TICKET_MAX_PAGE_SIZE', '200'))
+
+# New support tickets go to the least-loaded online admin; tickets that arrived while
+# nobody was online are assigned SUPPORT_ASSIGN_BATCH at a time every SUPPORT_ASSIGN_INTERVAL seconds.
+SUPPORT_ASSIGN_BATCH = int(os.getenv('SUPPORT_ASSIGN_BATCH', '100'))
+# Admins not heard from for SUPPORT_ADMIN_PRESENCE_TTL seconds leave the pool; each
+# open notification socket vouches for its admin every SUPPORT_ADMIN_HEARTBEAT_INTERVAL seconds.
+SUPPORT_ADMIN_PRESENCE_TTL = int(os.getenv('SUPPORT_ADMIN_PRESENCE_TTL', '60'))
+SUPPORT_ADMIN_HEARTBEAT_INTERVAL = int(os.getenv('SUPPORT_ADMIN_HEARTBEAT_INTERVAL', '15'))
+
+# Upper bound on points buffered in Redis per trip between trail flushes
+TRIP_TRAIL_MAXLEN = int(os.getenv('TRIP_TRAIL_MAXLEN', '5000'))
+
 # WebSocket setup (using Channels, if needed)
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
-            "hosts": [("redis", 6379)],
+            "hosts": [REDIS_URL],
         },
     },
 }
@@ -0,0 +1,239 @@
+"""
+Automatic assignment of support tickets to the least-loaded online admin.
+
+Each admin's count of open tickets lives in a Redis hash, and online admins
+are mirrored in a sorted set scored by that count, so picking an admin and
+counting the ticket against them is one atomic script however many tickets
+arrive at once. The ticket row is then claimed with a conditional UPDATE.
+
+Admins are online while they have a notification socket open, which is
+tracked per socket and vouched for by a heartbeat, so admins whose sockets
+died with their worker are swept out of the pool once their heartbeat expires.
+"""
+# pylint: disable=no-member
+import time
+from collections import Counter
+
+from django.conf import settings
+
+from bookings.offers import send_notifications
+from ecoride.redis_client import get_redis, get_async_redis
+
+from .models import SupportTicket
+
+# Sorted set of online admin IDs scored by how many open tickets they hold
+SUPPORT_ADMIN_LOAD_KEY = 'support_admin_load'
+# Hash of admin ID -> open tickets held, online or not
+SUPPORT_ADMIN_TICKETS_KEY = 'support_admin_tickets'
+# Hash of ticket ID -> admin it is counted against
+SUPPORT_TICKET_ADMINS_KEY = 'support_ticket_admins'
+# Hash of admin ID -> open notification sockets
+SUPPORT_ADMIN_SOCKETS_KEY = 'support_admin_sockets'
+# Sorted set of online admin IDs scored by the unix time they were last heard from
+SUPPORT_ADMINS_LAST_SEEN_KEY = 'support_admins_last_seen'
+
+LOAD_KEYS = [SUPPORT_ADMIN_LOAD_KEY, SUPPORT_ADMIN_TICKETS_KEY, SUPPORT_TICKET_ADMINS_KEY]
+PRESENCE_KEYS = [SUPPORT_ADMIN_LOAD_KEY, SUPPORT_ADMIN_TICKETS_KEY, SUPPORT_ADMIN_SOCKETS_KEY,
+                 SUPPORT_ADMINS_LAST_SEEN_KEY]
+
+# Add ``delta`` to an admin's ticket count, mirroring it in the online set if they are there
+RECOUNT = """
+local function recount(admin, delta)
+    local count = redis.call('HINCRBY', KEYS[2], admin, delta)
+    if count <= 0 then
+        redis.call('HDEL', KEYS[2], admin)
+        count = 0
+    end
+    redis.call('ZADD', KEYS[1], 'XX', count, admin)
+end
+"""
+
+# Count ticket ARGV[1] against admin ARGV[2], moving it from any other admin,
+# or when ARGV[2] is empty against the least-loaded online admin unless it is
+# already counted. Returns the admin it is counted against, or false if nobody is online.
+ASSIGN_TICKET = RECOUNT + """
+local counted = redis.call('HGET', KEYS[3], ARGV[1])
+local admin = ARGV[2]
+if admin == '' then
+    if counted then
+        return counted
+    end
+    admin = redis.call('ZRANGE', KEYS[1], 0, 0)[1]
+    if not admin then
+        return false
+    end
+elseif counted == admin then
+    return admin
+elseif counted then
+    recount(counted, -1)
+end
+redis.call('HSET', KEYS[3], ARGV[1], admin)
+recount(admin, 1)
+return admin
+"""
+
+# Stop counting ticket ARGV[1], only if it is counted against ARGV[2] when that is given
+RELEASE_TICKET = RECOUNT + """
+local counted = redis.call('HGET', KEYS[3], ARGV[1])
+if not counted or (ARGV[2] ~= '' and counted ~= ARGV[2]) then
+    return false
+end
+redis.call('HDEL', KEYS[3], ARGV[1])
+recount(counted, -1)
+return counted
+"""
+
+# Track admin ARGV[1]'s notification sockets, heard from at ARGV[2]; they are online while they have one
+ADMIN_ONLINE = """
+redis.call('HINCRBY', KEYS[3], ARGV[1], 1)
+redis.call('ZADD', KEYS[4], ARGV[2], ARGV[1])
+redis.call('ZADD', KEYS[1], tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or 0), ARGV[1])
+"""
+ADMIN_OFFLINE = """
+if redis.call('HINCRBY', KEYS[3], ARGV[1], -1) <= 0 then
+    redis.call('HDEL', KEYS[3], ARGV[1])
+    redis.call('ZREM', KEYS[4], ARGV[1])
+    redis.call('ZREM', KEYS[1], ARGV[1])
+end
+"""
+# Admin ARGV[1] was heard from at ARGV[2]; one swept while a socket was still
+# open (say, a stalled event loop) is put back in the pool
+ADMIN_HEARTBEAT = """
+redis.call('ZADD', KEYS[4], ARGV[2], ARGV[1])
+if redis.call('HSETNX', KEYS[3], ARGV[1], 1) == 1 then
+    redis.call('ZADD', KEYS[1], tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or 0), ARGV[1])
+end
+"""
+
+# Take up to ARGV[2] admins last heard from before ARGV[1] out of the pool and
+# forget their sockets in one atomic step, so a concurrent heartbeat is never lost.
+SWEEP_STALE_ADMINS = """
+local stale = redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #stale > 0 then
+    redis.call('ZREM', KEYS[4], unpack(stale))
+    redis.call('ZREM', KEYS[1], unpack(stale))
+    redis.call('HDEL', KEYS[3], unpack(stale))
+end
+return stale
+"""
+
+SWEEP_BATCH_SIZE = 1000
+
+def count_ticket(ticket_id, admin_id=None):
+    """Count a ticket against an admin (default: the least-loaded online one); returns who, or ``None``"""
+    assign = get_redis().register_script(ASSIGN_TICKET)
+    admin_id = assign(keys=LOAD_KEYS, args=[ticket_id, '' if admin_id is None else str(admin_id)])
+    return None if admin_id is None else admin_id.decode('utf-8')
+
+def release_ticket(ticket_id, admin_id=None):
+    """Stop counting a ticket, e.g. once it is closed; returns whether it was counted"""
+    release = get_redis().register_script(RELEASE_TICKET)
+    return release(keys=LOAD_KEYS, args=[ticket_id, '' if admin_id is None else str(admin_id)]) is not None
+
+def assign_ticket(ticket_id):
+    """
+    Give an open, unassigned ticket to the least-loaded online admin and tell
+    them over their notification socket. Returns the admin's ID, or ``None``
+    if nobody is online or the ticket was taken or closed meanwhile.
+    """
+    admin_id = count_ticket(ticket_id)
+    if admin_id is None:
+        return None
+
+    assigned = SupportTicket.objects.filter(id=ticket_id, assigned_admin__isnull=True, status='open')\
+        .update(assigned_admin_id=admin_id, status='in_progress')
+    if not assigned:
+        # Whoever holds it now keeps the count; it only comes off this admin
+        if not SupportTicket.objects.filter(id=ticket_id, assigned_admin_id=admin_id)\
+                .exclude(status='closed').exists():
+            release_ticket(ticket_id, admin_id)
+        return None
+
+    send_notifications([(admin_id, {
+        'type': 'support_ticket_assigned',
+        'ticket_id': int(ticket_id),
+        'message': f"Support ticket {ticket_id} has been assigned to you.",
+    })])
+    return admin_id
+
+def claim_ticket(ticket_id, admin_id):
+    """Let an admin take an unassigned ticket themselves; exactly one concurrent caller wins"""
+    claimed = SupportTicket.objects.filter(id=ticket_id, assigned_admin__isnull=True)\
+        .exclude(status='closed').update(assigned_admin_id=admin_id, status='in_progress')
+    if claimed:
+        count_ticket(ticket_id, admin_id)
+    return bool(claimed)
+
+def assign_waiting_tickets(limit=None):
+    """
+    Assign open, unassigned tickets oldest first, up to ``limit`` (default
+    SUPPORT_ASSIGN_BATCH), while any admin is online. Returns how many were assigned.
+    """
+    limit = limit or settings.SUPPORT_ASSIGN_BATCH
+    ticket_ids = SupportTicket.objects.filter(assigned_admin__isnull=True, status='open')\
+        .order_by('created_at', 'id').values_list('id', flat=True)[:limit]
+    assigned = 0
+    for ticket_id in ticket_ids:
+        if not get_redis().exists(SUPPORT_ADMIN_LOAD_KEY):
+            break
+        if assign_ticket(ticket_id):
+            assigned += 1
+    return assigned
+
+def reconcile_admin_loads():
+    """
+    Rebuild the ticket counts from Postgres with one query, in a single MULTI.
+    Returns how many admins' counts had drifted.
+    """
+    tickets = dict(SupportTicket.objects.filter(assigned_admin__isnull=False)
+                   .exclude(status='closed').values_list('id', 'assigned_admin_id'))
+    counts = Counter(str(admin_id) for admin_id in tickets.values())
+
+    redis_client = get_redis()
+    cached = {admin_id.decode('utf-8'): int(count)
+              for admin_id, count in redis_client.hgetall(SUPPORT_ADMIN_TICKETS_KEY).items()}
+    online = [admin_id.decode('utf-8') for admin_id in redis_client.zrange(SUPPORT_ADMIN_LOAD_KEY, 0, -1)]
+
+    pipe = redis_client.pipeline()
+    pipe.delete(SUPPORT_ADMIN_TICKETS_KEY, SUPPORT_TICKET_ADMINS_KEY)
+    if tickets:
+        pipe.hset(SUPPORT_ADMIN_TICKETS_KEY, mapping=counts)
+        pipe.hset(SUPPORT_TICKET_ADMINS_KEY,
+                  mapping={ticket_id: str(admin_id) for ticket_id, admin_id in tickets.items()})
+    if online:
+        pipe.zadd(SUPPORT_ADMIN_LOAD_KEY, {admin_id: counts.get(admin_id, 0) for admin_id in online}, xx=True)
+    pipe.execute()
+    return sum(1 for admin_id in set(cached) | set(counts) if cached.get(admin_id, 0) != counts.get(admin_id, 0))
+
+def sweep_stale_admins(max_age=None):
+    """
+    Take admins silent for more than ``max_age`` seconds (default
+    SUPPORT_ADMIN_PRESENCE_TTL) out of the pool, e.g. when the worker holding
+    their sockets died. Returns their IDs.
+    """
+    if max_age is None:
+        max_age = settings.SUPPORT_ADMIN_PRESENCE_TTL
+    sweep = get_redis().register_script(SWEEP_STALE_ADMINS)
+    cutoff = time.time() - max_age
+
+    swept = []
+    while True:
+        stale = sweep(keys=PRESENCE_KEYS, args=[cutoff, SWEEP_BATCH_SIZE])
+        swept.extend(admin_id.decode('utf-8') for admin_id in stale)
+        if len(stale) < SWEEP_BATCH_SIZE:
+            return swept
+
+async def admin_online(admin_id):
+    """Put an admin in the assignment pool when one of their notification sockets connects"""
+    script = get_async_redis().register_script(ADMIN_ONLINE)
+    await script(keys=PRESENCE_KEYS, args=[str(admin_id), time.time()])
+
+async def admin_heartbeat(admin_id):
+    """Keep an admin with an open notification socket in the pool"""
+    script = get_async_redis().register_script(ADMIN_HEARTBEAT)
+    await script(keys=PRESENCE_KEYS, args=[str(admin_id), time.time()])
+
+async def admin_offline(admin_id):
+    """Take an admin out of the pool once their last notification socket disconnects"""
+    script = get_async_redis().register_script(ADMIN_OFFLINE)
+    await script(keys=PRESENCE_KEYS, args=[str(admin_id)])
@@ -0,0 +1,146 @@
+"""
+Support chat history, with the latest messages of each ticket cached in Redis,
+a cursor so reconnecting clients only receive what they missed, and older
+messages paged newest first by keyset on (ticket, timestamp, id)
+"""
+# pylint: disable=no-member
+from datetime import datetime, timedelta, timezone
+
+from django.db.models import Q
+from channels.db import database_sync_to_async
+
+from ecoride.chat_cache import expire_recent_messages, recent_messages
+from ecoride.redis_client import get_redis
+
+from .models import ChatMessage
+
+# Timestamps of support chat frames, in UTC, to the second
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def ticket_chat_key(ticket_id):
+    """Key of the capped list of a ticket's latest chat message frames"""
+    return f'ticket_{ticket_id}_recent_chat'
+
+def encode_cursor(timestamp):
+    """
+    Opaque cursor pointing just after a message sent at ``timestamp``: its
+    microseconds since the epoch, so it needs no escaping in a query string
+    """
+    return str((timestamp - EPOCH) // timedelta(microseconds=1))
+
+def decode_cursor(cursor):
+    """The timestamp in a cursor; raises ValueError if it is malformed"""
+    if not isinstance(cursor, str) or not cursor.isdigit():
+        raise ValueError('Malformed history cursor')
+    return EPOCH + timedelta(microseconds=int(cursor))
+
+def encode_page_cursor(timestamp, message_id):
+    """Opaque cursor pointing just before a stored message, for paging back"""
+    return f'{encode_cursor(timestamp)}_{message_id}'
+
+def decode_page_cursor(cursor):
+    """``(timestamp, message_id)`` from a page cursor; raises ValueError if it is malformed"""
+    if not isinstance(cursor, str):
+        raise ValueError('Malformed history cursor')
+    timestamp, message_id = cursor.rsplit('_', 1)
+    return decode_cursor(timestamp), int(message_id)
+
+def chat_frame(message, sender, role, timestamp):
+    """One support chat message as sent over the socket"""
+    return {
+        'message': message,
+        'sender': sender,
+        'user': role,
+        'timestamp': timestamp.strftime(TIMESTAMP_FORMAT),
+        'cursor': encode_cursor(timestamp),
+    }
+
+def chat_message_frame(message):
+    """One support chat message as sent over the socket, from a ``values()`` row"""
+    return chat_frame(message['message'], message['sender__email'], message['sender__role'], message['timestamp'])
+
+def frame_time(frame):
+    """
+    When a frame's message was sent (to the second for frames cached without
+    a cursor, or with one from before cursors were epoch microseconds)
+    """
+    if frame.get('cursor', '').isdigit():
+        return decode_cursor(frame['cursor'])
+    return datetime.strptime(frame['timestamp'], TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+
+def keyset_before(timestamp, message_id):
+    """Filter for the messages that come before ``(timestamp, message_id)``"""
+    return Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+
+def ticket_messages(ticket_id):
+    """A ticket's messages as ``values()`` rows with their sender, for one query"""
+    return ChatMessage.objects.filter(ticket_id=ticket_id)\
+        .values('id', 'message', 'timestamp', 'sender__email', 'sender__role')
+
+def frame_page_cursor(frame):
+    """
+    Page cursor pointing just before a cached frame. Frames loaded from
+    Postgres keep their ``id``; ones cached on send have none yet and are
+    paged past by timestamp alone.
+    """
+    return encode_page_cursor(frame_time(frame), frame.get('id', 0))
+
+def older_ticket_messages(ticket_id, oldest, limit):
+    """
+    Up to ``limit`` frames of a ticket's chat, with their ``id``, sent before
+    the ``oldest`` cached frame (the latest when it is ``None``), oldest first,
+    and whether that is all of them
+    """
+    messages = ticket_messages(ticket_id)
+    if oldest:
+        messages = messages.filter(keyset_before(frame_time(oldest), oldest.get('id', 0)))
+
+    page = list(messages.order_by('-timestamp', '-id')[:limit + 1])
+    frames = [dict(chat_message_frame(message), id=message['id']) for message in reversed(page[:limit])]
+    return frames, len(page) <= limit
+
+def ticket_history_page(ticket_id, before, limit):
+    """
+    Up to ``limit`` frames of a ticket's chat sent before the ``before`` cursor,
+    oldest first, and the cursor of the page before them (``None`` once the
+    start is reached), with one query on the (ticket, timestamp, id) index
+    """
+    page = list(ticket_messages(ticket_id).filter(keyset_before(*decode_page_cursor(before)))
+                .order_by('-timestamp', '-id')[:limit + 1])
+    next_cursor = None
+    if len(page) > limit:
+        next_cursor = encode_page_cursor(page[limit - 1]['timestamp'], page[limit - 1]['id'])
+    return [chat_message_frame(message) for message in reversed(page[:limit])], next_cursor
+
+def newer_ticket_messages(ticket_id, since):
+    """Frames of every message of a ticket sent after ``since``, oldest first"""
+    messages = ticket_messages(ticket_id).filter(timestamp__gt=since).order_by('timestamp', 'id')
+    return [chat_message_frame(message) for message in messages]
+
+async def ticket_chat_history(ticket_id, since=None):
+    """
+    A ticket's messages sent after the ``since`` cursor, oldest first, or its
+    latest RECENT_CHAT_MESSAGES without one, and the cursor to page back from
+    them (``None`` when they reach the start or follow ``since``). Served from
+    the cache when it reaches back far enough, otherwise with one query.
+    Raises ValueError if the cursor is malformed.
+    """
+    since = decode_cursor(since) if since else None
+    frames, complete = await recent_messages(
+        ticket_chat_key(ticket_id),
+        lambda oldest, limit: database_sync_to_async(older_ticket_messages)(ticket_id, oldest, limit),
+    )
+    messages = [{key: value for key, value in frame.items() if key != 'id'} for frame in frames]
+    if since is None:
+        return messages, None if complete or not frames else frame_page_cursor(frames[0])
+    if complete or (frames and frame_time(frames[0]) <= since):
+        return [message for message in messages if frame_time(message) > since], None
+    return await database_sync_to_async(newer_ticket_messages)(ticket_id, since), None
+
+def close_ticket_chat(ticket_id):
+    """Let a closed ticket's cached chat messages expire"""
+    pipe = get_redis().pipeline()
+    expire_recent_messages(pipe, ticket_chat_key(ticket_id))
+    pipe.execute()
@@ -1,27 +1,25 @@
-import jwt
+import asyncio
 import json
+from urllib.parse import parse_qs
 
+from django.conf import settings
+from django.utils import timezone
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 
-from django.contrib.auth import get_user_model
-from django.conf import settings
-from rest_framework.exceptions import AuthenticationFailed
+from bookings.offers import claim_offer
+from ecoride.chat_cache import push_recent_message
+from ecoride.redis_client import get_async_redis
 
+from .assignment import admin_heartbeat, admin_offline, admin_online, assign_ticket, claim_ticket
+from .chat import chat_frame, ticket_chat_history, ticket_chat_key, ticket_history_page
 from .models import SupportTicket, ChatMessage
 
-User = get_user_model()
-
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        token = self.scope['query_string'].decode().split("token=")[1]
-        try:
-            # Decode the JWT token to retrieve the user ID
-            decoded_data = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-            self.user = await self.get_user(decoded_data['user_id'])
-            if self.user is None:
-                raise AuthenticationFailed("Invalid token")
-        except (jwt.ExpiredSignatureError, jwt.InvalidTokenError, AuthenticationFailed):
+        # The user authenticated by JWTAuthMiddleware, if any
+        self.user = self.scope.get('principal')
+        if self.user is None:
             await self.close()
             return
         
@@ -29,7 +27,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
         
         await self.accept()
 
-        if not self.ticket_id:
+        created = not self.ticket_id
+        if created:
             ticket = await database_sync_to_async(self.create_ticket)()
             self.ticket_id = ticket.id
             self.ticket_group_name = f"support_{self.ticket_id}"
@@ -43,24 +42,30 @@ class ChatConsumer(AsyncWebsocketConsumer):
             ticket = await database_sync_to_async(self.get_ticket)(self.ticket_id)
             self.ticket_group_name = f"support_{self.ticket_id}"
 
-        assigned_admin, user = await self.get_ticket_data(ticket)
+        assigned_admin_id, user_id = ticket.assigned_admin_id, ticket.user_id
 
         # Allow only the user who created the ticket and the assigned admin to access
         if self.user.is_staff:
-            if assigned_admin:
+            if assigned_admin_id:
                 # If an admin is already assigned and another admin tries to connect, disconnect
-                if assigned_admin != self.user:
+                if assigned_admin_id != self.user.id:
                     await self.send(text_data=json.dumps({
                         'error': 'This ticket is already assigned to another admin.'
                     }))
                     await self.close()
                     return
             else:
-                # If no admin is assigned, assign the current admin
-                await database_sync_to_async(self.assign_admin)(ticket)
+                # If no admin is assigned, the current admin takes it unless another one beats them to it
+                claimed = await database_sync_to_async(claim_ticket, thread_sensitive=False)(ticket.id, self.user.id)
+                if not claimed:
+                    await self.send(text_data=json.dumps({
+                        'error': 'This ticket is already assigned to another admin.'
+                    }))
+                    await self.close()
+                    return
         else:
             # If it's a normal user, check if they are the owner of the ticket
-            if user != self.user:
+            if user_id != self.user.id:
                 await self.send(text_data=json.dumps({
                     'error': 'You are not authorized to access this ticket.'
                 }))
@@ -70,15 +75,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # Add user to the ticket's group and accept the connection
         await self.channel_layer.group_add(self.ticket_group_name, self.channel_name)
 
-        # Fetch and send existing messages to the user or admin
-        messages = await self.get_existing_messages()
-        if messages:
-            for message in messages:
-                await self.send(text_data=json.dumps(message))
+        # A new ticket goes to the least-loaded online admin, who is notified
+        if created:
+            await database_sync_to_async(assign_ticket, thread_sensitive=False)(ticket.id)
+
+        # Send the messages the user or admin has not seen yet: those after the
+        # ``since`` cursor they reconnect with, or the latest ones
+        since = parse_qs(self.scope.get('query_string', b'').decode()).get('since', [None])[0]
+        await self.send_history(since)
 
     def create_ticket(self):
         # Automatically create a ticket when the user starts a chat
-        return SupportTicket.objects.create(user=self.user)
+        return SupportTicket.objects.create(user_id=self.user.id)
     
     def get_ticket(self, ticket_id):
         # Fetch the ticket based on the provided ticket_id
@@ -87,57 +95,67 @@ class ChatConsumer(AsyncWebsocketConsumer):
         except SupportTicket.DoesNotExist:
             return None
 
-    def assign_admin(self, ticket):
-        # Assign the current admin to the ticket
-        ticket.assigned_admin = self.user
-        ticket.status = 'in_progress'
-        ticket.save()
-
-    @database_sync_to_async
-    def get_ticket_data(self, ticket):
-        assigned_admin = ticket.assigned_admin
-        user = ticket.user
-
-        return  assigned_admin, user
-        
-    @database_sync_to_async
-    def get_existing_messages(self):
-        # Fetch all existing messages for the ticket
-        ticket = SupportTicket.objects.get(id=self.ticket_id)
-        
-        # Use list comprehension to create a list of message data
-        return [
-            {
-                'message': message.message,
-                'sender': message.sender.email,
-                'user': message.sender.role,
-                'timestamp': message.timestamp.strftime('%Y-%m-%d %H:%M:%S')
-            }
-            for message in ticket.messages.all()
-        ]
-    
     async def receive(self, text_data):
         data = json.loads(text_data)
+        if data.get('type') == 'chat_history':
+            if 'before' in data:
+                await self.send_history_page(data['before'])
+            else:
+                await self.send_history(data.get('since'))
+            return
         message = data.get('message')
+        timestamp = timezone.now()
+        frame = chat_frame(message, self.user.email, self.user.role, timestamp)
+
+        # Cache it for reconnects first, so a concurrent refill from Postgres cannot add it twice
+        pipe = get_async_redis().pipeline()
+        push_recent_message(pipe, ticket_chat_key(self.ticket_id), frame)
+        await pipe.execute()
 
         # Save the message in the database
-        await database_sync_to_async(self.save_message)(message)
+        await database_sync_to_async(self.save_message)(message, timestamp)
 
         # Send the message to the group
-        await self.channel_layer.group_send(
-            self.ticket_group_name,
-            {
-                'type': 'chat_message',
-                'message': message,
-                'sender': self.user.email,
-                'user': self.user.role
-            }
-        )
+        await self.channel_layer.group_send(self.ticket_group_name, {'type': 'chat_message', **frame})
 
-    def save_message(self, message):
-        # Save a chat message to the database
-        ticket = SupportTicket.objects.get(id=self.ticket_id)
-        ChatMessage.objects.create(ticket=ticket, sender=self.user, message=message)
+    def save_message(self, message, timestamp):
+        # Save a chat message to the database, with the timestamp its cursor was made from
+        ChatMessage.objects.create(ticket_id=self.ticket_id, sender_id=self.user.id, message=message,
+                                   timestamp=timestamp)
+
+    async def send_history(self, since=None):
+        try:
+            messages, next_cursor = await ticket_chat_history(self.ticket_id, since)
+        except ValueError:
+            await self.send(text_data=json.dumps({'type': 'error', 'message': 'Invalid history cursor.'}))
+            return
+
+        # SUPPORT_CHAT_HISTORY_BATCH messages per frame, each with the cursor to resume after
+        # it and the one to page back from
+        batch_size = settings.SUPPORT_CHAT_HISTORY_BATCH
+        for start in range(0, max(len(messages), 1), batch_size):
+            batch = messages[start:start + batch_size]
+            await self.send(text_data=json.dumps({
+                'type': 'chat_history',
+                'messages': batch,
+                'cursor': batch[-1]['cursor'] if batch else since,
+                'next_cursor': next_cursor,
+            }))
+
+    async def send_history_page(self, before):
+        # One page of the messages before a cursor, and the cursor of the page before it
+        try:
+            messages, next_cursor = await database_sync_to_async(ticket_history_page)(
+                self.ticket_id, before, settings.SUPPORT_CHAT_HISTORY_BATCH)
+        except ValueError:
+            await self.send(text_data=json.dumps({'type': 'error', 'message': 'Invalid history cursor.'}))
+            return
+
+        await self.send(text_data=json.dumps({
+            'type': 'chat_history',
+            'messages': messages,
+            'next_cursor': next_cursor,
+        }))
 
     async def chat_message(self, event):
         message = event['message']
@@ -149,29 +167,21 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'message': message,
             'sender': sender,
             'user': role,
+            'timestamp': event.get('timestamp'),
+            'cursor': event.get('cursor'),
         }))
 
     async def disconnect(self, code):
         # Leave the group on disconnect
         await self.channel_layer.group_discard(self.ticket_group_name, self.channel_name)
 
-    @database_sync_to_async
-    def get_user(self, user_id):
-        try:
-            return User.objects.get(id=user_id)
-        except User.DoesNotExist:
-            return None
-
 class NotificationConsumer(AsyncWebsocketConsumer):
+    heartbeat_task = None
+
     async def connect(self):
-        token = self.scope['query_string'].decode().split("token=")[1]
-        try:
-            # Decode the JWT token to retrieve the user ID
-            decoded_data = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-            self.user = await self.get_user(decoded_data['user_id'])
-            if self.user is None:
-                raise AuthenticationFailed("Invalid token")
-        except (jwt.ExpiredSignatureError, jwt.InvalidTokenError, AuthenticationFailed):
+        # The user authenticated by JWTAuthMiddleware, if any
+        self.user = self.scope.get('principal')
+        if self.user is None:
             await self.close()
             return
 
@@ -186,13 +196,41 @@ class NotificationConsumer(AsyncWebsocketConsumer):
 
         await self.accept()
 
+        # Admins with a notification socket open take new support tickets, for as long
+        # as the socket keeps vouching for them
+        if self.user.is_staff:
+            await admin_online(self.user.id)
+            self.heartbeat_task = asyncio.create_task(self.heartbeat())
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(settings.SUPPORT_ADMIN_HEARTBEAT_INTERVAL)
+            await admin_heartbeat(self.user.id)
+
     async def disconnect(self, close_code):
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        if self.user is not None and self.user.is_staff:
+            await admin_offline(self.user.id)
+
         # Remove the user from the notification group
         await self.channel_layer.group_discard(
             self.group_name,
             self.channel_name
         )
 
+    async def receive(self, text_data):
+        data = json.loads(text_data)
+
+        # Riders accept booking offers over this socket; the first one wins
+        if data.get('type') == 'accept_offer' and self.user.role == 'Rider':
+            booking_id = data.get('booking_id')
+            won = await database_sync_to_async(claim_offer, thread_sensitive=False)(booking_id, self.user.id)
+            await self.send(text_data=json.dumps({
+                'type': 'offer_accepted' if won else 'booking_offer_taken',
+                'booking_id': booking_id,
+            }))
+
     # Receive message from the group
     async def send_notification(self, event):
         message = event['message']
@@ -202,10 +240,3 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             'type': 'notification',
             'message': message
         }))
-
-    @database_sync_to_async
-    def get_user(self, user_id):
-        try:
-            return User.objects.get(id=user_id)
-        except User.DoesNotExist:
-            return None
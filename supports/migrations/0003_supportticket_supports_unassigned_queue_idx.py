@@ -0,0 +1,19 @@
+# Generated by Django 5.1 on 2026-10-17 00:44
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('supports', '0002_alter_chatmessage_ticket_alter_chatmessage_timestamp_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='supportticket',
+            index=models.Index(condition=models.Q(('assigned_admin__isnull', True), ('status', 'open')), fields=['created_at', 'id'], name='supports_unassigned_queue_idx'),
+        ),
+    ]
@@ -1,5 +1,6 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 
 User = get_user_model()
 
@@ -17,8 +18,32 @@ class SupportTicket(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # Only open, unassigned tickets: the admin queue stays small however many tickets are closed
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='supports_unassigned_queue_idx',
+                         condition=models.Q(status='open', assigned_admin__isnull=True)),
+        ]
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Closed tickets only keep their cached chat messages for a while,
+        # and no longer count towards their admin's load
+        if self.status == 'closed':
+            # pylint: disable=import-outside-toplevel
+            from .assignment import release_ticket
+            from .chat import close_ticket_chat
+
+            transaction.on_commit(lambda: close_ticket_chat(self.id))
+            transaction.on_commit(lambda: release_ticket(self.id))
+
 class ChatMessage(models.Model):
-    ticket = models.ForeignKey(SupportTicket, on_delete=models.CASCADE, related_name='messages')
+    ticket = models.ForeignKey(SupportTicket, on_delete=models.CASCADE, related_name='messages',
+                               db_index=False)
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     message = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the message is sent; history cursors are made from it
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['ticket', 'timestamp', 'id'])]
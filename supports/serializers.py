@@ -11,7 +11,16 @@ class SupportTicketSerializer(serializers.ModelSerializer):
         fields = ['id', 'user_avatar_url' ,'user_fullname', 'assigned_admin', 'created_at', 'status', 'first_message']
 
     def get_first_message(self, obj):
-        first_message = obj.messages.order_by('timestamp').first()
+        # Tickets from UnassignedTicketListView carry their first message as annotations
+        if hasattr(obj, 'first_message_id'):
+            if obj.first_message_id is None:
+                return None
+            first_message = ChatMessage(id=obj.first_message_id, ticket_id=obj.id,
+                                        sender_id=obj.first_message_sender_id,
+                                        message=obj.first_message_text,
+                                        timestamp=obj.first_message_timestamp)
+        else:
+            first_message = obj.messages.order_by('timestamp').first()
         if first_message:
             return MessageSerializer(first_message).data
         return None
@@ -0,0 +1,18 @@
+from celery import shared_task
+
+from .assignment import assign_waiting_tickets, reconcile_admin_loads, sweep_stale_admins
+
+@shared_task
+def assign_unassigned_tickets():
+    """Hand tickets that arrived while no admin was online to the least-loaded admins"""
+    return assign_waiting_tickets()
+
+@shared_task
+def reconcile_admin_load_cache():
+    """Correct any drift between the cached admin ticket counts and the tickets in Postgres"""
+    return reconcile_admin_loads()
+
+@shared_task
+def sweep_admin_presence():
+    """Take admins whose notification sockets stopped heartbeating out of the assignment pool"""
+    return len(sweep_stale_admins())
@@ -1,3 +1,364 @@
-from django.test import TestCase
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import parse_qs
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from rest_framework.test import APITestCase
+from rest_framework import status
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from ecoride.asgi import JWTAuthMiddleware
+from ecoride.redis_client import get_redis
+
+from .assignment import SUPPORT_ADMIN_LOAD_KEY, SUPPORT_ADMIN_SOCKETS_KEY, SUPPORT_ADMIN_TICKETS_KEY,\
+    SUPPORT_ADMINS_LAST_SEEN_KEY, SUPPORT_TICKET_ADMINS_KEY, admin_heartbeat, admin_offline, admin_online,\
+    assign_ticket, assign_waiting_tickets, claim_ticket, reconcile_admin_loads
+from .chat import ticket_chat_key
+from .tasks import sweep_admin_presence
+from .models import SupportTicket, ChatMessage
+from .urls import websocket_urlpatterns
+
+User = get_user_model()
+
+class UnassignedTicketListViewTests(APITestCase):
+
+    def setUp(self):
+        self.url = reverse('unassigned-tickets')
+        self.admin = User.objects.create_superuser(
+            fullname='Admin User', email='admin@example.com', password='adminpass', phone='08087654321')
+        self.users = [
+            User.objects.create_user(fullname=f'User {index}', email=f'user{index}@example.com',
+                                     password='userpass', role='User', is_active=True, phone=f'0908765432{index}')
+            for index in range(7)
+        ]
+        self.tickets = [SupportTicket.objects.create(user=user) for user in self.users]
+        for index, ticket in enumerate(self.tickets[::2]):
+            for line in range(3):
+                ChatMessage.objects.create(ticket=ticket, sender=ticket.user, message=f'Ticket {index} line {line}')
+
+        # Neither of these is in the queue
+        SupportTicket.objects.create(user=self.users[0], assigned_admin=self.admin, status='in_progress')
+        SupportTicket.objects.create(user=self.users[1], status='closed')
+
+    def test_admin_pages_through_the_queue(self):
+        """Admins get the open unassigned tickets oldest first, a page per query, with their first message"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.admin).access_token}')
+        url, pages = f'{self.url}?page_size=3', []
+        while url:
+            # The admin, then the page
+            with self.assertNumQueries(2):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            pages.append(response.data['results'])
+            url = response.data['next']
+
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        tickets = [ticket for page in pages for ticket in page]
+        self.assertEqual([ticket['id'] for ticket in tickets], [ticket.id for ticket in self.tickets])
+        self.assertEqual(tickets[0]['user_fullname'], 'User 0')
+        self.assertEqual(tickets[0]['first_message']['message'], 'Ticket 0 line 0')
+        self.assertEqual(tickets[0]['first_message']['sender'], self.users[0].id)
+        self.assertEqual(tickets[0]['first_message']['ticket'], self.tickets[0].id)
+        self.assertEqual(tickets[2]['first_message']['message'], 'Ticket 1 line 0')
+        self.assertIsNone(tickets[1]['first_message'])
+
+    def test_only_admins_see_the_queue(self):
+        """Normal users should not have access to the ticket queue"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.users[0]).access_token}')
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+class SupportAssignmentTests(TransactionTestCase):
+    CONCURRENT_TICKETS = 60
+
+    def setUp(self):
+        self.admins = [
+            User.objects.create_user(fullname=f'Admin {index}', email=f'admin{index}@example.com',
+                                     password='adminpass', role='Admin', is_staff=True, is_active=True,
+                                     phone=f'0808765432{index}')
+            for index in range(3)
+        ]
+        self.user = User.objects.create_user(fullname='Jane Doe', email='jane@example.com', password='userpass',
+                                             role='User', is_active=True, phone='09087654321')
+        keys = [SUPPORT_ADMIN_LOAD_KEY, SUPPORT_ADMIN_TICKETS_KEY, SUPPORT_TICKET_ADMINS_KEY, SUPPORT_ADMIN_SOCKETS_KEY,
+                SUPPORT_ADMINS_LAST_SEEN_KEY]
+        get_redis().delete(*keys)
+        self.addCleanup(get_redis().delete, *keys)
+
+    def load(self):
+        """Cached open ticket count per admin"""
+        return {admin_id.decode('utf-8'): int(count)
+                for admin_id, count in get_redis().hgetall(SUPPORT_ADMIN_TICKETS_KEY).items()}
+
+    def test_concurrent_tickets_are_spread_over_online_admins(self):
+        """
+        Test that simultaneous new tickets go to the least-loaded online admins only, each exactly once.
+        """
+        busy = self.admins[0]
+        for admin in self.admins:
+            async_to_sync(admin_online)(admin.id)
+        # A second socket of the same admin, closed again: they stay online
+        async_to_sync(admin_online)(busy.id)
+        async_to_sync(admin_offline)(busy.id)
+        for _ in range(4):
+            ticket = SupportTicket.objects.create(user=self.user)
+            self.assertTrue(claim_ticket(ticket.id, busy.id))
+
+        tickets = [SupportTicket.objects.create(user=self.user) for _ in range(self.CONCURRENT_TICKETS)]
+        barrier = threading.Barrier(self.CONCURRENT_TICKETS)
+
+        def assign(ticket):
+            barrier.wait()
+            try:
+                return assign_ticket(ticket.id)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.CONCURRENT_TICKETS) as executor:
+            assigned = list(executor.map(assign, tickets))
+
+        # 64 tickets over three admins, one of whom started with four
+        self.assertNotIn(None, assigned)
+        self.assertGreaterEqual(Counter(assigned)[str(busy.id)], 17)
+        self.assertEqual(sorted(self.load().values()), [21, 21, 22])
+        in_db = Counter(str(admin_id) for admin_id in
+                        SupportTicket.objects.filter(status='in_progress').values_list('assigned_admin_id', flat=True))
+        self.assertEqual(self.load(), dict(in_db))
+        self.assertIsNone(assign_ticket(tickets[0].id))
+
+        # An admin who goes offline gets nothing new, and keeps their count for when they return
+        for admin in self.admins:
+            async_to_sync(admin_offline)(admin.id)
+        self.assertFalse(get_redis().exists(SUPPORT_ADMIN_LOAD_KEY))
+        waiting = SupportTicket.objects.create(user=self.user)
+        self.assertIsNone(assign_ticket(waiting.id))
+        async_to_sync(admin_online)(busy.id)
+        self.assertEqual(get_redis().zscore(SUPPORT_ADMIN_LOAD_KEY, str(busy.id)), self.load()[str(busy.id)])
+        self.assertEqual(assign_waiting_tickets(), 1)
+        waiting.refresh_from_db()
+        self.assertEqual(waiting.assigned_admin_id, busy.id)
+
+    def test_closing_tickets_frees_their_admin(self):
+        """
+        Test that a closed ticket stops counting once, a lost claim leaves no count, and drift is reconciled.
+        """
+        admin, other, _ = self.admins
+        async_to_sync(admin_online)(admin.id)
+        ticket = SupportTicket.objects.create(user=self.user)
+        self.assertEqual(assign_ticket(ticket.id), str(admin.id))
+        self.assertFalse(claim_ticket(ticket.id, other.id))
+
+        ticket.refresh_from_db()
+        for _ in range(2):
+            ticket.status = 'closed'
+            ticket.save()
+        self.assertEqual(self.load(), {})
+        self.assertEqual(get_redis().zscore(SUPPORT_ADMIN_LOAD_KEY, str(admin.id)), 0)
+
+        held = SupportTicket.objects.create(user=self.user, assigned_admin=other, status='in_progress')
+        get_redis().hset(SUPPORT_ADMIN_TICKETS_KEY, str(admin.id), 5)
+        self.assertEqual(reconcile_admin_loads(), 2)
+        self.assertEqual(self.load(), {str(other.id): 1})
+        self.assertEqual(get_redis().hget(SUPPORT_TICKET_ADMINS_KEY, held.id), str(other.id).encode())
+
+    def test_admins_whose_sockets_died_leave_the_pool(self):
+        """
+        Test that admins whose heartbeat stopped are swept out of the pool, and that a late heartbeat brings them back.
+        """
+        ghost, admin, _ = self.admins
+        for someone in (ghost, admin):
+            async_to_sync(admin_online)(someone.id)
+        # The ghost's worker died a while ago without closing its socket
+        get_redis().zadd(SUPPORT_ADMINS_LAST_SEEN_KEY, {str(ghost.id): timezone.now().timestamp() - 600})
+
+        self.assertEqual(sweep_admin_presence(), 1)
+        self.assertEqual(get_redis().zrange(SUPPORT_ADMIN_LOAD_KEY, 0, -1), [str(admin.id).encode()])
+        self.assertFalse(get_redis().hexists(SUPPORT_ADMIN_SOCKETS_KEY, str(ghost.id)))
+        for _ in range(2):
+            ticket = SupportTicket.objects.create(user=self.user)
+            self.assertEqual(assign_ticket(ticket.id), str(admin.id))
+
+        # A socket that was only slow is put back, with its ticket count
+        async_to_sync(admin_heartbeat)(ghost.id)
+        self.assertEqual(get_redis().zscore(SUPPORT_ADMIN_LOAD_KEY, str(ghost.id)), 0)
+        self.assertEqual(sweep_admin_presence(), 0)
+        async_to_sync(admin_offline)(ghost.id)
+        self.assertIsNone(get_redis().zscore(SUPPORT_ADMINS_LAST_SEEN_KEY, str(ghost.id)))
+
+    @async_to_sync
+    async def test_assigned_admin_is_notified(self):
+        """
+        Test that a new support chat is assigned to the online admin, who hears about it on their notification socket.
+        """
+        application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+        admin, user = self.admins[0], self.user
+        admin_token, user_token = await database_sync_to_async(
+            lambda: [str(RefreshToken.for_user(someone).access_token) for someone in (admin, user)])()
+
+        notifications = WebsocketCommunicator(application, f'/ws/notifications/?token={admin_token}')
+        connected, _ = await notifications.connect()
+        self.assertTrue(connected)
+
+        chat = WebsocketCommunicator(application, f'/ws/support/?token={user_token}')
+        connected, _ = await chat.connect()
+        self.assertTrue(connected)
+        ticket_id = (await chat.receive_json_from())['ticket_id']
+
+        notification = await notifications.receive_json_from()
+        self.assertEqual(notification['message']['type'], 'support_ticket_assigned')
+        self.assertIsNotNone(get_redis().zscore(SUPPORT_ADMINS_LAST_SEEN_KEY, str(admin.id)))
+        self.assertEqual(notification['message']['ticket_id'], ticket_id)
+
+        for socket in (chat, notifications):
+            await socket.disconnect()
+        self.assertFalse(get_redis().exists(SUPPORT_ADMIN_LOAD_KEY))
+
+class SupportChatTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(fullname='Jane Doe', email='jane@example.com', password='userpass',
+                                             role='User', is_active=True, phone='09087654321')
+        self.ticket = SupportTicket.objects.create(user=self.user)
+        self.user_token = str(RefreshToken.for_user(self.user).access_token)
+
+        # The principal is already cached, so the budgets below are the consumer's own queries
+        self.application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+        async_to_sync(self.application.authenticate)(self.user_token)
+        get_redis().delete(ticket_chat_key(self.ticket.id))
+        self.addCleanup(get_redis().delete, ticket_chat_key(self.ticket.id))
+
+    @override_settings(RECENT_CHAT_MESSAGES=5, RECENT_CHAT_CLOSED_TTL=60)
+    def test_support_chat_history_is_cached_until_the_ticket_closes(self):
+        """
+        Test that support messages are cached on send, capped, and expire once the ticket is closed.
+        """
+        async def chat():
+            socket = WebsocketCommunicator(self.application, f'/ws/support/{self.ticket.id}/?token={self.user_token}')
+            connected, _ = await socket.connect()
+            self.assertTrue(connected)
+            for index in range(8):
+                await socket.send_json_to({'message': f'Help {index}'})
+                await socket.receive_json_from()
+            await socket.disconnect()
+
+            socket = WebsocketCommunicator(self.application, f'/ws/support/{self.ticket.id}/?token={self.user_token}')
+            await socket.connect()
+            history = (await socket.receive_json_from())['messages']
+            self.assertTrue(await socket.receive_nothing())
+            await socket.disconnect()
+            return history
+
+        history = async_to_sync(chat)()
+        self.assertEqual([message['message'] for message in history], [f'Help {index}' for index in range(3, 8)])
+        self.assertEqual(history[0]['sender'], self.user.email)
+        self.assertEqual(get_redis().llen(ticket_chat_key(self.ticket.id)), 5)
+        self.assertGreater(get_redis().ttl(ticket_chat_key(self.ticket.id)), 60)
+
+        self.ticket.status = 'closed'
+        self.ticket.save()
+        self.assertLessEqual(get_redis().ttl(ticket_chat_key(self.ticket.id)), 60)
+
+    @override_settings(RECENT_CHAT_MESSAGES=5, SUPPORT_CHAT_HISTORY_BATCH=4)
+    def test_support_chat_reconnect_receives_only_newer_messages(self):
+        """
+        Test that a reconnect with a cursor gets only later messages, in batches, from the cache or one query.
+        """
+        async def send_messages():
+            socket = WebsocketCommunicator(self.application, f'/ws/support/{self.ticket.id}/?token={self.user_token}')
+            await socket.connect()
+            await socket.receive_json_from()  # History
+            received = []
+            for index in range(8):
+                await socket.send_json_to({'message': f'Help {index}'})
+                received.append(await socket.receive_json_from())
+            await socket.disconnect()
+            return received
+
+        def reconnect(since):
+            async def connect():
+                socket = WebsocketCommunicator(
+                    self.application, f'/ws/support/{self.ticket.id}/?token={self.user_token}&since={since}')
+                await socket.connect()
+                frames = [await socket.receive_json_from()]
+                while not await socket.receive_nothing():
+                    frames.append(await socket.receive_json_from())
+                await socket.disconnect()
+                return frames
+            return async_to_sync(connect)()
+
+        received = async_to_sync(send_messages)()
+        cursors = [message['cursor'] for message in received]
+        # Cursors go in the query string as they are
+        self.assertEqual(parse_qs(f'since={cursors[0]}')['since'], [cursors[0]])
+
+        # Further back than the cache holds: one query besides the ticket
+        with self.assertNumQueries(2):
+            frames = reconnect(cursors[1])
+        self.assertEqual([len(frame['messages']) for frame in frames], [4, 2])
+        self.assertEqual([message['message'] for frame in frames for message in frame['messages']],
+                         [f'Help {index}' for index in range(2, 8)])
+        self.assertEqual(frames[-1]['cursor'], cursors[-1])
+
+        # Within the cache: just the ticket
+        with self.assertNumQueries(1):
+            frames = reconnect(cursors[5])
+        self.assertEqual([message['message'] for message in frames[0]['messages']], ['Help 6', 'Help 7'])
+
+        # Up to date: an empty batch that keeps the cursor
+        frames = reconnect(cursors[-1])
+        self.assertEqual(frames, [{'type': 'chat_history', 'messages': [], 'cursor': cursors[-1], 'next_cursor': None}])
+        self.assertEqual(reconnect('yesterday')[0]['type'], 'error')
+
+    @override_settings(RECENT_CHAT_MESSAGES=5, SUPPORT_CHAT_HISTORY_BATCH=2)
+    def test_support_chat_pages_back_through_older_messages(self):
+        """
+        Test that history older than the cache is paged newest first, one query per page, without gaps on ties.
+        """
+        # Messages 3 to 5 were sent at the same instant, across the cache and page boundaries
+        start = timezone.now() - timedelta(minutes=1)
+        ChatMessage.objects.bulk_create([
+            ChatMessage(ticket=self.ticket, sender=self.user, message=f'Help {index}',
+                        timestamp=start + timedelta(seconds=second))
+            for index, second in enumerate([0, 1, 2, 3, 3, 3, 4, 5, 6, 7])
+        ])
+
+        async def chat():
+            socket = WebsocketCommunicator(self.application, f'/ws/support/{self.ticket.id}/?token={self.user_token}')
+            await socket.connect()
+            frames = [await socket.receive_json_from()]
+            while not await socket.receive_nothing():
+                frames.append(await socket.receive_json_from())
+
+            pages, next_cursor = [], frames[-1]['next_cursor']
+            while next_cursor:
+                await socket.send_json_to({'type': 'chat_history', 'before': next_cursor})
+                pages.append(await socket.receive_json_from())
+                next_cursor = pages[-1]['next_cursor']
+
+            errors = []
+            for cursor in ('not-a-cursor', 12345):
+                await socket.send_json_to({'type': 'chat_history', 'before': cursor})
+                errors.append(await socket.receive_json_from())
+            await socket.disconnect()
+            return frames, pages, errors
+
+        # The ticket and the cache fill on connect, then one query per page
+        with self.assertNumQueries(5):
+            frames, pages, errors = async_to_sync(chat)()
+        self.assertEqual([message['message'] for frame in frames for message in frame['messages']],
+                         [f'Help {index}' for index in range(5, 10)])
+        self.assertNotIn('id', frames[0]['messages'][0])
+        self.assertEqual([len(page['messages']) for page in pages], [2, 2, 1])
+        history = [message['message'] for page in reversed(pages) for message in page['messages']]
+        self.assertEqual(history, [f'Help {index}' for index in range(5)])
+        self.assertEqual(errors, [{'type': 'error', 'message': 'Invalid history cursor.'}] * 2)
@@ -1,14 +1,39 @@
-from rest_framework.views import APIView
+from django.conf import settings
+from django.db.models import OuterRef, Subquery
+from rest_framework import generics
+from rest_framework.pagination import CursorPagination
 from rest_framework.permissions import IsAdminUser
-from rest_framework.response import Response
 
-from .models import SupportTicket
+from .models import SupportTicket, ChatMessage
 from .serializers import SupportTicketSerializer
 
-class UnassignedTicketListView(APIView):
+class UnassignedTicketPagination(CursorPagination):
+    """Keyset pages of the ticket queue, oldest first"""
+    ordering = ('created_at', 'id')
+    page_size = settings.SUPPORT_TICKET_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.SUPPORT_TICKET_MAX_PAGE_SIZE
+
+class UnassignedTicketListView(generics.ListAPIView):
+    """
+    Open tickets no admin has taken yet, oldest first, a page at a time.
+
+    Each page is one query: the user is joined in and the first message
+    annotated with subqueries, and the partial index on open unassigned
+    tickets serves the keyset seek.
+    """
     permission_classes = [IsAdminUser]
+    serializer_class = SupportTicketSerializer
+    pagination_class = UnassignedTicketPagination
 
-    def get(self, request):
-        unassigned_tickets = SupportTicket.objects.filter(assigned_admin__isnull=True, status='open')
-        serializer = SupportTicketSerializer(unassigned_tickets, many=True)
-        return Response(serializer.data)
+    def get_queryset(self):
+        first_message = ChatMessage.objects.filter(ticket=OuterRef('pk')).order_by('timestamp', 'id')
+        return SupportTicket.objects.filter(assigned_admin__isnull=True, status='open')\
+            .select_related('user')\
+            .annotate(
+                first_message_id=Subquery(first_message.values('id')[:1]),
+                first_message_sender_id=Subquery(first_message.values('sender')[:1],
+                                                 output_field=ChatMessage._meta.get_field('sender').target_field),
+                first_message_text=Subquery(first_message.values('message')[:1]),
+                first_message_timestamp=Subquery(first_message.values('timestamp')[:1]),
+            )